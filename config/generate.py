@@ -2,20 +2,16 @@
 
 Usage: `python3 -m config.generate`
 """
-from itertools import chain, product
+from itertools import product
 from pathlib import Path
 
-import t5
-
-import conversational_ai.tasks  # noqa: F401
+from conversational_ai import tasks
 
 WHITELIST = ["chitchat", "dailydialog", "convai2"]
 
 sizes = ["small", "base", "large", "3b", "11b"]
-mixtures = filter(
-    lambda task: any(name in task for name in WHITELIST),
-    chain(t5.data.TaskRegistry.names(), t5.data.MixtureRegistry.names()),
-)
+# the names are enough, so nothing (not even TensorFlow) needs to be imported
+mixtures = filter(lambda task: any(name in task for name in WHITELIST), tasks.names())
 
 for size, mixture in product(sizes, mixtures):
     path = Path(f"./config/mixtures/{mixture}/{size}.gin")
@@ -0,0 +1,241 @@
+"""Decodes many stored conversations at once, e.g. to compare checkpoints.
+
+Usage: `python3 -m conversational_ai.batch_infer --gin_file=batch_infer.gin`
+
+Conversations are read from transcripts (``chats/chat_*.txt`` or a directory of
+them), a ``ChatArchive``, JSON lines files of ``{"id": ..., "history": [...]}`` or
+a ChitChat split (e.g. ``"chitchat:validation"``). Prompts are built like
+``chat_interactively`` builds them and grouped into buckets by their number of
+tokens; each bucket is decoded by a model compiled for its length, so short
+prompts aren't padded to the longest one.
+"""
+import itertools
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+import gin
+
+from conversational_ai.chat import TokenizedHistory
+from conversational_ai.transcript import ChatArchive
+
+_Example = Dict[str, Any]
+
+
+@gin.configurable
+def batch_infer(
+    inputs: Sequence[str],
+    conversation_prefix: str,
+    turn_prefixes: List[str],
+    turn_suffix: str = "",
+    context_window: int = 100,
+    model_dir: Optional[Union[str, Path]] = None,
+    step: Optional[Union[int, str]] = "latest",
+    output_file: Union[str, Path] = "{model_dir}/batch_infer/{step}.jsonl",
+    bucket_lengths: Optional[Sequence[int]] = None,
+    every_turn: bool = True,
+    transcript_turn_prefixes: Sequence[str] = ("human: ", "model: "),
+    batches_per_write: int = 4,
+    stop_at_turn_prefixes: bool = False,
+) -> Path:
+    """Decodes the conversations in ``inputs`` and appends the results to a file.
+
+    If ``every_turn``, the model responds to every odd-length prefix of each
+    conversation (i.e. takes the place of the second speaker, like in a chat),
+    otherwise only to the whole conversation. Each result is written to
+    ``output_file`` as a JSON line with the ``id``, ``input``, ``prediction`` and the
+    original next turn (``reference``, if any). Examples that are already in
+    ``output_file`` are skipped, so an interrupted run can simply be restarted.
+
+    ``bucket_lengths`` are the input lengths to compile models for (only the
+    longest by default, i.e. ``utils.run.sequence_length["inputs"]``); each one
+    costs building the graph and restoring the checkpoint once. See
+    ``chat_interactively`` for ``stop_at_turn_prefixes``.
+
+    Returns:
+        the path of the output file
+    """
+    # (in)directly import tf here so we can set TF_CPP_MIN_LOG_LEVEL in __main__ first
+    import t5
+
+    from conversational_ai import t5_model
+
+    if model_dir is None:
+        model_dir = gin.query_parameter("utils.run.model_dir")
+    model_dir = str(model_dir)
+    if step is None or step == -1 or step == "latest":
+        step = t5_model.latest_checkpoint_step(model_dir)
+    step = int(step)
+    output_path = Path(str(output_file).format(model_dir=model_dir, step=step))
+    done = _completed_ids(output_path)
+
+    sequence_length = gin.query_parameter("utils.run.sequence_length")
+    bucket_lengths = sorted(bucket_lengths or [sequence_length["inputs"]])
+    # the vocabulary `utils.run` is configured with
+    vocabulary = t5_model.utils.inputs_vocabulary(t5.data.SentencePieceVocabulary())
+    history_kwargs = dict(
+        encode=vocabulary.encode,
+        max_tokens=bucket_lengths[-1],
+        conversation_prefix=conversation_prefix,
+        turn_prefixes=turn_prefixes,
+        turn_suffix=turn_suffix,
+        context_window=context_window,
+    )
+    if stop_at_turn_prefixes:
+        from conversational_ai import decoding
+
+        decoding.use_stop_sequences(
+            decoding.encode_stop_sequences(vocabulary, turn_prefixes)
+        )
+
+    buckets: Dict[int, List[_Example]] = {length: [] for length in bucket_lengths}
+    for example in _examples(
+        inputs, history_kwargs, every_turn, transcript_turn_prefixes
+    ):
+        if example["id"] not in done:
+            length = next(
+                (n for n in bucket_lengths if example["num_tokens"] <= n),
+                bucket_lengths[-1],  # the (single) most recent turn doesn't fit
+            )
+            buckets[length].append(example)
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with output_path.open("a") as f:
+        for length, examples in buckets.items():
+            if examples:
+                _decode_bucket(
+                    model_dir,
+                    step,
+                    {**sequence_length, "inputs": length},
+                    examples,
+                    f,
+                    batches_per_write,
+                )
+    return output_path
+
+
+def _decode_bucket(
+    model_dir: str,
+    step: int,
+    sequence_length: Dict[str, int],
+    examples: List[_Example],
+    f: Any,
+    batches_per_write: int,
+) -> None:
+    """Decodes ``examples`` with a model compiled for ``sequence_length``."""
+    import tensorflow.compat.v1 as tf
+
+    from conversational_ai import t5_model
+
+    with gin.unlock_config():
+        gin.bind_parameter("utils.run.sequence_length", sequence_length)
+    predictor = t5_model.Predictor(model_dir, step=step)
+    tf.logging.info(
+        "Decoding %d examples with %d input tokens",
+        len(examples),
+        sequence_length["inputs"],
+    )
+    chunk_size = predictor.batch_size * batches_per_write
+    try:
+        for i in range(0, len(examples), chunk_size):
+            chunk = examples[i : i + chunk_size]
+            predictions = predictor([ex["input"] for ex in chunk])
+            for ex, prediction in zip(chunk, predictions):
+                result = {
+                    "id": ex["id"],
+                    "step": step,
+                    "input": ex["input"],
+                    "prediction": prediction,
+                    "reference": ex["reference"],
+                }
+                f.write(json.dumps(result) + "\n")
+            f.flush()  # so a restarted run skips everything that was decoded
+    finally:
+        predictor.close()
+
+
+def _examples(
+    inputs: Sequence[str],
+    history_kwargs: Dict[str, Any],
+    every_turn: bool,
+    transcript_turn_prefixes: Sequence[str],
+) -> List[_Example]:
+    """Returns the model input of each example, sorted by its number of tokens."""
+    examples = []
+    for convo_id, convo in read_conversations(inputs, transcript_turn_prefixes):
+        history = TokenizedHistory(**history_kwargs)
+        for i, turn in enumerate(convo):
+            history.append(turn)
+            if (i % 2 == 0) if every_turn else (i == len(convo) - 1):
+                model_input = history.model_input()
+                examples.append(
+                    {
+                        "id": f"{convo_id}:{i + 1}",
+                        "input": model_input,
+                        "num_tokens": len(history.encode(model_input)) + 1,  # + EOS
+                        "reference": convo[i + 1] if i + 1 < len(convo) else None,
+                    }
+                )
+    return sorted(examples, key=lambda ex: ex["num_tokens"])
+
+
+def read_conversations(
+    inputs: Sequence[str], transcript_turn_prefixes: Sequence[str]
+) -> Iterator[Tuple[str, List[str]]]:
+    """Yields the ID and turns of each conversation in ``inputs``."""
+    for spec in inputs:
+        path = Path(spec)
+        if spec.startswith("chitchat:"):
+            from conversational_ai.dataset import chitchat
+
+            split = spec[len("chitchat:") :]
+            for i, convo in enumerate(chitchat.load_conversations(split)):
+                yield f"{spec}:{i}", convo
+        elif path.with_name(path.name + ".index.json").exists():
+            archive = ChatArchive(path)
+            for name in archive.names():
+                turns = archive.read(name)["turns"]
+                yield name, _strip_prefixes(turns, transcript_turn_prefixes)
+        elif path.suffix == ".jsonl":
+            for line in path.read_text().splitlines():
+                if line.strip():
+                    record = json.loads(line)
+                    yield str(record["id"]), record["history"]
+        else:
+            for transcript in (
+                sorted(path.glob("chat_*.txt")) if path.is_dir() else [path]
+            ):
+                turns = transcript.read_text().splitlines()
+                yield transcript.stem, _strip_prefixes(turns, transcript_turn_prefixes)
+
+
+def _strip_prefixes(turns: List[str], prefixes: Sequence[str]) -> List[str]:
+    """Removes the speaker prefixes a ``TranscriptWriter`` added to each turn."""
+    return [
+        turn[len(p) :] if turn.startswith(p) else turn
+        for turn, p in zip(turns, itertools.cycle(prefixes))
+    ]
+
+
+def _completed_ids(output_path: Path) -> Set[str]:
+    """Returns the IDs of the examples in ``output_path``.
+
+    A partially written last line (from an interrupted run) is removed.
+    """
+    if not output_path.exists():
+        return set()
+    data = output_path.read_bytes()
+    complete = data[: data.rfind(b"\n") + 1]
+    if len(complete) < len(data):
+        with output_path.open("r+b") as f:
+            f.truncate(len(complete))
+    return {json.loads(line)["id"] for line in complete.decode("utf-8").splitlines()}
+
+
+if __name__ == "__main__":
+    os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # disable tf C++ logging before importing
+    from conversational_ai import t5_model
+
+    t5_model.parse_gin_defaults_and_flags()
+    batch_infer()
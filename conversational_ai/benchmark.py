@@ -0,0 +1,383 @@
+"""Benchmarks startup, inference and the data pipeline on a CPU, offline.
+
+Usage: `python3 -m conversational_ai.benchmark --help`
+
+A tiny, randomly initialized T5 model (and SentencePiece vocabulary) is created in
+a temporary directory, so the numbers are only comparable between runs of this
+script (e.g. on different commits), not with real checkpoints. The results are
+printed (and optionally written) as JSON.
+"""
+import datetime
+import itertools
+import json
+import os
+import platform
+import subprocess  # noqa: S404
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import chitchat_dataset as ccc
+import gin
+
+from conversational_ai.chat import TokenizedHistory, chat_turn
+from conversational_ai.instrumentation import TurnRecorder, mean, percentile
+
+_CONVERSATION_PREFIX = "prefix: "
+_TURN_PREFIXES = ["speaker1>", "speaker2>"]
+_TURN_SUFFIX = "\t"
+
+# a model small enough to build, train for a step and decode with in seconds
+_TINY_MODEL_BINDINGS = [
+    "num_layers = 1",
+    "d_model = 32",
+    "d_ff = 64",
+    "num_heads = 2",
+    "d_kv = 16",
+    'utils.get_variable_dtype.activation_dtype = "float32"',
+    'utils.run.mesh_shape = "model:1,batch:1"',
+    "utils.run.tpu_job_name = None",
+    "utils.run.tpu = None",
+    "utils.run.gcp_project = None",
+    "utils.run.tpu_zone = None",
+    'utils.run.sequence_length = {"inputs": 64, "targets": 16}',
+    "utils.run.train_steps = 1",
+    "utils.run.iterations_per_loop = 1",
+    "utils.run.save_checkpoints_steps = 1",
+    "Bitransformer.decode.max_decode_length = 16",
+]
+
+# what each entry point imports (and registers) before it parses its gin config
+_ENTRY_POINT_IMPORTS = {
+    "tasks": "import conversational_ai.tasks",
+    "chat": "import conversational_ai.chat, conversational_ai.t5_model",
+    "train": "import conversational_ai.t5_model",
+    "train_mixture": (
+        "from conversational_ai import t5_model\n"
+        't5_model.tasks.register("chitchat_dailydialog_v003_prefix_lm")'
+    ),
+}
+_HEAVY_MODULES = ["tensorflow", "tensorflow_datasets", "t5", "mesh_tensorflow"]
+_IMPORT_TIMER = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"seconds": seconds, "modules": len(sys.modules), "heavy": heavy}}))
+"""
+
+
+def benchmark(
+    work_dir: Path,
+    batch_sizes: Sequence[int] = (1, 2, 4, 8),
+    num_turns: int = 8,
+    num_examples: int = 1000,
+    model: bool = True,
+    datasets: bool = True,
+    gin_params: Optional[List[str]] = None,
+    imports: bool = True,
+) -> Dict[str, Any]:
+    """Runs the benchmarks and returns their results."""
+    results: Dict[str, Any] = {"meta": _metadata()}
+    if imports:
+        results["imports"] = benchmark_imports()
+    if model:
+        model_dir = _create_tiny_model(work_dir, gin_params or [])
+        results["chat"] = benchmark_chat(model_dir, num_turns)
+        results["throughput"] = [
+            benchmark_throughput(model_dir, batch_size) for batch_size in batch_sizes
+        ]
+    if datasets:
+        results["datasets"] = benchmark_datasets(num_examples)
+    return results
+
+
+def benchmark_imports(repeats: int = 3) -> Dict[str, Dict[str, Any]]:
+    """Times what each entry point imports, in a new interpreter each time.
+
+    The first run is (close to) a cold start, later ones hit the OS file cache.
+    Also reports which of the heavy libraries (e.g. TensorFlow) got imported.
+    """
+    results = {}
+    for name, statement in _ENTRY_POINT_IMPORTS.items():
+        runs = []
+        for _ in range(repeats):
+            output = subprocess.run(  # noqa: S603
+                [
+                    sys.executable,
+                    "-c",
+                    _IMPORT_TIMER.format(statement=statement, heavy=_HEAVY_MODULES),
+                ],
+                cwd=Path(__file__).parent.parent,
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+                check=True,
+            ).stdout
+            runs.append(json.loads(output.splitlines()[-1]))
+        seconds = [run["seconds"] for run in runs]
+        results[name] = {
+            "seconds": seconds,
+            "min_seconds": min(seconds),
+            "modules": runs[-1]["modules"],
+            "heavy_modules": runs[-1]["heavy"],
+        }
+    return results
+
+
+def benchmark_chat(model_dir: str, num_turns: int) -> Dict[str, Any]:
+    """Times each step of chat turns with a batch size of 1 (see ``TurnRecorder``).
+
+    The first turn also builds the graph and restores the checkpoint.
+    """
+    from conversational_ai import t5_model
+
+    _bind_batch_size(1)
+    recorder = TurnRecorder()
+    with recorder.span("load_model"):
+        predictor = t5_model.Predictor(
+            model_dir, step="latest", hooks=[recorder.hook()]
+        )
+    history = TokenizedHistory(
+        t5_model.utils.inputs_vocabulary(predictor.vocabulary).encode,
+        predictor.sequence_length["inputs"],
+        _CONVERSATION_PREFIX,
+        _TURN_PREFIXES,
+        _TURN_SUFFIX,
+    )
+    try:
+        for text in _conversation_turns(num_turns):
+            chat_turn(text, history, predictor, _TURN_PREFIXES, recorder)
+            recorder.end_turn()
+    finally:
+        predictor.close()
+
+    decode_times = sorted(t["spans"]["decode"]["seconds"] for t in recorder.turns[1:])
+    return {
+        "decode": {
+            "mean": mean(decode_times),
+            **{f"p{q}": percentile(decode_times, q) for q in [50, 90]},
+        },
+        "turns": recorder.turns,
+    }
+
+
+def benchmark_throughput(
+    model_dir: str, batch_size: int, num_batches: int = 4
+) -> Dict[str, Any]:
+    """Times decoding full batches with a model compiled for ``batch_size``."""
+    from conversational_ai import t5_model
+
+    _bind_batch_size(batch_size)
+    predictor = t5_model.Predictor(model_dir, step="latest")
+    inputs = list(itertools.islice(_model_inputs(), batch_size * num_batches))
+    try:
+        predictor(inputs[:batch_size])  # build the graph and restore the checkpoint
+        start = time.perf_counter()
+        predictor(inputs)
+        seconds = time.perf_counter() - start
+    finally:
+        predictor.close()
+    return {
+        "batch_size": batch_size,
+        "examples": len(inputs),
+        "seconds": seconds,
+        "examples_per_second": len(inputs) / seconds,
+    }
+
+
+def benchmark_datasets(num_examples: int) -> Dict[str, Dict[str, Any]]:
+    """Times generating (at most) ``num_examples`` with each task's ``dataset_fn``."""
+    import t5
+    import tensorflow.compat.v1 as tf
+    import tensorflow_datasets as tfds
+
+    from conversational_ai import tasks
+    from conversational_ai.dataset.cache import CachedTask
+
+    tasks.register_all()
+    results: Dict[str, Dict[str, Any]] = {}
+    for name in sorted(t5.data.TaskRegistry.names()):
+        task = t5.data.TaskRegistry.get(name)
+        if not isinstance(task, CachedTask):
+            continue  # only benchmark our tasks, not all of T5's
+        try:
+            with tf.Graph().as_default():
+                start = time.perf_counter()
+                ds = task._dataset_fn(split="validation", shuffle_files=False)
+                examples = tfds.as_numpy(ds.take(num_examples))
+                num = sum(1 for _ in examples)
+                seconds = time.perf_counter() - start
+        except Exception as e:  # e.g. the dataset hasn't been downloaded
+            results[name] = {"error": repr(e)}
+            continue
+        results[name] = {
+            "examples": num,
+            "seconds": seconds,
+            "examples_per_second": num / seconds,
+        }
+    return results
+
+
+def _create_tiny_model(work_dir: Path, gin_params: List[str]) -> str:
+    """Creates a tiny model (trained for one step) and returns its ``model_dir``."""
+    import pkg_resources
+    import t5
+
+    from conversational_ai import t5_model
+
+    model_dir = work_dir.joinpath("model")
+    gin.add_config_file_search_path(
+        pkg_resources.resource_filename("mesh_tensorflow.transformer", "gin")
+    )
+    gin.parse_config_files_and_bindings(
+        ["defaults.gin"], _TINY_MODEL_BINDINGS + gin_params
+    )
+    vocabulary = t5.data.SentencePieceVocabulary(_train_sentencepiece(work_dir))
+    with gin.unlock_config():
+        gin.bind_parameter("utils.run.model_dir", str(model_dir))
+        gin.bind_parameter("utils.run.vocabulary", vocabulary)
+        gin.bind_parameter("utils.run.train_dataset_fn", _random_dataset)
+        gin.bind_parameter("utils.run.mode", "train")
+    _bind_batch_size(1)
+    t5_model.run()
+    return str(model_dir)
+
+
+def _train_sentencepiece(work_dir: Path, vocab_size: int = 512) -> str:
+    """Trains a small SentencePiece model on ChitChat and returns its path."""
+    import sentencepiece
+
+    text_file = work_dir.joinpath("sentencepiece.txt")
+    with text_file.open("w") as f:
+        for convo in itertools.islice(ccc.ConversationDataset(), 500):
+            f.writelines(f"{turn}\n" for turn in convo)
+    prefix = work_dir.joinpath("sentencepiece")
+    # T5 expects pad=0, EOS=1 and UNK=2
+    sentencepiece.SentencePieceTrainer.Train(
+        f"--input={text_file} --model_prefix={prefix} --vocab_size={vocab_size} "
+        "--pad_id=0 --eos_id=1 --unk_id=2 --bos_id=-1 --minloglevel=2"
+    )
+    return f"{prefix}.model"
+
+
+def _random_dataset(
+    sequence_length: Dict[str, int], vocabulary: Any, dataset_split: str
+) -> Any:
+    """A ``train_dataset_fn`` of random tokens, just to create a checkpoint."""
+    import tensorflow.compat.v1 as tf
+
+    return tf.data.Dataset.from_tensors(
+        {
+            k: tf.random.uniform([length], 2, vocabulary.vocab_size, tf.int32)
+            for k, length in sequence_length.items()
+        }
+    )
+
+
+def _bind_batch_size(batch_size: int) -> None:
+    with gin.unlock_config():
+        gin.bind_parameter("utils.run.batch_size", ("sequences_per_batch", batch_size))
+
+
+def _conversation_turns(num_turns: int) -> List[str]:
+    turns = itertools.chain.from_iterable(ccc.ConversationDataset())
+    return list(itertools.islice(turns, num_turns))
+
+
+def _model_inputs() -> Any:
+    for convo in ccc.ConversationDataset():
+        convo = list(convo)
+        for i in range(1, len(convo)):
+            yield _CONVERSATION_PREFIX + _TURN_SUFFIX.join(
+                ccc.prepend_cycle(convo[:i], _TURN_PREFIXES)
+            )
+
+
+def _metadata() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(  # noqa: S603,S607
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def _parse_args() -> Any:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--output", help="write the results to this JSON file", metavar="PATH"
+    )
+    parser.add_argument(
+        "--batch_sizes",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=[1, 2, 4, 8],
+        help="the batch sizes to measure the throughput of (default: 1,2,4,8)",
+    )
+    parser.add_argument(
+        "--num_turns", type=int, default=8, help="the number of chat turns to time"
+    )
+    parser.add_argument(
+        "--num_examples",
+        type=int,
+        default=1000,
+        help="the number of examples to generate per task",
+    )
+    parser.add_argument(
+        "--skip_model", action="store_true", help="skip the inference benchmarks"
+    )
+    parser.add_argument(
+        "--skip_datasets", action="store_true", help="skip the dataset benchmarks"
+    )
+    parser.add_argument(
+        "--skip_imports",
+        action="store_true",
+        help="skip timing the imports of the entry points",
+    )
+    parser.add_argument(
+        "--gin_param",
+        action="append",
+        help="override a binding of the tiny model (e.g. to test a bigger one)",
+        metavar="PARAM",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # disable tf C++ logging before importing
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""  # always benchmark on the CPU
+    _args = _parse_args()
+    with tempfile.TemporaryDirectory() as _tmp:
+        _results = benchmark(
+            Path(_tmp),
+            batch_sizes=_args.batch_sizes,
+            num_turns=_args.num_turns,
+            num_examples=_args.num_examples,
+            model=not _args.skip_model,
+            datasets=not _args.skip_datasets,
+            gin_params=_args.gin_param,
+            imports=not _args.skip_imports,
+        )
+    _output = json.dumps(_results, indent=2)
+    print(_output)
+    if _args.output:
+        Path(_args.output).write_text(_output + "\n")
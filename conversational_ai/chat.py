@@ -1,12 +1,18 @@
 """Simple chatbot script to chat with a trained T5 model."""
+import functools
+import math
 import os
 import readline  # noqa: F401,W0611
+import time
 from pathlib import Path
-from typing import Iterable, List, Optional, Union
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple, Union
 
 import chitchat_dataset as ccc
 import gin
 
+from conversational_ai.instrumentation import TurnRecorder
+from conversational_ai.transcript import TranscriptWriter
+
 
 @gin.configurable
 def chat_interactively(
@@ -21,8 +27,41 @@ def chat_interactively(
     conversation_length_save_threshold: int = 0,
     output_turn_prefixes: Iterable[str] = ["human: ", "model: "],  # noqa: B006
     prompt: str = "> ",
+    persistent: bool = True,
+    max_input_tokens: Optional[int] = None,
+    metrics_file: Optional[Union[str, Path]] = None,
+    print_metrics_summary: bool = False,
+    stop_at_turn_prefixes: bool = False,
+    stream: bool = False,
+    num_candidates: int = 1,
+    repetition_penalty: float = 1.0,
 ) -> List[str]:
-    """Runs an interactive chat session with the trained T5 model."""
+    """Runs an interactive chat session with the trained T5 model.
+
+    The oldest turns are dropped so that the model input fits in
+    ``max_input_tokens`` tokens (``utils.run.sequence_length["inputs"]`` by default)
+    instead of letting the model truncate the most recent turns.
+
+    Turns are appended to ``output_file`` as they happen, once the chat has
+    ``conversation_length_save_threshold`` turns (see ``TranscriptWriter``).
+
+    If ``metrics_file`` is given, the time spent in each step of every turn (see
+    ``TurnRecorder``) is appended to it as JSON lines, and a summary is printed at
+    the end of the session if ``print_metrics_summary``.
+
+    If ``stop_at_turn_prefixes``, decoding stops as soon as the model starts the
+    next turn (see ``decoding.use_stop_sequences``) instead of decoding up to
+    ``max_decode_length`` tokens that ``postprocess_response`` throws away.
+
+    If ``stream`` (and ``persistent``), the response is printed as it is decoded
+    (see ``Predictor.stream``), up to the next turn prefix, and the time to its
+    first piece is recorded as ``time_to_first_token``.
+
+    If ``num_candidates > 1`` (and ``persistent``), that many responses are sampled
+    in one batch (see ``Predictor.sample``) instead, and the one with the highest
+    log-likelihood per token is used, less ``repetition_penalty`` if the model
+    already said it in the chat (see ``_rerank``). Decoding must sample then.
+    """
     # (in)directly import tf here so we can set TF_CPP_MIN_LOG_LEVEL in __main__ first
     from conversational_ai import t5_model
 
@@ -37,47 +76,373 @@ def chat_interactively(
         "timestamp": t5_model.RUN_TIMESTAMP,
     }
 
+    transcript = None
     if output_file is not None:
-        output_file = Path(str(output_file).format(**fmt))
-        output_file.parent.mkdir(parents=True, exist_ok=True)
+        transcript = TranscriptWriter(
+            Path(str(output_file).format(**fmt)),
+            output_turn_prefixes,
+            min_turns=conversation_length_save_threshold,
+        )
+
+    recorder = TurnRecorder(
+        Path(str(metrics_file).format(**fmt)) if metrics_file is not None else None
+    )
+    with recorder.span("load_model"):
+        predict, vocabulary = _load_model(
+            str(model_dir),
+            step,
+            persistent,
+            [recorder.hook()],
+            turn_prefixes if stop_at_turn_prefixes else None,
+            emit_tokens=stream or num_candidates > 1,
+        )
+    stream_fn, sample_fn = _decode_fns(predict, stream, num_candidates)
 
-    history: List[str] = []
+    if max_input_tokens is None:
+        max_input_tokens = gin.query_parameter("utils.run.sequence_length")["inputs"]
+
+    tokenized_history = TokenizedHistory(
+        vocabulary.encode,
+        max_input_tokens,
+        conversation_prefix,
+        turn_prefixes,
+        turn_suffix,
+        context_window,
+    )
+    history = tokenized_history.turns
+    predictor = predict if isinstance(predict, t5_model.Predictor) else None
     try:
         while True:
             inp = input(prompt)
-            history.append(inp)
-
-            inputs = ccc.prepend_cycle(history[-context_window:], turn_prefixes)
-            inputs = [conversation_prefix + turn_suffix.join(inputs)]
-            predictions = t5_model.predict(inputs, model_dir=str(model_dir), step=step)
-
-            # TODO: should we join all predictions?
-            prediction = _postprocess_response("\n".join(predictions), turn_prefixes)
-
-            history.append(prediction)
-            print(prediction)
-            if output_file and len(history) >= conversation_length_save_threshold:
-                output = ccc.prepend_cycle(history, output_turn_prefixes)
-                output_file.write_text("\n".join(output))
+            decoded_before = predictor.num_decoded_tokens if predictor else 0
+            _, prediction = chat_turn(
+                inp,
+                tokenized_history,
+                predict,
+                turn_prefixes,
+                recorder,
+                stream_fn,
+                sample_fn,
+                repetition_penalty,
+                echo=True,
+            )
+            # counted by `TokenizedHistory` and the `Predictor` as they went
+            recorder.add(input_tokens=tokenized_history.num_input_tokens)
+            if predictor is not None:
+                recorder.add(
+                    decoded_tokens=predictor.num_decoded_tokens - decoded_before
+                )
+            recorder.end_turn()
+            if transcript is not None:
+                transcript.append(inp)
+                transcript.append(prediction)
     except (KeyboardInterrupt, EOFError):
         return history  # return without printing traceback
     except Exception:
         raise
     finally:
+        if predictor is not None:
+            predictor.close()
+        if transcript is not None:
+            transcript.close()
+        if print_metrics_summary and recorder.turns:
+            print(recorder.summary())
         if config_log_file and len(history) >= conversation_length_save_threshold:
             config_log_file = Path(str(config_log_file).format(**fmt))
             config_log_file.parent.mkdir(parents=True, exist_ok=True)
             config_log_file.write_text(gin.config_str())  # gin will have been init
 
 
+def chat_turn(
+    inp: str,
+    tokenized_history: "TokenizedHistory",
+    predict: Callable[[List[str]], List[str]],
+    turn_prefixes: List[str],
+    recorder: TurnRecorder,
+    stream: Optional[Callable[[str], Iterable[str]]] = None,
+    sample: Optional[Callable[[str], List[Tuple[str, float, int]]]] = None,
+    repetition_penalty: float = 1.0,
+    echo: bool = False,
+) -> Tuple[str, str]:
+    """Appends ``inp`` and the model's response to it to the history.
+
+    If ``stream`` is given (e.g. ``Predictor.stream``), it is used instead of
+    ``predict``. If ``sample`` is given (e.g. ``Predictor.sample``), the candidates
+    it returns are reranked with ``_rerank`` instead. If ``echo``, the response is
+    printed (as it comes, if streamed).
+
+    Returns:
+        the model input and the (postprocessed) response
+    """
+    with recorder.span("tokenize"):
+        tokenized_history.append(inp)
+    with recorder.span("build_prompt"):
+        model_input = tokenized_history.model_input()
+    if stream is not None:
+        with recorder.span("decode"):
+            start = time.perf_counter()
+            pieces: List[str] = []
+            for piece in _stream_response(stream(model_input), turn_prefixes):
+                if not pieces:
+                    recorder.add(time_to_first_token=time.perf_counter() - start)
+                pieces.append(piece)
+                if echo:
+                    print(piece, end="", flush=True)
+        prediction = "".join(pieces)
+        if echo:
+            print()
+    elif sample is not None:
+        with recorder.span("decode"):
+            candidates = sample(model_input)
+        with recorder.span("rerank"):
+            previous = tokenized_history.turns[1::2]  # the model's turns so far
+            prediction = _rerank(
+                candidates, turn_prefixes, previous, repetition_penalty
+            )
+        recorder.add(num_candidates=len(candidates))
+        if echo:
+            print(prediction)
+    else:
+        with recorder.span("decode"):
+            predictions = predict([model_input])
+        with recorder.span("postprocess"):
+            # TODO: should we join all predictions?
+            prediction = postprocess_response("\n".join(predictions), turn_prefixes)
+        if echo:
+            print(prediction)
+    with recorder.span("tokenize"):
+        tokenized_history.append(prediction)
+    return model_input, prediction
+
+
+def _load_model(
+    model_dir: str,
+    step: Optional[Union[int, str]],
+    persistent: bool,
+    hooks: Optional[List[Any]] = None,
+    stop_strings: Optional[List[str]] = None,
+    emit_tokens: bool = False,
+) -> Tuple[Callable[[List[str]], List[str]], Any]:
+    """Returns a function to get predictions from the model and its vocabulary.
+
+    ``hooks`` are only used by a ``persistent`` model (see ``Predictor``). If
+    ``stop_strings`` are given, decoding stops at any of them. If ``emit_tokens``,
+    the graph passes each decoded token on (see ``decoding.emit_tokens``).
+    """
+    import t5
+
+    from conversational_ai import decoding, t5_model
+
+    if persistent:  # keep the model loaded instead of restoring it every turn
+        predictor = t5_model.Predictor(model_dir, step=step, hooks=hooks)
+        predict: Callable[[List[str]], List[str]] = predictor
+        vocabulary = t5_model.utils.inputs_vocabulary(predictor.vocabulary)
+    else:
+        predict = functools.partial(t5_model.predict, model_dir=model_dir, step=step)
+        vocabulary = t5.data.SentencePieceVocabulary(t5.data.DEFAULT_SPM_PATH)
+
+    # the graph is only built when decoding the first turn, so this isn't too late
+    decoding.use_stop_sequences(
+        decoding.encode_stop_sequences(vocabulary, stop_strings or [])
+    )
+    if emit_tokens:
+        decoding.emit_tokens()
+    return predict, vocabulary
+
+
+def _decode_fns(
+    predict: Callable[[List[str]], List[str]], stream: bool, num_candidates: int
+) -> Tuple[Any, Any]:
+    """Returns the ``stream`` and ``sample`` functions for ``chat_turn`` (if any).
+
+    Both need a ``Predictor``; sampling candidates takes precedence since the
+    response is only known once they are all decoded. Sampling them raises a
+    ``ValueError`` if decoding is deterministic, since they would all be the same.
+    """
+    from conversational_ai import t5_model
+
+    if not isinstance(predict, t5_model.Predictor):
+        return None, None
+    if num_candidates > 1:
+        if predict.deterministic:
+            predict.close()
+            raise ValueError(
+                "num_candidates > 1 needs sampling (a temperature > 0 and no beam "
+                "search) or the candidates are all the same"
+            )
+        return None, functools.partial(predict.sample, num_samples=num_candidates)
+    return predict.stream if stream else None, None
+
+
+def build_model_input(
+    history: List[str],
+    conversation_prefix: str,
+    turn_prefixes: List[str],
+    turn_suffix: str = "",
+    context_window: int = 100,
+) -> str:
+    """Returns the model input of the last ``context_window`` turns of ``history``."""
+    inputs = ccc.prepend_cycle(history[-context_window:], turn_prefixes)
+    return conversation_prefix + turn_suffix.join(inputs)
+
+
+class TokenizedHistory:
+    """A conversation history that fits the model input in a token budget.
+
+    Each turn is tokenized once, when it is appended, and only its token counts are
+    kept. ``model_input`` then uses them to keep as many of the most recent turns
+    as fit in ``max_tokens`` without tokenizing the history again.
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[str], List[int]],
+        max_tokens: int,
+        conversation_prefix: str,
+        turn_prefixes: List[str],
+        turn_suffix: str = "",
+        context_window: int = 100,
+    ) -> None:
+        """Creates an empty history (see ``chat_interactively`` for the args)."""
+        assert len(turn_prefixes) == 2
+        self.encode = encode
+        self.max_tokens = max_tokens
+        self.conversation_prefix = conversation_prefix
+        self.turn_prefixes = turn_prefixes
+        self.turn_suffix = turn_suffix
+        self.context_window = context_window
+        self.turns: List[str] = []
+        # the number of tokens in each turn when prepended with either turn prefix
+        self._num_tokens: List[Tuple[int, int]] = []
+        self._num_prefix_tokens = len(encode(conversation_prefix)) + 1  # + EOS
+        # the number of tokens in the last `model_input`
+        self.num_input_tokens = self._num_prefix_tokens
+
+    def append(self, turn: str) -> None:
+        """Appends (and tokenizes) a turn."""
+        self.turns.append(turn)
+        num_tokens = [
+            len(self.encode(p + turn + self.turn_suffix)) for p in self.turn_prefixes
+        ]
+        self._num_tokens.append((num_tokens[0], num_tokens[1]))
+
+    def model_input(self) -> str:
+        """Returns the model input for the most recent turns that fit.
+
+        Its number of tokens (as counted from the turns) is kept in
+        ``num_input_tokens``.
+        """
+        # the first turn in the window always gets the first turn prefix, so a turn's
+        # prefix (and token count) depends on whether the window has an odd or even
+        # number of turns; keep a running total for each case
+        totals = [self._num_prefix_tokens, self._num_prefix_tokens]
+        num_turns = 0
+        self.num_input_tokens = self._num_prefix_tokens
+        for i, num_tokens in enumerate(reversed(self._num_tokens)):
+            if i >= self.context_window:
+                break
+            totals = [totals[0] + num_tokens[i % 2], totals[1] + num_tokens[1 - i % 2]]
+            if num_turns and totals[i % 2] > self.max_tokens:
+                break
+            num_turns += 1
+            self.num_input_tokens = totals[i % 2]
+
+        return build_model_input(
+            self.turns,
+            self.conversation_prefix,
+            self.turn_prefixes,
+            self.turn_suffix,
+            num_turns,
+        )
+
+
 # FIXME: figure out how to handle postprocessing the output
-def _postprocess_response(prediction: str, turn_prefixes: List[str]) -> str:
+def postprocess_response(prediction: str, turn_prefixes: List[str]) -> str:
+    """Returns the first turn of the second speaker in ``prediction``."""
     assert len(turn_prefixes) == 2
     splits = prediction.split(turn_prefixes[1], 1)
-    prediction = next(s.strip() for s in splits if s.strip())
+    prediction = next((s.strip() for s in splits if s.strip()), "")
     return prediction.split(turn_prefixes[0], 1)[0].strip()
 
 
+def _rerank(
+    candidates: List[Tuple[str, float, int]],
+    turn_prefixes: List[str],
+    previous: List[str],
+    repetition_penalty: float = 1.0,
+) -> str:
+    """Returns the best of the (postprocessed) ``candidates``.
+
+    Each candidate (a prediction, its log-likelihood and its number of tokens) is
+    scored by its log-likelihood per token, less ``repetition_penalty`` if its
+    response is one of the ``previous`` ones (ignoring case and whitespace).
+    Empty responses are only chosen if all of them are.
+    """
+    said = {_normalize(turn) for turn in previous}
+    best, best_score = "", -math.inf
+    for prediction, log_likelihood, num_tokens in candidates:
+        response = postprocess_response(prediction, turn_prefixes)
+        if not response:
+            continue
+        score = log_likelihood / max(num_tokens, 1)
+        if _normalize(response) in said:
+            score -= repetition_penalty
+        if score > best_score:
+            best, best_score = response, score
+    return best
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def _stream_response(pieces: Iterable[str], turn_prefixes: List[str]) -> Iterator[str]:
+    """Yields the response in the ``pieces`` of a prediction as they come.
+
+    Like ``postprocess_response``, but the response ends at the first turn prefix
+    after it (so the rest of the prediction isn't waited for). Whitespace and text
+    that could be the start of a turn prefix are held back until the next pieces
+    show whether they're part of the response.
+    """
+    assert len(turn_prefixes) == 2
+    prediction, sent = "", ""
+    for piece in pieces:
+        prediction += piece
+        response, ended = _split_response(prediction, turn_prefixes)
+        if not ended:
+            response = response[
+                : len(response) - _partial_prefix(response, turn_prefixes)
+            ]
+        response = response.rstrip()
+        if response.startswith(sent) and len(response) > len(sent):
+            yield response[len(sent) :]
+            sent = response
+        if ended:
+            return
+    response = _split_response(prediction, turn_prefixes)[0].rstrip()
+    if response.startswith(sent) and len(response) > len(sent):
+        yield response[len(sent) :]
+
+
+def _split_response(prediction: str, turn_prefixes: List[str]) -> Tuple[str, bool]:
+    """Returns the response a prediction starts with and whether it has ended."""
+    response = prediction.lstrip()
+    if response.startswith(turn_prefixes[1]):  # the model started its own turn
+        response = response[len(turn_prefixes[1]) :].lstrip()
+    ends = [response.find(p) for p in turn_prefixes if p in response]
+    if ends:
+        return response[: min(ends)], True
+    return response, False
+
+
+def _partial_prefix(text: str, turn_prefixes: List[str]) -> int:
+    """Returns the length of the longest start of a turn prefix ``text`` ends with."""
+    return max(
+        (i for p in turn_prefixes for i in range(1, len(p)) if text.endswith(p[:i])),
+        default=0,
+    )
+
+
 if __name__ == "__main__":
     os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # disable tf C++ logging before importing
     from conversational_ai import t5_model
@@ -0,0 +1,393 @@
+"""Materializes tasks as tokenized TFRecords so training doesn't run generators.
+
+Usage: `python3 -m conversational_ai.dataset.cache --help`
+
+The files are written in the same format as ``t5.data.cache_tasks_main`` (without
+needing Apache Beam), so ``t5.data.Task`` reads them with a parallel interleave.
+
+The stats of each split (see ``compute_stats``) are cached too, even if the task
+itself isn't, so mixing rates and train steps can be derived from them cheaply.
+"""
+import functools
+import hashlib
+import json
+import math
+import shutil
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import gin
+import t5
+import tensorflow.compat.v1 as tf
+import tensorflow_datasets as tfds
+
+from conversational_ai.dataset import dedup
+
+DEFAULT_CACHE_DIR = "./data/cache"
+
+
+class CachedTask(t5.data.Task):
+    """A ``t5.data.Task`` that uses its tokenized cache whenever it exists.
+
+    The cache lives in ``{cache_dir}/{name}/{fingerprint}``, where the fingerprint
+    is a hash of the contents of ``source_files`` and of the task's functions and
+    their parameters; a stale cache is therefore never used.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        source_files: Iterable[Union[str, Path]],
+        cache_dir: Union[str, Path] = DEFAULT_CACHE_DIR,
+        **kwargs,
+    ) -> None:
+        """Creates a new CachedTask; see ``t5.data.Task`` for the other args."""
+        super().__init__(name, supports_caching=True, **kwargs)
+        self.source_files = [Path(p) for p in source_files]
+        self.cache_root = Path(cache_dir)
+
+    @property
+    def cache_dir(self) -> Optional[str]:
+        """Returns the cache directory or ``None`` if the task isn't cached."""
+        path = self.cache_path
+        return str(path) if path.joinpath("COMPLETED").exists() else None
+
+    @property
+    def cache_path(self) -> Path:
+        """The directory the task is (or will be) cached in."""
+        return self.cache_root.joinpath(self.name, self.fingerprint)
+
+    @property
+    def fingerprint(self) -> str:
+        """A hash of the source data and everything used to preprocess it."""
+        if not hasattr(self, "_fingerprint"):
+            h = hashlib.sha256()
+            for path in sorted(_iter_files(self.source_files)):
+                h.update(str(path).encode("utf-8"))
+                h.update(_hash_file(path).encode("utf-8"))
+            h.update(_describe(self._dataset_fn).encode("utf-8"))
+            h.update(_describe(self._text_preprocessor).encode("utf-8"))
+            h.update(json.dumps(sorted(self.output_features)).encode("utf-8"))
+            h.update(self.sentencepiece_model_path.encode("utf-8"))
+            if dedup.settings():  # so existing caches stay valid without dedup
+                h.update(json.dumps(dedup.settings(), sort_keys=True).encode("utf-8"))
+            self._fingerprint = h.hexdigest()[:16]
+        return self._fingerprint
+
+    def get_cached_stats(self, split: str = tfds.Split.TRAIN) -> Dict[str, Any]:
+        """Returns the stats of ``split`` (see ``compute_stats``).
+
+        Unlike ``t5.data.Task``, the task doesn't need to be cached; the stats are
+        computed with a single pass through the split the first time they are
+        needed and saved in ``cache_path``.
+        """
+        if self.cache_dir is not None:
+            return super().get_cached_stats(split)
+        if split not in self._stats:
+            path = Path(t5.data.get_stats_path(str(self.cache_path), split))
+            if not path.exists():
+                tf.logging.info("Computing '%s' %s stats", self.name, split)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                _write_json(path, compute_stats(self, split))
+            self._stats[split] = json.loads(path.read_text())
+        return self._stats[split]
+
+    def get_dataset(
+        self,
+        sequence_length: Dict[str, int],
+        split: str = tfds.Split.TRAIN,
+        use_cached: bool = False,
+        shuffle: bool = True,
+        **kwargs,
+    ) -> tf.data.Dataset:
+        """Returns a dataset, from the cache if it exists; see ``t5.data.Task``."""
+        use_cached = use_cached or self.cache_dir is not None
+        return super().get_dataset(
+            sequence_length, split, use_cached=use_cached, shuffle=shuffle, **kwargs
+        )
+
+
+def cache_task(task: CachedTask, num_shards: int = 8, overwrite: bool = False) -> Path:
+    """Writes every split of ``task`` to its cache directory as tokenized shards."""
+    output_dir = task.cache_path
+    if output_dir.joinpath("COMPLETED").exists() and not overwrite:
+        tf.logging.info("'%s' is already cached at %s", task.name, output_dir)
+        return output_dir
+
+    # write to a temporary dir so an interrupted run never looks complete
+    tmp_dir = output_dir.with_name(output_dir.name + ".incomplete")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    for split in task.splits:
+        info, stats = _write_shards(
+            _tokenize(task, split),
+            t5.data.get_tfrecord_prefix(str(tmp_dir), split),
+            num_shards,
+            task.output_features,
+        )
+        _write_json(Path(t5.data.get_info_path(str(tmp_dir), split)), info)
+        _write_json(Path(t5.data.get_stats_path(str(tmp_dir), split)), stats)
+        tf.logging.info(
+            "Cached %d '%s' %s examples", stats["examples"], task.name, split
+        )
+
+    tmp_dir.joinpath("COMPLETED").touch()
+    shutil.rmtree(output_dir, ignore_errors=True)
+    tmp_dir.rename(output_dir)
+    return output_dir
+
+
+def compute_stats(task: t5.data.Task, split: str) -> Dict[str, Any]:
+    """Returns the number of examples and a token length histogram per feature.
+
+    The stats are a superset of the ones ``t5.data.cache_tasks_main`` computes:
+    ``examples``, ``{feature}_tokens`` and ``{feature}_lengths``, which maps the
+    length of the feature (in tokens, without EOS) to the number of examples.
+    """
+    stats = _new_stats(task.output_features)
+    for ex in _tokenize(task, split):
+        _update_stats(stats, ex, task.output_features)
+    return stats
+
+
+def truncation_rate(stats: Dict[str, Any], feature: str, length: int) -> float:
+    """Returns the fraction of examples in which ``feature`` will be truncated."""
+    # T5 appends EOS after truncating the feature to `length - 1` tokens
+    lengths = stats[f"{feature}_lengths"]
+    num_truncated = sum(n for k, n in lengths.items() if int(k) + 1 > length)
+    return num_truncated / stats["examples"] if stats["examples"] else 0.0
+
+
+def num_tokens(
+    stats: Dict[str, Any], feature: str, length: Optional[int] = None
+) -> int:
+    """Returns the number of ``feature`` tokens (with EOS) after truncation."""
+    lengths = stats[f"{feature}_lengths"]
+    max_length = length if length is not None else math.inf
+    return sum(int(min(int(k) + 1, max_length)) * n for k, n in lengths.items())
+
+
+@gin.configurable
+def epoch_train_steps(
+    batch_size: int,
+    sequence_length: Dict[str, int],
+    mixture_or_task_name: str,
+    num_epochs: float = 1.0,
+    packed: bool = True,
+) -> int:
+    """Returns the number of steps to train on each example ``num_epochs`` times.
+
+    Use this like ``mesh_tensorflow.transformer.utils.auto_train_steps``, i.e.
+    ``utils.run.train_steps = @epoch_train_steps``. If the examples are packed,
+    the number of steps is based on the (truncated) number of tokens of the
+    feature that takes the most rows instead of the number of examples.
+    """
+    from conversational_ai import tasks
+
+    tasks.register(mixture_or_task_name)
+    mixture_or_task = t5.data.get_mixture_or_task(mixture_or_task_name)
+    all_stats = [
+        task.get_cached_stats(tfds.Split.TRAIN)
+        for task in t5.data.get_subtasks(mixture_or_task)
+    ]
+    if packed:
+        num_rows = max(
+            sum(num_tokens(stats, k, length) for stats in all_stats) / length
+            for k, length in sequence_length.items()
+        )
+    else:
+        num_rows = sum(stats["examples"] for stats in all_stats)
+    return math.ceil(num_epochs * num_rows / batch_size)
+
+
+def _tokenize(task: t5.data.Task, split: str) -> Iterator[Dict[str, Any]]:
+    """Yields the preprocessed, tokenized examples of a split in order."""
+    ds = task._dataset_fn(split=split, shuffle_files=False)
+    ds = task.preprocess_text(ds)
+    ds = t5.data.encode_string_features(
+        ds, task.get_vocabulary(), keys=task.output_features, copy_plaintext=True
+    )
+    return tfds.as_numpy(ds)
+
+
+def _new_stats(output_features: Iterable[str]) -> Dict[str, Any]:
+    stats: Dict[str, Any] = {"examples": 0}
+    for k in output_features:
+        stats[f"{k}_tokens"] = 0
+        stats[f"{k}_lengths"] = {}
+    return stats
+
+
+def _update_stats(
+    stats: Dict[str, Any], ex: Dict[str, Any], output_features: Iterable[str]
+) -> None:
+    stats["examples"] += 1
+    for k in output_features:
+        length = int(sum(ex[k] > 1)) if k in ex else 0  # like `GetStats` in T5
+        stats[f"{k}_tokens"] += length
+        lengths = stats[f"{k}_lengths"]
+        lengths[str(length)] = lengths.get(str(length), 0) + 1  # str for JSON
+
+
+def _write_shards(
+    examples: Iterable[Dict[str, Any]],
+    prefix: str,
+    num_shards: int,
+    output_features: Iterable[str],
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Writes ``examples`` round-robin to shards and returns their info and stats."""
+    paths = [f"{prefix}-{i:05d}-of-{num_shards:05d}" for i in range(num_shards)]
+    writers = [tf.io.TFRecordWriter(p) for p in paths]
+    info: Dict[str, Any] = {"num_shards": num_shards, "features": {}}
+    stats = _new_stats(output_features)
+    try:
+        for i, ex in enumerate(examples):
+            writers[i % num_shards].write(
+                t5.data.dict_to_tfexample(ex).SerializeToString()
+            )
+            _update_stats(stats, ex, output_features)
+            if not info["features"]:
+                info["features"] = {k: _feature_info(v) for k, v in ex.items()}
+    finally:
+        for writer in writers:
+            writer.close()
+    return info, stats
+
+
+def _write_json(path: Path, obj: Any) -> None:
+    path.write_text(json.dumps(obj, sort_keys=True, indent=2))
+
+
+def _feature_info(value: Any) -> Dict[str, Any]:
+    """Returns the info ``t5.data.Task`` needs to parse a feature (like ``GetInfo``)."""
+    t = tf.constant(value)
+    # the tf.Example proto stores int32 as int64
+    dtype = "int64" if t.dtype.name == "int32" else t.dtype.name
+    return {"shape": [None] * len(t.shape), "dtype": dtype}
+
+
+def _iter_files(paths: Iterable[Path]) -> Iterable[Path]:
+    for path in paths:
+        if path.is_dir():
+            yield from (p for p in path.rglob("*") if p.is_file())
+        elif path.exists():
+            yield path
+
+
+@functools.lru_cache(maxsize=None)
+def _hash_file(path: Path, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _describe(obj: Any) -> str:
+    """Returns a string that changes when a (partial) function or its args do."""
+    if isinstance(obj, functools.partial):
+        args = [_describe(a) for a in obj.args]
+        kwargs = {k: _describe(v) for k, v in sorted(obj.keywords.items())}
+        return f"partial({_describe(obj.func)}, {args}, {kwargs})"
+    if isinstance(obj, (list, tuple)):
+        return repr([_describe(o) for o in obj])
+    if callable(obj) and hasattr(obj, "__code__"):
+        code = hashlib.sha256(obj.__code__.co_code).hexdigest()[:16]
+        return f"{obj.__module__}.{obj.__qualname__}:{code}"
+    if callable(obj) and hasattr(obj, "__qualname__"):
+        return f"{obj.__module__}.{obj.__qualname__}"
+    return repr(obj)
+
+
+def _parse_args() -> Any:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--task",
+        action="append",
+        help="the name of a task to cache (default: all cachable tasks)",
+        metavar="NAME",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help=f"the directory to cache tasks in (default: {DEFAULT_CACHE_DIR})",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--num_shards", type=int, default=8, help="the number of shards per split"
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true", help="overwrite existing caches"
+    )
+    parser.add_argument(
+        "--stats_only",
+        action="store_true",
+        help="only compute (or load) the stats of each split and print them",
+    )
+    parser.add_argument(
+        "--sequence_length",
+        type=json.loads,
+        help='report truncation rates at e.g. \'{"inputs": 256, "targets": 32}\'',
+        metavar="JSON",
+    )
+    return parser.parse_args()
+
+
+def main(
+    tasks: Optional[List[str]] = None,
+    cache_dir: Optional[Union[str, Path]] = None,
+    stats_only: bool = False,
+    sequence_length: Optional[Dict[str, int]] = None,
+    **kwargs,
+) -> None:
+    """Caches all (or just the given) of our ``CachedTask`` tasks."""
+    import conversational_ai.tasks
+
+    if tasks:
+        for name in tasks:
+            conversational_ai.tasks.register(name)
+    else:
+        conversational_ai.tasks.register_all()
+
+    for name in tasks or t5.data.TaskRegistry.names():
+        task = t5.data.TaskRegistry.get(name)
+        if not isinstance(task, CachedTask):
+            continue
+        if cache_dir is not None:
+            task.cache_root = Path(cache_dir)
+        if stats_only:
+            print(json.dumps(_summarize(task, sequence_length), indent=2))
+        else:
+            print(cache_task(task, **kwargs))
+
+
+def _summarize(
+    task: CachedTask, sequence_length: Optional[Dict[str, int]]
+) -> Dict[str, Any]:
+    summary: Dict[str, Any] = {}
+    for split in task.splits:
+        stats = task.get_cached_stats(split)
+        summary[split] = {"examples": stats["examples"]}
+        for k in task.output_features:
+            summary[split][f"{k}_tokens"] = stats[f"{k}_tokens"]
+            if sequence_length and k in sequence_length:
+                rate = truncation_rate(stats, k, sequence_length[k])
+                summary[split][f"{k}_truncation_rate"] = rate
+    return {task.name: summary}
+
+
+if __name__ == "__main__":
+    _args = _parse_args()
+    tf.logging.set_verbosity(tf.logging.INFO)
+    main(
+        tasks=_args.task,
+        cache_dir=_args.cache_dir,
+        num_shards=_args.num_shards,
+        overwrite=_args.overwrite,
+        stats_only=_args.stats_only,
+        sequence_length=_args.sequence_length,
+    )
@@ -1,36 +1,129 @@
 """Dataset utilities for the ChitChat Challenge dataset."""
-from typing import Callable, Dict, Iterable, Iterator
+import functools
+import hashlib
+import json
+import logging
+import random
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Union
 
 import chitchat_dataset as ccc
-import tensorflow.compat.v1 as tf
 
-from conversational_ai.dataset import utils
+from conversational_ai.dataset import dedup, utils
 
+# where `ccc.ConversationDataset` etc. load the dataset from by default
+DATA_PATH = Path(ccc.__file__).with_name("dataset.json")
 
-def generate_compounding_conversations(**kwargs) -> Iterable[Dict[str, str]]:
-    """Yields examples from `ccc.CompoundingConversationDataset`."""
+# about the 216 of 7168 conversations that used to be held out with `take`/`skip`
+VALIDATION_FRACTION = 0.03
+
+
+def split_of(convo_id: str, validation_fraction: float = VALIDATION_FRACTION) -> str:
+    """Returns the split a conversation is in by hashing its ID.
+
+    The split of a conversation never changes, even if conversations are added to
+    or removed from the dataset.
+    """
+    digest = hashlib.sha256(convo_id.encode("utf-8")).digest()
+    bucket = int.from_bytes(digest[:8], "big") / 2 ** 64
+    return "validation" if bucket < validation_fraction else "train"
+
+
+def load_conversations(
+    split: str,
+    shuffle: bool = False,
+    validation_fraction: float = VALIDATION_FRACTION,
+    end_of_utterance_token: str = " ",
+    path: Union[str, Path] = DATA_PATH,
+    seed: Optional[int] = None,
+    shard_index: int = 0,
+    num_shards: int = 1,
+    dedup_params: Optional[Dict[str, Any]] = None,
+) -> Iterator[List[str]]:
+    """Yields the conversations in ``split``, in a random order if ``shuffle``.
+
+    The conversations are shuffled with ``seed``. Near-duplicates are dropped first
+    if ``dedup.drop_near_duplicate_conversations`` is configured (or with
+    ``dedup_params`` instead of the gin config, if given). Only every
+    ``num_shards``th conversation is yielded, starting at ``shard_index``.
+    """
+    data = json.loads(Path(path).read_text())
+    convos = [
+        [end_of_utterance_token.join(u["text"] for u in m) for m in convo["messages"]]
+        for convo_id, convo in data.items()
+        if split_of(convo_id, validation_fraction) == split
+    ]
+    convos = list(
+        dedup.drop_near_duplicate_conversations(
+            convos,
+            name=f"{Path(path).parent.name}_{split}",
+            log=logging.getLogger("tensorflow").info,
+            **(dedup_params or {}),
+        )
+    )
+    if shuffle:
+        random.Random(seed).shuffle(convos)
+    yield from convos[shard_index::num_shards]
+
+
+def generate_compounding_conversations(
+    convos: Iterable[List[str]], **kwargs
+) -> Iterable[Dict[str, str]]:
+    """Yields compounding examples (see ``utils.compound_conversation``)."""
     kwargs.setdefault("prefix", "prefix: ")
-    for inputs, targets in ccc.CompoundingConversationDataset(**kwargs):
-        yield {"inputs": inputs, "targets": targets}
+    kwargs.setdefault("first_speaker_token", "<speaker1>")
+    kwargs.setdefault("second_speaker_token", "<speaker2>")
+    for convo in convos:
+        for inputs, targets in utils.compound_conversation(convo=convo, **kwargs):
+            yield {"inputs": inputs, "targets": targets}
 
 
-def generate_conversations_as_str(**kwargs) -> Iterable[Dict[str, str]]:
-    """Yields examples from ``ccc.ConversationDataset()`` as strings."""
-    for convo in ccc.ConversationDataset():
+def generate_conversations_as_str(
+    convos: Iterable[List[str]], **kwargs
+) -> Iterable[Dict[str, str]]:
+    """Yields the conversations as strings."""
+    for convo in convos:
         yield {"text": utils.convo_as_str(convo=convo, **kwargs)}
 
 
 def dataset(
     split: str,
     shuffle_files: bool,
-    generator: Callable[[], Iterable[Dict[str, str]]],
+    generator: Callable[..., Iterable[Dict[str, str]]],
     keys: Iterator[str],
-    num_train: int,
-) -> tf.data.Dataset:
-    """Creates a ``tf.data.Dataset``."""
-    dataset = tf.data.Dataset.from_generator(
-        generator,
+    validation_fraction: float = VALIDATION_FRACTION,
+    end_of_utterance_token: str = " ",
+    seed: Optional[int] = None,
+) -> Any:
+    """Creates a ``tf.data.Dataset``.
+
+    Conversations are assigned to splits with ``split_of``, so each split only
+    generates its own conversations and examples from a conversation never end up
+    in more than one split. ``shuffle_files`` shuffles the order of conversations
+    with ``seed`` (a random one by default, the same for every worker of
+    ``utils.generate_in_parallel``, which generates the examples). The examples are
+    then passed through ``dedup.drop_near_duplicate_examples``.
+    """
+    import tensorflow.compat.v1 as tf
+
+    def generate() -> Iterator[Dict[str, str]]:
+        dedup_params = dedup.bound_parameters("drop_near_duplicate_conversations")
+        load = functools.partial(
+            load_conversations,
+            split,
+            shuffle_files,
+            validation_fraction,
+            end_of_utterance_token,
+            seed=random.randrange(2 ** 32) if seed is None else seed,
+            dedup_params=dedup_params,
+        )
+        examples = utils.generate_in_parallel(
+            generator, load, load_first=dedup_params.get("threshold") is not None
+        )
+        return dedup.drop_near_duplicate_examples(examples, log=tf.logging.info)
+
+    return tf.data.Dataset.from_generator(
+        generate,
         output_types={k: tf.string for k in keys},
         output_shapes={k: tf.TensorShape([]) for k in keys},
     )
-    return dataset.take(num_train) if split == "train" else dataset.skip(num_train)
@@ -0,0 +1,287 @@
+"""Dropping near-duplicate conversations and examples with MinHash and LSH.
+
+ChitChat, DailyDialog and ConvAI2 have many near-identical conversations (and
+boilerplate openings), which the compounding tasks then expand into many near-
+identical examples. ``MinHashIndex`` estimates the Jaccard similarity of the
+character shingles of texts with MinHash signatures and only compares a text to
+the ones that share a band of its signature (locality-sensitive hashing), so
+finding the near-duplicates of a text doesn't get slower with more texts.
+
+Both ``drop_near_duplicate_conversations`` (used by the ``dataset`` functions when
+they load the conversations, once, before they are sharded between workers) and
+``drop_near_duplicate_examples`` (e.g. input/target pairs) are disabled until their
+``threshold`` is set in gin.
+"""
+import hashlib
+import os
+import zlib
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import gin
+import numpy as np
+
+_PRIME = (1 << 61) - 1  # (a * hash + b) % _PRIME fits in 64 bits for 32 bit hashes
+
+
+class MinHashIndex:
+    """Finds near-duplicates of texts (or tuples of texts, e.g. examples).
+
+    Two tuples of texts are near-duplicates if the estimated Jaccard similarity of
+    the shingles (character n-grams) of each of their texts is at least
+    ``threshold``.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        num_perm: int = 128,
+        shingle_size: int = 5,
+        seed: int = 1,
+    ) -> None:
+        """Creates a new (empty) index."""
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, _PRIME, size=num_perm, dtype=np.int64).astype(
+            np.uint64
+        )
+        self.bands, self.rows = _lsh_parameters(threshold, num_perm)
+        self.keys: List[str] = []
+        self._signatures: List[np.ndarray] = []
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(self.bands)]
+
+    def signature(self, *texts: str) -> np.ndarray:
+        """Returns the MinHash signatures of ``texts`` (one row per text)."""
+        return np.stack([self._minhash(text) for text in texts])
+
+    def query(self, signature: np.ndarray) -> Optional[str]:
+        """Returns the key of a near-duplicate of ``signature`` in the index."""
+        checked = set()
+        for bucket, band in zip(self._buckets, self._bands(signature)):
+            for i in bucket.get(band, []):
+                if i in checked:
+                    continue
+                checked.add(i)
+                similarity = (self._signatures[i] == signature).mean(axis=1)
+                if similarity.min() >= self.threshold:
+                    return self.keys[i]
+        return None
+
+    def add(self, key: str, signature: np.ndarray) -> None:
+        """Adds ``signature`` to the index as ``key``."""
+        for bucket, band in zip(self._buckets, self._bands(signature)):
+            bucket.setdefault(band, []).append(len(self.keys))
+        self.keys.append(key)
+        self._signatures.append(signature)
+
+    def _minhash(self, text: str) -> np.ndarray:
+        hashes = np.array(
+            [zlib.crc32(s.encode("utf-8")) for s in _shingles(text, self.shingle_size)],
+            dtype=np.uint64,
+        )
+        return ((hashes[:, np.newaxis] * self._a + self._b) % _PRIME).min(axis=0)
+
+    def _bands(self, signature: np.ndarray) -> List[bytes]:
+        return [
+            signature[:, i * self.rows : (i + 1) * self.rows].tobytes()
+            for i in range(self.bands)
+        ]
+
+
+class DedupStats:
+    """Counts the examples (and their whitespace-separated tokens) that are dropped."""
+
+    def __init__(self, name: str = "examples") -> None:
+        """Creates new (empty) stats of ``name`` (e.g. ``"conversations"``)."""
+        self.name = name
+        self.examples = self.tokens = 0
+        self.dropped_examples = self.dropped_tokens = 0
+
+    def update(self, text: str, dropped: bool) -> None:
+        """Adds an example with ``text`` that was (or wasn't) ``dropped``."""
+        num_tokens = len(text.split())
+        self.examples += 1
+        self.tokens += num_tokens
+        if dropped:
+            self.dropped_examples += 1
+            self.dropped_tokens += num_tokens
+
+    def __str__(self) -> str:
+        """Returns a one-line summary, e.g. for the logs."""
+        return (
+            f"dropped {self.dropped_examples} of {self.examples} {self.name} "
+            f"({self.dropped_examples / max(self.examples, 1):.1%}) and "
+            f"{self.dropped_tokens} of {self.tokens} tokens "
+            f"({self.dropped_tokens / max(self.tokens, 1):.1%})"
+        )
+
+
+@gin.configurable
+def drop_near_duplicate_conversations(
+    conversations: Iterable[List[str]],
+    name: str,
+    threshold: Optional[float] = None,
+    num_perm: int = 128,
+    shingle_size: int = 5,
+    index_dir: Union[str, Path] = "./data/dedup",
+    log: Optional[Callable[[str], None]] = None,
+) -> Iterable[List[str]]:
+    """Returns the ``conversations`` that aren't near-duplicates of earlier ones.
+
+    Does nothing unless ``threshold`` is set. The signature of every conversation
+    is saved in ``{index_dir}/{name}.npz``, so the index is rebuilt from it instead
+    of hashing the conversations again in later runs. The number of conversations
+    and tokens that were dropped is passed to ``log``.
+    """
+    if threshold is None:
+        return conversations
+
+    index = MinHashIndex(threshold, num_perm, shingle_size)
+    path = Path(index_dir, f"{name}.npz")
+    saved = _load_signatures(path, num_perm, shingle_size)
+    stats = DedupStats("conversations")
+    kept, keys, signatures = [], [], []
+    for convo in conversations:
+        text = "\n".join(turn for turn in convo if turn)
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        signature = saved[key] if key in saved else index.signature(text)
+        keys.append(key)
+        signatures.append(signature)
+        duplicate = index.query(signature)
+        stats.update(text, duplicate is not None)
+        if duplicate is None:
+            index.add(key, signature)
+            kept.append(convo)
+
+    if not set(keys) <= set(saved):
+        _save_signatures(path, keys, signatures, num_perm, shingle_size)
+    if log is not None:
+        log(f"{name}: {stats}")
+    return kept
+
+
+@gin.configurable
+def drop_near_duplicate_examples(
+    examples: Iterable[Dict[str, str]],
+    threshold: Optional[float] = None,
+    num_perm: int = 128,
+    shingle_size: int = 5,
+    max_index_size: Optional[int] = 500_000,
+    log: Optional[Callable[[str], None]] = None,
+) -> Iterator[Dict[str, str]]:
+    """Yields the ``examples`` that aren't near-duplicates of earlier ones.
+
+    Does nothing unless ``threshold`` is set. Examples are only near-duplicates if
+    every feature is (e.g. both ``inputs`` and ``targets``), so the examples that a
+    compounding task makes of one conversation aren't dropped for sharing most of
+    their inputs. Unlike ``drop_near_duplicate_conversations``, the index is only
+    kept in memory; the stats are passed to ``log`` once all examples are seen.
+
+    The index keeps a signature of ``num_perm`` 64 bit ints per feature of every
+    example it keeps, i.e. about 2 KB for inputs and targets with the defaults
+    (and a similar amount for the LSH buckets), so only the first
+    ``max_index_size`` kept examples (``None`` for all) are added to it; later
+    examples are only dropped if they are near-duplicates of those.
+    """
+    if threshold is None:
+        yield from examples
+        return
+
+    index = MinHashIndex(threshold, num_perm, shingle_size)
+    stats = DedupStats("examples")
+    for i, example in enumerate(examples):
+        texts = [example[k] for k in sorted(example)]
+        signature = index.signature(*texts)
+        duplicate = index.query(signature)
+        stats.update(" ".join(texts), duplicate is not None)
+        if duplicate is None:
+            if max_index_size is None or len(index.keys) < max_index_size:
+                index.add(str(i), signature)
+            yield example
+    if log is not None:
+        log(str(stats))
+
+
+def settings() -> Dict[str, Any]:
+    """Returns the parameters of the functions above that change their results."""
+    return {
+        f"{fn}.{name}": value
+        for fn in ["drop_near_duplicate_conversations", "drop_near_duplicate_examples"]
+        for name, value in bound_parameters(fn).items()
+        if name != "index_dir"
+    }
+
+
+def bound_parameters(fn: str) -> Dict[str, Any]:
+    """Returns the parameters of the function ``fn`` above that are bound in gin.
+
+    E.g. to pass them to processes that don't have the gin config.
+    """
+    params = {}
+    for name in [
+        "threshold",
+        "num_perm",
+        "shingle_size",
+        "max_index_size",
+        "index_dir",
+    ]:
+        try:
+            params[name] = gin.query_parameter(f"{fn}.{name}")
+        except ValueError:
+            pass  # not bound so the default is used
+    return params
+
+
+def _shingles(text: str, size: int) -> List[str]:
+    """Returns the character n-grams of ``text`` (lowercased, whitespace collapsed)."""
+    text = " ".join(text.lower().split())
+    return [text[i : i + size] for i in range(max(len(text) - size + 1, 1))]
+
+
+def _lsh_parameters(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """Returns the number of bands and rows per band for ``threshold``.
+
+    Two signatures share at least a band with a probability of ``1 - (1 - s **
+    rows) ** bands`` for a similarity of ``s``, which rises most steeply around
+    ``(1 / bands) ** (1 / rows)``.
+    """
+    return min(
+        ((num_perm // rows, rows) for rows in range(1, num_perm + 1)),
+        key=lambda p: abs((1 / p[0]) ** (1 / p[1]) - threshold),
+    )
+
+
+def _load_signatures(
+    path: Path, num_perm: int, shingle_size: int
+) -> Dict[str, np.ndarray]:
+    """Returns the signatures saved in ``path`` by key (if they're compatible)."""
+    if not path.exists():
+        return {}
+    with np.load(path) as saved:
+        if saved["params"].tolist() != [num_perm, shingle_size]:
+            return {}
+        return dict(zip(saved["keys"].tolist(), saved["signatures"]))
+
+
+def _save_signatures(
+    path: Path,
+    keys: List[str],
+    signatures: List[np.ndarray],
+    num_perm: int,
+    shingle_size: int,
+) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first so an interrupted (or concurrent) run never
+    # leaves a partial one
+    tmp = path.with_name(f".{path.name}.{os.getpid()}")
+    with tmp.open("wb") as f:
+        np.savez(
+            f,
+            keys=np.array(keys),
+            signatures=np.stack(signatures),
+            params=np.array([num_perm, shingle_size]),
+        )
+    tmp.replace(path)
@@ -1,49 +1,107 @@
 """Dataset utilities for generic datasets."""
 import functools
-import json
+import itertools
+import logging
 from pathlib import Path
-from typing import Callable, Dict, Iterable, Iterator, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Union
 
-import chitchat_dataset as ccc
-import tensorflow.compat.v1 as tf
+from conversational_ai.dataset import dedup, utils
 
-from conversational_ai.dataset import utils
 
+def _load_dataset(
+    path: Union[str, Path],
+    end_of_utterance_token: str = " ",
+    shard_index: int = 0,
+    num_shards: int = 1,
+    dedup_params: Optional[Dict[str, Any]] = None,
+) -> Iterable[List[str]]:
+    convos = (
+        _turns(chat.get("dialog", chat.get("dialogue", [])), end_of_utterance_token)
+        for chat in utils.iter_json_objects(path)
+    )
+    # only loads all the conversations at once if dropping near-duplicates
+    convos = dedup.drop_near_duplicate_conversations(
+        convos,
+        name=f"{Path(path).parent.name}_{Path(path).name.split('.')[0]}",
+        log=logging.getLogger("tensorflow").info,
+        **(dedup_params or {}),
+    )
+    return itertools.islice(convos, shard_index, None, num_shards)
+
+
+def _turns(
+    messages: Iterable[Dict[str, Any]], end_of_utterance_token: str
+) -> List[str]:
+    """Returns the turns of a conversation, like ``ccc.MessageDataset`` groups.
 
-def _load_dataset(path: Union[str, Path]) -> Iterable[Iterable]:
-    for chat in json.load(open(path)):
-        dialog = chat.get("dialog", chat.get("dialogue", []))
-        yield (msg.get("text") for msg in dialog)
+    Consecutive messages from the same ``sender`` (if the dataset has senders, like
+    ConvAI2) are joined with ``end_of_utterance_token``.
+    """
+    turns: List[str] = []
+    last_sender = None
+    for msg in messages:
+        sender = msg.get("sender")
+        if turns and sender is not None and sender == last_sender:
+            turns[-1] += end_of_utterance_token + msg.get("text", "")
+        else:
+            turns.append(msg.get("text", ""))
+        last_sender = sender
+    return turns
+
+
+def _find_split(data_dir: Union[str, Path], split: str) -> Path:
+    """Returns the path to ``split`` in ``data_dir`` in any supported format."""
+    for ext in [".json", ".jsonl", ".json.gz", ".jsonl.gz"]:
+        path = Path(data_dir, f"{split}{ext}")
+        if path.exists():
+            return path
+    return Path(data_dir, f"{split}.json")  # so the error mentions the default
 
 
 def generate_compounding_conversations(
-    path: Union[str, Path], **kwargs
+    convos: Iterable[List[str]], **kwargs
 ) -> Iterable[Dict[str, str]]:
-    """Yields examples from the dataset at ``path`` as a ."""
+    """Yields compounding examples (see ``utils.compound_conversation``)."""
     kwargs.setdefault("prefix", "prefix: ")
-    for convo in _load_dataset(path):
-        for inputs, targets in ccc.compound_conversation(convo=convo, **kwargs):
+    for convo in convos:
+        for inputs, targets in utils.compound_conversation(convo=convo, **kwargs):
             yield {"inputs": inputs, "targets": targets}
 
 
 def generate_conversations_as_str(
-    path: Union[str, Path], **kwargs
+    convos: Iterable[List[str]], **kwargs
 ) -> Iterable[Dict[str, str]]:
-    """Yields examples from the dataset at ``path`` as strings."""
-    for convo in _load_dataset(path):
+    """Yields the conversations as strings."""
+    for convo in convos:
         yield {"text": utils.convo_as_str(convo=convo, **kwargs)}
 
 
 def dataset(
     split: str,
     shuffle_files: bool,
-    generator: Callable[[], Iterable[Dict[str, str]]],
+    generator: Callable[..., Iterable[Dict[str, str]]],
     keys: Iterator[str],
     data_dir: Union[str, Path],
-) -> tf.data.Dataset:
-    """Creates a ``tf.data.Dataset``."""
+    end_of_utterance_token: str = " ",
+) -> Any:
+    """Creates a ``tf.data.Dataset`` (see ``utils.generate_in_parallel``)."""
+    import tensorflow.compat.v1 as tf
+
+    def generate() -> Iterator[Dict[str, str]]:
+        dedup_params = dedup.bound_parameters("drop_near_duplicate_conversations")
+        load = functools.partial(
+            _load_dataset,
+            _find_split(data_dir, split),
+            end_of_utterance_token,
+            dedup_params=dedup_params,
+        )
+        examples = utils.generate_in_parallel(
+            generator, load, load_first=dedup_params.get("threshold") is not None
+        )
+        return dedup.drop_near_duplicate_examples(examples, log=tf.logging.info)
+
     return tf.data.Dataset.from_generator(
-        functools.partial(generator, path=f"{data_dir}/{split}.json"),
+        generate,
         output_types={k: tf.string for k in keys},
         output_shapes={k: tf.TensorShape([]) for k in keys},
     )
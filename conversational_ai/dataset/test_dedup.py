@@ -0,0 +1,51 @@
+"""Tests for the ``conversational_ai.dataset.dedup`` module."""
+from pathlib import Path
+from typing import List
+
+from conversational_ai.dataset.dedup import (
+    drop_near_duplicate_conversations,
+    drop_near_duplicate_examples,
+)
+
+
+def test_drop_near_duplicate_conversations(tmp_path: Path) -> None:
+    """Tests that near-duplicates are dropped and the signatures are reused."""
+    convos = [
+        ["Hi! How are you doing today?", "I'm doing great, thanks for asking!"],
+        ["Hi! How are you doing today??", "I'm doing great, thanks for asking!"],
+        ["Do you like pizza?", "Not really, I prefer tacos."],
+        ["Hi! How are you doing today?", "Terrible. My dog ate my homework."],
+    ]
+    logs: List[str] = []
+    kwargs = dict(name="test", threshold=0.8, index_dir=tmp_path, log=logs.append)
+    assert drop_near_duplicate_conversations(convos, **kwargs) == [
+        convos[0],
+        convos[2],
+        convos[3],
+    ]
+    assert logs == [
+        "test: dropped 1 of 4 conversations (25.0%) and 12 of 45 tokens (26.7%)"
+    ]
+
+    path = tmp_path / "test.npz"
+    mtime = path.stat().st_mtime_ns
+    assert len(drop_near_duplicate_conversations(convos, **kwargs)) == 3
+    assert path.stat().st_mtime_ns == mtime  # nothing new to save
+
+    # disabled by default
+    assert drop_near_duplicate_conversations(convos, "test") is convos
+
+
+def test_drop_near_duplicate_examples() -> None:
+    """Tests that examples are only near-duplicates if all features are."""
+    examples = [
+        {"inputs": "speaker1> Hi! How are you doing today?", "targets": "Good!"},
+        {"inputs": "speaker1> Hi! How are you doing today?!", "targets": "Good!"},
+        {"inputs": "speaker1> Hi! How are you doing today?", "targets": "Bad."},
+    ]
+    kept = list(drop_near_duplicate_examples(examples, threshold=0.7))
+    assert kept == [examples[0], examples[2]]
+
+    # the index is full after the first example, so it's the only one compared to
+    kept = list(drop_near_duplicate_examples(examples * 2, 0.7, max_index_size=1))
+    assert kept == [examples[0], examples[2], examples[2]]
@@ -0,0 +1,32 @@
+"""Tests for the ``conversational_ai.dataset.generic`` module."""
+import json
+from pathlib import Path
+
+from conversational_ai.dataset import generic
+
+
+def test_load_dataset(tmp_path: Path) -> None:
+    """Tests that consecutive messages from the same sender are one turn."""
+    path = tmp_path / "validation.json"
+    path.write_text(
+        json.dumps(
+            [
+                {"dialogue": [{"text": "a"}, {"text": "b"}]},
+                {
+                    "dialog": [
+                        {"sender": "p1", "text": "c"},
+                        {"sender": "p1", "text": "d"},
+                        {"sender": "p2", "text": "e"},
+                        {"sender": "p1", "text": "f"},
+                    ]
+                },
+            ]
+        )
+    )
+    assert list(generic._load_dataset(path, end_of_utterance_token=" | ")) == [
+        ["a", "b"],
+        ["c | d", "e", "f"],
+    ]
+    assert list(generic._load_dataset(path, shard_index=1, num_shards=2)) == [
+        ["c d", "e", "f"]
+    ]
@@ -0,0 +1,36 @@
+"""Tests for the ``conversational_ai.dataset.packing`` module."""
+from typing import Dict, List, Sequence
+
+from conversational_ai.dataset.packing import PackingStats, pack
+
+
+def test_pack() -> None:
+    """Tests that ``pack`` fits examples together and keeps track of segments."""
+    sequence_length = {"inputs": 8, "targets": 4}
+    examples: List[Dict[str, Sequence[int]]] = [
+        {"inputs": [3, 3, 3, 3, 3, 1], "targets": [7, 1]},
+        {"inputs": [4, 4, 1], "targets": [7, 1]},
+        {"inputs": [5, 5, 5, 5, 1], "targets": [7, 1]},
+        {"inputs": [6, 1], "targets": [7, 1]},
+    ]
+    rows = pack(examples, sequence_length)
+
+    # packing them in order would take 3 rows
+    assert len(rows) == 2
+    assert rows[0]["inputs"].tolist() == [3, 3, 3, 3, 3, 1, 6, 1]
+    assert rows[0]["inputs_segmentation"].tolist() == [1, 1, 1, 1, 1, 1, 2, 2]
+    assert rows[0]["inputs_position"].tolist() == [0, 1, 2, 3, 4, 5, 0, 1]
+    assert rows[0]["targets"].tolist() == [7, 1, 7, 1]
+    assert rows[0]["targets_segmentation"].tolist() == [1, 1, 2, 2]
+    assert rows[0]["targets_position"].tolist() == [0, 1, 0, 1]
+    assert rows[1]["inputs"].tolist() == [5, 5, 5, 5, 1, 4, 4, 1]
+
+    stats = PackingStats(sequence_length)
+    stats.update(len(examples), rows)
+    assert stats.efficiency() == {"inputs": 1.0, "targets": 1.0}
+    assert "4 examples into 2 rows" in str(stats)
+
+    # too long features are truncated and still end in EOS
+    rows = pack([{"inputs": [2] * 12, "targets": [1]}], sequence_length)
+    assert rows[0]["inputs"].tolist() == [2, 2, 2, 2, 2, 2, 2, 1]
+    assert rows[0]["targets"].tolist() == [1, 0, 0, 0]
@@ -0,0 +1,101 @@
+"""Tests for the ``conversational_ai.dataset.utils`` module."""
+import gzip
+import json
+from pathlib import Path
+from typing import Dict, Iterable, Iterator
+
+import chitchat_dataset as ccc
+import pytest
+
+from conversational_ai.dataset.utils import (
+    compound_conversation,
+    generate_in_parallel,
+    iter_json_objects,
+)
+
+
+def test_iter_json_objects(tmp_path: Path) -> None:
+    """Tests ``iter_json_objects`` with JSON arrays, JSON Lines and gzip."""
+    objects = [
+        {"dialog": [{"text": "Hello! [,] {}"}, {"text": 'Hi "there"'}]},
+        {"dialogue": [{"text": "\U0001f60a " * 10}]},
+        {},
+    ]
+
+    json_path = tmp_path / "split.json"
+    json_path.write_text(json.dumps(objects, indent=2))
+    jsonl_path = tmp_path / "split.jsonl.gz"
+    with gzip.open(jsonl_path, "wt") as f:
+        f.write("\n".join(json.dumps(obj) for obj in objects) + "\n")
+
+    for path in [json_path, jsonl_path]:
+        for chunk_size in [1, 7, 1 << 16]:
+            assert list(iter_json_objects(path, chunk_size=chunk_size)) == objects
+
+
+def test_compound_conversation() -> None:
+    """Tests ``compound_conversation`` against ``ccc.compound_conversation``."""
+    convo = ["a", "bb", "ccc", "dddd", "eeeee"]
+    expected = list(ccc.compound_conversation(convo, "1", "2", prefix="> "))
+    assert list(compound_conversation(convo, "1", "2", prefix="> ")) == expected
+
+    actual = list(compound_conversation(convo, "1", "2", max_input_length=7))
+    assert actual == [
+        ("1a", "2bb"),
+        ("1a2bb", "1ccc"),
+        ("2bb1ccc", "2dddd"),
+        ("2dddd", "1eeeee"),
+    ]
+
+    # e.g. a `TokenCounter`, but with a token per word
+    convo = ["a b", "c", "d e f", "g"]
+    actual = list(
+        compound_conversation(
+            convo, "1 ", "2 ", max_input_length=5, count_tokens=lambda s: len(s.split())
+        )
+    )
+    assert actual == [
+        ("1 a b", "2 c"),
+        ("1 a b2 c", "1 d e f"),
+        ("1 d e f", "2 g"),
+    ]
+
+
+def _numbers(convos: Iterable[int], fail: bool = False) -> Iterator[Dict[str, str]]:
+    for i in convos:
+        if fail and i == 5:
+            raise ValueError("failed")
+        yield {"text": str(i)}
+
+
+def _load_numbers(shard_index: int, num_shards: int) -> Iterable[int]:
+    return range(shard_index, 100, num_shards)
+
+
+def test_generate_in_parallel() -> None:
+    """Tests that ``generate_in_parallel`` merges the shards deterministically."""
+    expected = [str(i) for i in range(100)]
+    serial = list(generate_in_parallel(_numbers, _load_numbers))
+    assert [ex["text"] for ex in serial] == expected
+
+    parallel = list(
+        generate_in_parallel(_numbers, _load_numbers, num_workers=3, chunk_size=2)
+    )
+    assert sorted(ex["text"] for ex in parallel) == sorted(expected)
+    # chunks of 2 examples are taken from each shard in turn
+    assert [ex["text"] for ex in parallel[:8]] == [
+        "0",
+        "3",
+        "1",
+        "4",
+        "2",
+        "5",
+        "6",
+        "9",
+    ]
+    assert parallel == list(
+        generate_in_parallel(_numbers, _load_numbers, num_workers=3, chunk_size=2)
+    )
+
+    with pytest.raises(RuntimeError, match="ValueError: failed"):
+        list(generate_in_parallel(_numbers, _load_numbers, num_workers=2, fail=True))
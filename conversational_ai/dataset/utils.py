@@ -1,7 +1,25 @@
 """Dataset utilities."""
-from typing import Iterable
+import gzip
+import json
+import multiprocessing
+import queue
+import traceback
+from pathlib import Path
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import chitchat_dataset as ccc
+import gin
 
 
 def convo_as_str(
@@ -14,3 +32,218 @@ def convo_as_str(
     """Returns a conversation as a single string."""
     new_convo = turn_suffix.join(ccc.prepend_cycle(convo, turn_prefixes))
     return f"{prefix}{new_convo}{suffix}"
+
+
+def compound_conversation(
+    convo: Iterable[str],
+    first_speaker_token: str,
+    second_speaker_token: str,
+    prefix: str = "",
+    max_input_length: Optional[int] = None,
+    count_tokens: Callable[[str], int] = len,
+) -> Iterator[Tuple[str, str]]:
+    """Yields the same examples as ``ccc.compound_conversation``, but faster.
+
+    The conversation is joined into a single buffer once and each input is sliced
+    out of it using the offsets of the turns, instead of joining every prefix of
+    the conversation again. If ``max_input_length`` is given, the oldest turns are
+    dropped from inputs that are longer than it (in ``count_tokens`` of each turn,
+    e.g. a ``TokenCounter``, or characters by default, excluding ``prefix``), but
+    the most recent turn is always kept.
+    """
+    turns = list(ccc.prepend_cycle(convo, [first_speaker_token, second_speaker_token]))
+    buffer = "".join(turns)
+    offsets = [0]  # offsets[i] is where turns[i] starts in the buffer
+    for turn in turns:
+        offsets.append(offsets[-1] + len(turn))
+
+    start = 0  # the first turn in the input, which only ever moves forward
+    length = 0  # the number of tokens in turns[start:i]
+    for i in range(1, len(turns)):
+        if max_input_length is not None:
+            length += count_tokens(turns[i - 1])
+            while start < i - 1 and length > max_input_length:
+                length -= count_tokens(turns[start])
+                start += 1
+        yield prefix + buffer[offsets[start] : offsets[i]], turns[i]
+
+
+class TokenCounter:
+    """Counts the SentencePiece tokens in a string, e.g. for ``max_input_length``.
+
+    The model is only loaded when it's first used (in each process), so counters
+    can be pickled, e.g. for ``generate_in_parallel``.
+    """
+
+    def __init__(self, sentencepiece_model_path: Union[str, Path]) -> None:
+        """Creates a counter for the model at ``sentencepiece_model_path``."""
+        self.sentencepiece_model_path = str(sentencepiece_model_path)
+        self._processor: Any = None
+
+    def __call__(self, text: str) -> int:
+        """Returns the number of tokens in ``text``."""
+        if self._processor is None:
+            import sentencepiece as spm
+
+            self._processor = spm.SentencePieceProcessor()
+            self._processor.LoadFromSerializedProto(self._read_model())
+        return len(self._processor.EncodeAsIds(text))
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Returns the state to pickle, without the loaded model."""
+        return {**self.__dict__, "_processor": None}
+
+    def __repr__(self) -> str:
+        """Returns a representation that's the same in every process."""
+        return f"{type(self).__name__}({self.sentencepiece_model_path!r})"
+
+    def _read_model(self) -> bytes:
+        if "://" not in self.sentencepiece_model_path:
+            return Path(self.sentencepiece_model_path).read_bytes()
+        import tensorflow.compat.v1 as tf  # e.g. for `gs://` paths
+
+        with tf.io.gfile.GFile(self.sentencepiece_model_path, "rb") as f:
+            return f.read()
+
+
+def open_text(path: Union[str, Path]) -> IO[str]:
+    """Opens a (possibly gzip compressed) text file for reading."""
+    if str(path).endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def iter_json_objects(
+    path: Union[str, Path], chunk_size: int = 1 << 16
+) -> Iterator[Dict[str, Any]]:
+    """Yields the objects in a JSON array or JSON Lines file one at a time.
+
+    Unlike ``json.load``, only one object is held in memory at a time, so this can
+    be used for files that are larger than memory. Files ending in ``.gz`` are
+    decompressed on the fly.
+    """
+    decoder = json.JSONDecoder()
+    with open_text(path) as f:
+        buf, pos, eof = "", 0, False
+        while True:
+            # skip the separators between objects (and the enclosing array)
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] in "[,]"):
+                pos += 1
+            if pos == len(buf):
+                if eof:
+                    return
+                buf, pos = f.read(chunk_size), 0
+                eof = not buf
+                continue
+
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                chunk = f.read(max(chunk_size, len(buf) - pos))  # amortize retries
+                if not chunk:
+                    raise
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+
+            yield obj
+            pos = end
+
+
+@gin.configurable
+def generate_in_parallel(
+    generator: Callable[..., Iterable[Dict[str, str]]],
+    load: Callable[..., Iterable[Any]],
+    num_workers: int = 1,
+    chunk_size: int = 256,
+    load_first: bool = False,
+    **kwargs,
+) -> Iterator[Dict[str, str]]:
+    """Yields the examples of ``generator``, generated by ``num_workers`` processes.
+
+    Worker ``i`` yields the examples of ``generator(load(shard_index=i,
+    num_shards=num_workers), **kwargs)``, where ``load`` reads (e.g. streams) the
+    conversations itself and only yields every ``num_workers``th one, so they're
+    never all held in this process. The workers are spawned, so ``generator``,
+    ``load`` and ``kwargs`` must be picklable and can't rely on the gin config. If
+    ``load_first``, all of ``load()`` is read once in this process before the
+    workers are started, e.g. so they read the dedup signatures that it saves
+    instead of each computing them.
+
+    Chunks of ``chunk_size`` examples are taken from the workers in turn, so the
+    order of the examples only depends on the order each shard is generated in
+    (not on how fast the workers are), and is the same every time for the same
+    ``num_workers`` and ``chunk_size``.
+    """
+    if num_workers <= 1:
+        yield from generator(load(shard_index=0, num_shards=1), **kwargs)
+        return
+
+    if load_first:
+        for _ in load(shard_index=0, num_shards=1):
+            pass
+    # spawn instead of forking a process that has TensorFlow and its threads loaded
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=4) for _ in range(num_workers)]
+    workers = [
+        context.Process(
+            target=_generate_shard,
+            args=(generator, load, kwargs, i, num_workers, chunk_size, queues[i]),
+            daemon=True,
+        )
+        for i in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        active = list(range(num_workers))
+        while active:
+            for i in list(active):
+                chunk = _get_chunk(queues[i], workers[i])
+                if chunk is None:
+                    active.remove(i)
+                yield from chunk or []
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+
+def _generate_shard(
+    generator: Callable[..., Iterable[Dict[str, str]]],
+    load: Callable[..., Iterable[Any]],
+    kwargs: Dict[str, Any],
+    shard_index: int,
+    num_shards: int,
+    chunk_size: int,
+    chunks: Any,
+) -> None:
+    """Puts chunks of the examples of a shard in ``chunks``, then ``None``."""
+    try:
+        chunk: List[Dict[str, str]] = []
+        convos = load(shard_index=shard_index, num_shards=num_shards)
+        for example in generator(convos, **kwargs):
+            chunk.append(example)
+            if len(chunk) == chunk_size:
+                chunks.put(chunk)
+                chunk = []
+        if chunk:
+            chunks.put(chunk)
+        chunks.put(None)
+    except Exception:
+        chunks.put(traceback.format_exc())
+
+
+def _get_chunk(chunks: Any, worker: Any) -> Optional[List[Dict[str, str]]]:
+    """Returns the next chunk of ``worker`` (``None`` once it is done)."""
+    while True:
+        try:
+            chunk = chunks.get(timeout=1.0)
+            break
+        except queue.Empty:
+            if not worker.is_alive() and chunks.empty():
+                raise RuntimeError(
+                    f"{worker.name} exited with code {worker.exitcode}"
+                ) from None
+    if isinstance(chunk, str):  # the traceback of an exception in the worker
+        raise RuntimeError(f"{worker.name} failed:\n{chunk}")
+    return chunk
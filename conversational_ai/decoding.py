@@ -0,0 +1,364 @@
+"""Decoding that stops each sequence at the next speaker prefix.
+
+Models trained to continue conversations (e.g. ``chitchat_v003_prefix_lm``) keep
+generating the next speaker's turn after their own, which ``postprocess_response``
+throws away. ``use_stop_sequences`` makes ``Unitransformer.sample_autoregressive``
+(used by both language models and ``Bitransformer.decode`` without beam search)
+end a sequence as soon as it emits one of the given token sequences, and stop
+decoding altogether once every sequence in the batch has ended.
+
+``emit_tokens`` also makes it pass the ids sampled at each step (and their
+log-probabilities) to the callbacks given to ``on_tokens`` while the graph runs, so
+responses can be streamed (see ``Predictor.stream``) and scored (see
+``Predictor.sample``) without decoding them again.
+"""
+import contextlib
+import functools
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+import gin
+import mesh_tensorflow as mtf
+import numpy as np
+import tensorflow.compat.v1 as tf
+from mesh_tensorflow.transformer import transformer
+
+_STOP_SEQUENCES: List[List[int]] = []
+_TOKEN_CALLBACKS: List[Callable[[np.ndarray, np.ndarray], None]] = []
+_emit_tokens = False
+_BUILDING = threading.local()  # the `token_gate` of the graphs built in a thread
+_SAMPLE_AUTOREGRESSIVE = transformer.Unitransformer.sample_autoregressive
+
+
+def use_stop_sequences(stop_sequences: Sequence[Sequence[int]]) -> None:
+    """Stops decoding a sequence at any of ``stop_sequences`` (and EOS).
+
+    A stop sequence only counts after at least one other generated token, since
+    models often open their response with their own turn prefix. Only affects
+    graphs built afterwards; an empty list restores the default.
+    """
+    _STOP_SEQUENCES[:] = [list(s) for s in stop_sequences if s]
+    # HACK: `utils.build_model` hardcodes the model classes, so we can't subclass
+    transformer.Unitransformer.sample_autoregressive = _sample_autoregressive
+
+
+def stop_sequences() -> List[List[int]]:
+    """Returns the stop sequences given to ``use_stop_sequences`` (if any)."""
+    return [list(s) for s in _STOP_SEQUENCES]
+
+
+def emit_tokens() -> None:
+    """Makes decoding pass each step to the ``on_tokens`` callbacks.
+
+    Only affects graphs built afterwards, and not beam search. The ids are passed
+    per slice of the batch, so callbacks only see the whole batch (and can tell
+    which sequence each id belongs to) if it isn't split over devices.
+    """
+    global _emit_tokens
+    _emit_tokens = True
+    # HACK: `utils.build_model` hardcodes the model classes, so we can't subclass
+    transformer.Unitransformer.sample_autoregressive = _sample_autoregressive
+
+
+@contextlib.contextmanager
+def on_tokens(
+    callback: Optional[Callable[[np.ndarray, np.ndarray], None]]
+) -> Iterator[None]:
+    """Calls ``callback`` with the ids sampled at each step in the ``with`` block.
+
+    ``callback`` gets one id per sequence in the batch (0 once a sequence has
+    ended) and the log-probability of each id under the model (i.e. without the
+    temperature or top-k of sampling). It is called from a TensorFlow thread and
+    only if the graph was built after ``emit_tokens``. ``None`` doesn't add one.
+    """
+    if callback is None:
+        yield
+        return
+    _TOKEN_CALLBACKS.append(callback)
+    try:
+        yield
+    finally:
+        _TOKEN_CALLBACKS.remove(callback)
+
+
+@contextlib.contextmanager
+def token_gate(is_open: Callable[[], bool]) -> Iterator[None]:
+    """Only passes the ids of graphs built in the ``with`` block on if ``is_open()``.
+
+    The ``on_tokens`` callbacks are global, so this keeps a graph that runs next to
+    another one (e.g. while a reloaded checkpoint is warmed up) from passing its
+    ids to the callbacks of the other one's decoding.
+    """
+    previous = getattr(_BUILDING, "gate", None)
+    _BUILDING.gate = is_open
+    try:
+        yield
+    finally:
+        _BUILDING.gate = previous
+
+
+def encode_stop_sequences(
+    vocabulary: Any, stop_strings: Sequence[str]
+) -> List[List[int]]:
+    """Returns the token ids of each of ``stop_strings`` (e.g. turn prefixes)."""
+    return [vocabulary.encode(s.strip()) for s in stop_strings if s.strip()]
+
+
+def _sample_autoregressive(
+    self: transformer.Unitransformer, partial_sequences: mtf.Tensor, **kwargs: Any
+) -> mtf.Tensor:
+    if not (_STOP_SEQUENCES or _emit_tokens) or not self.autoregressive:
+        return _SAMPLE_AUTOREGRESSIVE(self, partial_sequences, **kwargs)
+    # replacing the method loses the gin bindings of the original, so apply them
+    return _sample_with_stop_sequences(
+        self, partial_sequences, **{**_bound_parameters(), **kwargs}
+    )
+
+
+def _bound_parameters() -> Dict[str, Any]:
+    """Returns the ``Unitransformer.sample_autoregressive`` params bound in gin."""
+    params = {}
+    for name in [
+        "stop_at_token",
+        "max_steps",
+        "temperature",
+        "never_end",
+        "sampling_keep_top_k",
+        "bos_id",
+    ]:
+        try:
+            params[name] = gin.query_parameter(
+                f"Unitransformer.sample_autoregressive.{name}"
+            )
+        except ValueError:
+            pass  # not bound so the default is used
+    return params
+
+
+def _sample_with_stop_sequences(
+    self: transformer.Unitransformer,
+    partial_sequences: mtf.Tensor,
+    stop_at_token: Optional[int] = 1,
+    max_steps: Optional[int] = None,
+    temperature: float = 0.0,
+    variable_dtype: mtf.VariableDType = mtf.VariableDType(tf.float32),  # noqa: B008
+    encoder_output: Optional[mtf.Tensor] = None,
+    encoder_sequence_id: Optional[mtf.Tensor] = None,
+    encoder_inputs: Optional[mtf.Tensor] = None,
+    shared_params: Optional[Dict[str, Any]] = None,
+    has_partial_sequences: bool = True,
+    encoder_layer_outputs: Optional[List[mtf.Tensor]] = None,
+    never_end: bool = False,
+    remove_partial_sequences: bool = False,
+    sampling_keep_top_k: int = -1,
+    bos_id: int = 0,
+) -> mtf.Tensor:
+    """``Unitransformer.sample_autoregressive`` that also stops at stop sequences.
+
+    Unlike the original, which keeps sampling for finished sequences until every
+    sequence is finished, a finished sequence only gets padding after its EOS or
+    stop sequence, so its output ends there. After ``emit_tokens``, the ids of each
+    step are also passed to the ``on_tokens`` callbacks.
+    """
+    inputs = partial_sequences
+    batch_dims = inputs.shape.dims[:-1]
+    length_dim = inputs.shape.dims[-1]
+    initial_position = mtf.reduce_sum(
+        mtf.to_int32(mtf.not_equal(inputs, 0)), reduced_dim=length_dim
+    )
+    sequence_id = 1 if encoder_sequence_id is not None else None
+
+    length_range = mtf.range(inputs.mesh, length_dim, tf.int32)
+    if self.input_full_attention:
+        read_priority = write_priority = length_range * mtf.to_int32(
+            mtf.greater(length_range, initial_position)
+        )
+    else:
+        read_priority = write_priority = length_range
+
+    context_kwargs = dict(
+        model=self,
+        mesh=inputs.mesh,
+        batch_dims=batch_dims,
+        length_dim=length_dim,
+        variable_dtype=variable_dtype,
+        sequence_id=sequence_id,
+        encoder_output=encoder_output,
+        encoder_sequence_id=encoder_sequence_id,
+        shared_params=shared_params,
+        encoder_layer_outputs=encoder_layer_outputs,
+        write_priority=write_priority,
+        encoder_inputs=encoder_inputs,
+    )
+    context_first_part = transformer.Context(
+        mode="first_part",
+        new_states=[],
+        position=length_range,
+        position_is_default=True,
+        initial_position=initial_position,
+        constant_states=[],
+        read_priority=read_priority,
+        inputs=inputs,
+        **context_kwargs,
+    )
+    shifted_inputs = mtf.shift(inputs, offset=1, dim=length_dim, wrap=False)
+    with tf.variable_scope(self.name):
+        self._call_internal(context_first_part, shifted_inputs)
+    constant_states = context_first_part.constant_states
+    if has_partial_sequences:
+        initial_states = context_first_part.new_states
+    else:
+        initial_states = [mtf.zeros_like(t) for t in context_first_part.new_states]
+
+    def cond_fn(
+        position: mtf.Tensor, ids: mtf.Tensor, done: mtf.Tensor, *unused_states: Any
+    ) -> mtf.Tensor:
+        """Should we run another loop iteration."""
+        is_done = mtf.logical_or(
+            mtf.greater_equal(position, length_dim.size), mtf.greater(done, 0)
+        )
+        if max_steps:
+            is_done = mtf.logical_or(
+                is_done, mtf.greater_equal(position - initial_position, max_steps)
+            )
+        return mtf.logical_not(mtf.reduce_all(is_done))
+
+    def body_fn(
+        position: mtf.Tensor, ids: mtf.Tensor, done: mtf.Tensor, *states: Any
+    ) -> List[mtf.Tensor]:
+        """One step in the decode loop."""
+        inputs_this_step = mtf.gather(ids, position - 1, length_dim)
+        # Setting proper bos_id for position == 0. No-op otherwise.
+        if bos_id:
+            inputs_this_step += (
+                bos_id
+                * mtf.ones_like(inputs_this_step)
+                * mtf.cast(mtf.equal(position, 0), tf.int32)
+            )
+        context_incremental = transformer.Context(
+            mode="incremental",
+            new_states=[],
+            position=position,
+            states=states,
+            constant_states=constant_states,
+            read_priority=position,
+            inputs=inputs_this_step,
+            **context_kwargs,
+        )
+        with tf.variable_scope(self.name, reuse=True):
+            logits = self._call_internal(context_incremental, inputs_this_step)
+        model_logits = logits
+        logits = _mask_logits(
+            logits, self.output_vocab_dim, stop_at_token, never_end, sampling_keep_top_k
+        )
+
+        ids_this_step = mtf.sample_with_temperature(
+            logits, self.output_vocab_dim, temperature
+        )
+        # pad the sequences that have already ended
+        ids_this_step *= mtf.to_int32(mtf.equal(done, 0))
+        if _emit_tokens:
+            log_probs = mtf.reduce_sum(
+                mtf.log_softmax(mtf.to_float(model_logits), self.output_vocab_dim)
+                * mtf.one_hot(ids_this_step, self.output_vocab_dim),
+                reduced_dim=self.output_vocab_dim,
+            )
+            ids_this_step = mtf.slicewise(
+                functools.partial(
+                    _call_token_callbacks, gate=getattr(_BUILDING, "gate", None)
+                ),
+                [ids_this_step, log_probs],
+                output_shape=ids_this_step.shape,
+                output_dtype=ids_this_step.dtype,
+                splittable_dims=ids_this_step.shape.dims,
+            )
+        new_ids = ids + ids_this_step * mtf.one_hot(
+            position, length_dim, dtype=tf.int32
+        )
+        stopped = _has_stopped(new_ids, position, initial_position, stop_at_token)
+        new_done = mtf.maximum(done, stopped)
+        return [position + 1, new_ids, new_done] + context_incremental.new_states
+
+    done = mtf.zeros_like(initial_position)
+    while_loop_inputs = [initial_position, inputs, done] + initial_states
+    outputs = mtf.while_loop(cond_fn, body_fn, while_loop_inputs)[1]
+    if has_partial_sequences and remove_partial_sequences:
+        # remove partial sequences from outputs
+        partial_length = mtf.reduce_sum(
+            mtf.to_int32(mtf.not_equal(partial_sequences, 0)), reduced_dim=length_dim
+        )
+        outputs = mtf.dynamic_shift(outputs, -partial_length, length_dim, wrap=False)
+    return outputs
+
+
+def _call_token_callbacks(
+    ids: tf.Tensor, log_probs: tf.Tensor, gate: Optional[Callable[[], bool]] = None
+) -> tf.Tensor:
+    """Returns ``ids`` after passing them to the ``on_tokens`` callbacks."""
+
+    def call(ids: np.ndarray, log_probs: np.ndarray) -> np.ndarray:
+        if gate is not None and not gate():
+            return ids
+        for callback in list(_TOKEN_CALLBACKS):
+            callback(ids, log_probs)
+        return ids
+
+    # the (identity) output is used, so the callbacks run at every step
+    outputs = tf.numpy_function(
+        call, [ids, log_probs], ids.dtype, name="call_token_callbacks"
+    )
+    outputs.set_shape(ids.shape)
+    return outputs
+
+
+def _mask_logits(
+    logits: mtf.Tensor,
+    vocab_dim: mtf.Dimension,
+    stop_at_token: Optional[int],
+    never_end: bool,
+    sampling_keep_top_k: int,
+) -> mtf.Tensor:
+    """Masks the logits like ``Unitransformer.sample_autoregressive`` does."""
+    if never_end:
+        logits += mtf.one_hot(
+            mtf.constant(logits.mesh, stop_at_token, dtype=tf.int32),
+            vocab_dim,
+            on_value=-1e9,
+            off_value=0.0,
+            dtype=logits.dtype,
+        )
+    if sampling_keep_top_k != -1:
+        if sampling_keep_top_k <= 0:
+            raise ValueError("sampling_keep_top_k must either be -1 or positive.")
+        k_largest = mtf.nth_largest_element(
+            logits, n=sampling_keep_top_k, reduced_dim=vocab_dim
+        )
+        logits = mtf.where(
+            mtf.less_equal(logits, k_largest), mtf.ones_like(logits) * -1e6, logits
+        )
+    return logits
+
+
+def _has_stopped(
+    ids: mtf.Tensor,
+    position: mtf.Tensor,
+    initial_position: mtf.Tensor,
+    stop_at_token: Optional[int],
+) -> mtf.Tensor:
+    """Returns 1 for each sequence that ends at ``position`` (else 0)."""
+    length_dim = ids.shape.dims[-1]
+    last_token = mtf.gather(ids, position, length_dim)
+    stopped = mtf.zeros_like(last_token)
+    if stop_at_token is not None:
+        stopped = mtf.to_int32(mtf.equal(last_token, stop_at_token))
+    for stop_sequence in _STOP_SEQUENCES:
+        # the stop sequence must be generated (not part of the partial sequence)
+        # after another token, e.g. not the prefix a response starts with
+        matches = mtf.to_int32(
+            mtf.greater(position - (len(stop_sequence) - 1), initial_position)
+        )
+        for i, stop_id in enumerate(reversed(stop_sequence)):
+            token = mtf.gather(ids, position - i, length_dim)
+            matches *= mtf.to_int32(mtf.equal(token, stop_id))
+        stopped = mtf.maximum(stopped, matches)
+    return stopped
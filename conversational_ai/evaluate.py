@@ -0,0 +1,263 @@
+"""Evaluates every checkpoint of a model once, keeping the results in a ledger.
+
+Usage: `python3 -m conversational_ai.evaluate --gin_file=evaluate_ledger.gin`
+
+Unlike ``utils.run.mode = "eval"`` with ``eval_checkpoint_step = "all"``, which
+decodes every checkpoint again on every run, checkpoints that are already in the
+ledger are skipped and the validation inputs are only tokenized once.
+"""
+import contextlib
+import json
+import os
+import re
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+import gin
+
+from conversational_ai import tasks
+
+
+@gin.configurable
+def evaluate(
+    model_dir: Optional[Union[str, Path]] = None,
+    mixture_or_task_name: Optional[str] = None,
+    split: str = "validation",
+    ledger_dir: Optional[Union[str, Path]] = None,
+    watch: bool = False,
+    min_interval: float = 60.0,
+    timeout: Optional[float] = None,
+) -> List[Dict[str, Any]]:
+    """Evaluates the checkpoints in ``model_dir`` that aren't in the ledger yet.
+
+    The ledger (``ledger.jsonl``), the decoded outputs of each checkpoint and the
+    tokenized inputs are stored in ``ledger_dir`` (``{model_dir}/{split}_eval`` by
+    default, where ``utils.run`` writes its eval summaries). If ``watch``, new
+    checkpoints are evaluated as they are written, until none has been written
+    for ``timeout`` seconds (forever by default).
+
+    Returns:
+        the ledger, i.e. one ``{"step", "task", "metric", "value"}`` dict per result
+    """
+    # (in)directly import tf here so we can set TF_CPP_MIN_LOG_LEVEL in __main__ first
+    import tensorflow.compat.v1 as tf
+
+    if model_dir is None:
+        model_dir = gin.query_parameter("utils.run.model_dir")
+    if mixture_or_task_name is None:
+        mixture_or_task_name = gin.query_parameter("%MIXTURE_NAME")
+    tasks.register(mixture_or_task_name)
+    model_dir = str(model_dir)
+    ledger = _Ledger(ledger_dir or Path(model_dir, f"{split}_eval"))
+    evaluator = _Evaluator(model_dir, mixture_or_task_name, split, ledger)
+
+    try:
+        evaluator.evaluate_pending()
+        if watch:
+            for _ in tf.train.checkpoints_iterator(
+                model_dir, min_interval_secs=min_interval, timeout=timeout
+            ):
+                evaluator.evaluate_pending()
+    finally:
+        evaluator.close()
+    return ledger.results
+
+
+class _Ledger:
+    """The metrics of each checkpoint, appended to ``{ledger_dir}/ledger.jsonl``.
+
+    If the last line was only partially written (by an interrupted run), it is
+    removed along with the rest of its task's results, which are evaluated again.
+    """
+
+    def __init__(self, ledger_dir: Union[str, Path]) -> None:
+        self.dir = Path(ledger_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.dir.joinpath("ledger.jsonl")
+        self.results: List[Dict[str, Any]] = []
+        if self.path.exists():
+            self.results = self._read()
+        self._done: Set[Tuple[int, str]] = {
+            (r["step"], r["task"]) for r in self.results
+        }
+
+    def is_done(self, step: int, task: str) -> bool:
+        return (step, task) in self._done
+
+    def add(self, step: int, task: str, metrics: Dict[str, float]) -> None:
+        results = [
+            {"step": step, "task": task, "metric": k, "value": float(v)}
+            for k, v in sorted(metrics.items())
+        ]
+        # append all of a task's metrics at once so a crash can't leave some out
+        with self.path.open("a") as f:
+            f.write("".join(json.dumps(r) + "\n" for r in results))
+        self.results.extend(results)
+        self._done.add((step, task))
+
+    def _read(self) -> List[Dict[str, Any]]:
+        data = self.path.read_bytes()
+        complete = data[: data.rfind(b"\n") + 1]
+        lines = complete.decode("utf-8").splitlines(keepends=True)
+        results = [json.loads(line) for line in lines]
+        if len(complete) < len(data):
+            # the partial line may be of the last task, so drop all of its results
+            last_task = [(r["step"], r["task"]) for r in results[-1:]]
+            while results and [(results[-1]["step"], results[-1]["task"])] == last_task:
+                results.pop()
+                lines.pop()
+            with self.path.open("r+b") as f:
+                f.truncate(len("".join(lines).encode("utf-8")))
+        return results
+
+
+class _Evaluator:
+    """Decodes the tokenized inputs of each task with every pending checkpoint."""
+
+    def __init__(
+        self, model_dir: str, mixture_or_task_name: str, split: str, ledger: _Ledger
+    ) -> None:
+        import t5
+
+        self.model_dir = model_dir
+        self.split = split
+        self.ledger = ledger
+        self.tasks = [
+            task
+            for task in t5.data.get_subtasks(
+                t5.data.get_mixture_or_task(mixture_or_task_name)
+            )
+            if task.metric_fns
+        ]
+        self._predictor: Any = None
+        self._examples: Dict[str, Tuple[Any, List[str]]] = {}
+        self._summary_writer: Any = None
+
+    def evaluate_pending(self) -> None:
+        """Evaluates each checkpoint that doesn't have results for every task."""
+        for step, checkpoint_path in _checkpoints(self.model_dir):
+            tasks = [t for t in self.tasks if not self.ledger.is_done(step, t.name)]
+            if tasks:
+                self._evaluate(step, checkpoint_path, tasks)
+
+    def close(self) -> None:
+        if self._predictor is not None:
+            self._predictor.close()
+        if self._summary_writer is not None:
+            self._summary_writer.close()
+
+    def _evaluate(self, step: int, checkpoint_path: str, tasks: List[Any]) -> None:
+        import tensorflow.compat.v1 as tf
+
+        from conversational_ai import t5_model
+
+        if self._predictor is None:
+            self._predictor = t5_model.Predictor(self.model_dir, step=step)
+            self._summary_writer = tf.summary.FileWriter(str(self.ledger.dir))
+        elif self._predictor.step != step:
+            self._predictor.reload(checkpoint_path)
+
+        for task in tasks:
+            input_ids, targets = self._tokenized_examples(task)
+            decodes = self._predictor.decode_ids(input_ids)
+            predictions = [task.postprocess_fn(d, example=None) for d in decodes]
+            predictions_path = self.ledger.dir.joinpath(
+                f"{task.name}_{step}_predictions"
+            )
+            predictions_path.write_text("".join(f"{p}\n" for p in predictions))
+
+            metrics: Dict[str, float] = {}
+            for metric_fn in task.metric_fns:
+                metrics.update(metric_fn(targets, predictions))
+            summary = tf.Summary()
+            for name, value in sorted(metrics.items()):
+                tag = f"eval/{task.name}/{name}"
+                tf.logging.info("%s at step %d: %.3f", tag, step, value)
+                summary.value.add(tag=tag, simple_value=value)
+            self._summary_writer.add_summary(summary, step)
+            self._summary_writer.flush()
+            self.ledger.add(step, task.name, metrics)
+
+    def _tokenized_examples(self, task: Any) -> Tuple[Any, List[str]]:
+        """Returns the padded input ids and postprocessed targets of ``task``.
+
+        They are computed once and saved in the ledger directory, so later runs
+        (and checkpoints) don't tokenize the inputs again. The files are named with
+        the task's fingerprint (if it's a ``CachedTask``), so they're recomputed
+        when its examples change.
+        """
+        if task.name in self._examples:
+            return self._examples[task.name]
+
+        import numpy as np
+
+        length = self._predictor.sequence_length["inputs"]
+        name = f"{task.name}_{self.split}_{length}"
+        if getattr(task, "fingerprint", None):
+            name += f"_{task.fingerprint}"
+        inputs_path = self.ledger.dir.joinpath(f"{name}_inputs.npy")
+        targets_path = self.ledger.dir.joinpath(f"{name}_targets.json")
+        if not inputs_path.exists() or not targets_path.exists():
+            input_ids, targets = self._tokenize(task, length)
+            # write to temporary files first so an interrupted run never leaves a
+            # partial one
+            with _replace_when_done(inputs_path) as tmp:
+                with tmp.open("wb") as f:
+                    np.save(f, input_ids)
+            with _replace_when_done(targets_path) as tmp:
+                tmp.write_text(json.dumps(targets))
+
+        examples = np.load(str(inputs_path)), json.loads(targets_path.read_text())
+        self._examples[task.name] = examples
+        return examples
+
+    def _tokenize(self, task: Any, length: int) -> Tuple[Any, List[str]]:
+        import numpy as np
+        import tensorflow.compat.v1 as tf
+        import tensorflow_datasets as tfds
+
+        sequence_length = self._predictor.sequence_length
+        input_ids, targets = [], []
+        # use a separate graph so the estimator's graph isn't modified
+        with tf.Graph().as_default():
+            ds = task.get_dataset(sequence_length, split=self.split, shuffle=False)
+            for ex in tfds.as_numpy(ds):
+                ids = list(ex["inputs"])
+                if self._predictor.model_type == "lm" and ids and ids[-1] == 1:
+                    ids = ids[:-1]  # like `utils.encode_inputs`, lm inputs lack EOS
+                input_ids.append(ids + [0] * (length - len(ids)))
+                target = tf.compat.as_text(ex["targets_plaintext"])
+                targets.append(task.postprocess_fn(target, example=ex, is_target=True))
+        return np.array(input_ids, dtype=np.int32), targets
+
+
+@contextlib.contextmanager
+def _replace_when_done(path: Path) -> Iterator[Path]:
+    """Yields a temporary path that replaces ``path`` once the block is done."""
+    tmp = path.with_name(f".{path.name}.{os.getpid()}")
+    try:
+        yield tmp
+        tmp.replace(path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def _checkpoints(model_dir: str) -> List[Tuple[int, str]]:
+    """Returns the step and path of each checkpoint in ``model_dir`` in order."""
+    import tensorflow.compat.v1 as tf
+
+    checkpoints = []
+    for index_path in tf.io.gfile.glob(os.path.join(model_dir, "model.ckpt-*.index")):
+        match = re.search(r"model\.ckpt-(\d+)\.index$", index_path)
+        if match:
+            checkpoints.append((int(match.group(1)), index_path[: -len(".index")]))
+    return sorted(checkpoints)
+
+
+if __name__ == "__main__":
+    os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # disable tf C++ logging before importing
+    from conversational_ai import t5_model
+
+    t5_model.parse_gin_defaults_and_flags()
+    evaluate()
@@ -0,0 +1,449 @@
+"""Exports a checkpoint as a self-contained SavedModel for inference on CPUs.
+
+Usage: `python3 -m conversational_ai.export --gin_file=export.gin`
+
+The SavedModel takes a batch of model inputs (strings) and returns the decoded
+responses (strings): SentencePiece tokenization and detokenization and the decode
+settings (e.g. ``Unitransformer.sample_autoregressive`` and stop sequences) are
+part of the graph. Its weights are frozen into constants, so loading it doesn't
+restore a checkpoint or copy Mesh TensorFlow's master variables to their slices,
+and can be stored as ``bfloat16`` or as ``int8`` with a scale per output channel
+(and dequantized in the graph). ``ExportedModel`` loads it for predictions.
+
+Protocol buffers are limited to 2 GB, so bigger models need ``int8`` weights.
+"""
+import itertools
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+import gin
+
+from conversational_ai.chat import TokenizedHistory
+
+_METADATA_FILE = "assets.extra/conversational_ai.json"
+
+
+@gin.configurable
+def export(
+    conversation_prefix: str,
+    turn_prefixes: List[str],
+    turn_suffix: str = "",
+    context_window: int = 100,
+    model_dir: Optional[Union[str, Path]] = None,
+    step: Optional[Union[int, str]] = "latest",
+    export_dir: Union[str, Path] = "{model_dir}/export/{step}_{weight_dtype}",
+    weight_dtype: str = "float32",
+    min_quantized_size: int = 4096,
+    stop_at_turn_prefixes: bool = False,
+    check_inputs: Sequence[str] = ("chitchat:validation",),
+    num_check_examples: int = 32,
+) -> Path:
+    """Exports checkpoint ``step`` of ``model_dir`` and checks its predictions.
+
+    ``weight_dtype`` is ``"float32"`` (unchanged), ``"bfloat16"`` or ``"int8"``;
+    weights with fewer than ``min_quantized_size`` elements (e.g. layer norm
+    scales) are kept as they are. The prompt format (``conversation_prefix``,
+    ``turn_prefixes``, ``turn_suffix`` and ``context_window``) is saved with the
+    model for clients and used to build the check inputs. See
+    ``chat_interactively`` for ``stop_at_turn_prefixes``.
+
+    Afterwards, ``num_check_examples`` conversations from ``check_inputs`` (see
+    ``batch_infer``) are decoded by both the checkpoint and the export, and how
+    many of the responses match is written to ``{export_dir}/check.json``.
+
+    Returns:
+        the path of the SavedModel
+    """
+    # (in)directly import tf here so we can set TF_CPP_MIN_LOG_LEVEL in __main__ first
+    import tensorflow.compat.v1 as tf
+
+    from conversational_ai import t5_model
+
+    if weight_dtype not in ["float32", "bfloat16", "int8"]:
+        raise ValueError(f"unknown weight_dtype {weight_dtype!r}")
+    if model_dir is None:
+        model_dir = gin.query_parameter("utils.run.model_dir")
+    model_dir = str(model_dir)
+    if step is None or step == -1 or step == "latest":
+        step = t5_model.latest_checkpoint_step(model_dir)
+    step = int(step)
+    export_path = Path(
+        str(export_dir).format(
+            model_dir=model_dir, step=step, weight_dtype=weight_dtype
+        )
+    )
+    if export_path.exists():
+        raise ValueError(f"{export_path} already exists")
+
+    stop_strings = turn_prefixes if stop_at_turn_prefixes else []
+    with tempfile.TemporaryDirectory() as tmp:
+        saved_model, settings, vocabulary = _export_saved_model(
+            model_dir, step, tmp, stop_strings
+        )
+        graph_def, signature, variables = _freeze(saved_model)
+    if weight_dtype != "float32":
+        graph_def = _quantize_weights(
+            graph_def, weight_dtype, variables, min_quantized_size
+        )
+    _write_saved_model(export_path, graph_def, signature)
+
+    metadata = {
+        "model_dir": model_dir,
+        "step": step,
+        "weight_dtype": weight_dtype,
+        "conversation_prefix": conversation_prefix,
+        "turn_prefixes": turn_prefixes,
+        "turn_suffix": turn_suffix,
+        "context_window": context_window,
+        "stop_strings": stop_strings,
+        **settings,
+    }
+    export_path.joinpath(_METADATA_FILE).parent.mkdir(exist_ok=True)
+    export_path.joinpath(_METADATA_FILE).write_text(json.dumps(metadata, indent=2))
+    export_path.joinpath("assets.extra/operative_config.gin").write_text(
+        gin.operative_config_str()
+    )
+    tf.logging.info("Exported %s to %s", model_dir, export_path)
+
+    if num_check_examples:
+        history_kwargs = dict(
+            encode=t5_model.utils.inputs_vocabulary(vocabulary).encode,
+            max_tokens=settings["sequence_length"]["inputs"],
+            conversation_prefix=conversation_prefix,
+            turn_prefixes=turn_prefixes,
+            turn_suffix=turn_suffix,
+            context_window=context_window,
+        )
+        check = _check(export_path, check_inputs, num_check_examples, history_kwargs)
+        export_path.joinpath("check.json").write_text(json.dumps(check, indent=2))
+        tf.logging.info("%d of %d responses match", check["matches"], check["inputs"])
+    return export_path
+
+
+class ExportedModel:
+    """A model exported by ``export``, loaded without Mesh TensorFlow."""
+
+    def __init__(self, export_dir: Union[str, Path]) -> None:
+        """Loads the SavedModel in ``export_dir``."""
+        import tensorflow.compat.v1 as tf
+        import tensorflow_text  # noqa: F401 (registers the SentencePiece ops)
+
+        self.export_dir = Path(export_dir)
+        self.metadata = json.loads(self.export_dir.joinpath(_METADATA_FILE).read_text())
+        self.batch_size = self.metadata["batch_size"]
+        self._graph = tf.Graph()
+        self._session = tf.Session(graph=self._graph)
+        meta_graph = tf.saved_model.loader.load(
+            self._session, [tf.saved_model.tag_constants.SERVING], str(export_dir)
+        )
+        signature = meta_graph.signature_def["serving_default"]
+        self._inputs = signature.inputs["inputs"].name
+        self._outputs = signature.outputs["outputs"].name
+
+    def __call__(self, model_input: List[str]) -> List[str]:
+        """Gets a prediction from the model for each string in ``model_input``."""
+        outputs: List[str] = []
+        # the serving input function only decodes the first batch it is given
+        for i in range(0, len(model_input), self.batch_size):
+            batch = model_input[i : i + self.batch_size]
+            results = self._session.run(self._outputs, {self._inputs: batch})
+            outputs.extend(r.decode("utf-8") for r in results[: len(batch)])
+        return outputs
+
+    def close(self) -> None:
+        """Closes the session."""
+        self._session.close()
+
+
+def _export_saved_model(
+    model_dir: str, step: int, tmp_dir: str, stop_strings: List[str]
+) -> Tuple[str, Dict[str, Any], Any]:
+    """Exports the checkpoint like ``utils.run`` with ``mode = "export"`` does.
+
+    Returns:
+        the path of the (unfrozen) SavedModel, the settings it was built with and
+        its vocabulary
+    """
+    from mesh_tensorflow.transformer import utils
+
+    from conversational_ai import decoding, t5_model
+
+    exported: Dict[str, Any] = {}
+
+    def export_from_estimator(
+        estimator: Any,
+        vocabulary: Any,
+        model_type: str,
+        batch_size: int,
+        sequence_length: Dict[str, int],
+        checkpoint_path: str,
+        **kwargs,
+    ) -> None:
+        if stop_strings:
+            vocab = utils.targets_vocabulary(vocabulary)
+            decoding.use_stop_sequences(
+                decoding.encode_stop_sequences(vocab, stop_strings)
+            )
+        exported["path"] = utils.export_model(
+            estimator,
+            tmp_dir,
+            vocabulary,
+            sequence_length,
+            batch_size=batch_size,
+            checkpoint_path=checkpoint_path,
+        )
+        exported["vocabulary"] = vocabulary
+        exported["settings"] = {
+            "model_type": model_type,
+            "batch_size": batch_size,
+            "sequence_length": sequence_length,
+            "decode_parameters": t5_model._decode_parameters(),
+            "sample_autoregressive_parameters": decoding._bound_parameters(),
+        }
+
+    with gin.unlock_config():
+        gin.bind_parameter("utils.run.mode", "infer")
+        gin.bind_parameter("utils.run.model_dir", model_dir)
+        gin.bind_parameter("utils.run.eval_checkpoint_step", step)
+        gin.bind_parameter("infer_model.decode_from_file_fn", export_from_estimator)
+    try:
+        # `utils.run` gives us the estimator it built instead of decoding
+        t5_model.run()
+    finally:
+        with gin.unlock_config():
+            gin.bind_parameter(
+                "infer_model.decode_from_file_fn", utils.decode_from_file
+            )
+    path = exported["path"]
+    if isinstance(path, bytes):
+        path = path.decode("utf-8")
+    return path, exported["settings"], exported["vocabulary"]
+
+
+def _freeze(saved_model: str) -> Tuple[Any, Any, Set[str]]:
+    """Returns the serving graph with its variables as constants and its signature.
+
+    Loading the SavedModel runs its ``local_init_op``, which copies the master
+    variables to the slices the graph reads, so only the slices are kept. Also
+    returns the names of the variables (which are now constants).
+    """
+    import tensorflow.compat.v1 as tf
+
+    with tf.Graph().as_default() as graph, tf.Session(graph=graph) as session:
+        meta_graph = tf.saved_model.loader.load(
+            session, [tf.saved_model.tag_constants.SERVING], saved_model
+        )
+        signature = meta_graph.signature_def["serving_default"]
+        output_nodes = [t.name.split(":")[0] for t in signature.outputs.values()]
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            session, graph.as_graph_def(), output_nodes
+        )
+        variables = {
+            node.name
+            for node in graph.as_graph_def().node
+            if node.op in ["VariableV2", "VarHandleOp"]
+        }
+    return graph_def, signature, variables
+
+
+def _quantize_weights(
+    graph_def: Any, weight_dtype: str, variables: Set[str], min_size: int
+) -> Any:
+    """Stores the (large) frozen ``variables`` of ``graph_def`` as ``weight_dtype``.
+
+    Each constant is replaced by a smaller one and the ops that convert it back,
+    under the original name, so the rest of the graph is unchanged.
+    """
+    import tensorflow.compat.v1 as tf
+
+    quantized = tf.GraphDef()
+    quantized.versions.CopyFrom(graph_def.versions)
+    quantized.library.CopyFrom(graph_def.library)
+    num_quantized = 0
+    for node in graph_def.node:
+        if node.name in variables and _is_weight(node, min_size):
+            quantized.node.extend(_quantized_nodes(node, weight_dtype))
+            num_quantized += 1
+        else:
+            quantized.node.extend([node])
+    tf.logging.info("Stored %d weights as %s", num_quantized, weight_dtype)
+    return quantized
+
+
+def _is_weight(node: Any, min_size: int) -> bool:
+    import numpy as np
+    import tensorflow.compat.v1 as tf
+
+    if node.op != "Const" or node.input:
+        return False
+    if node.attr["dtype"].type not in [
+        tf.float32.as_datatype_enum,
+        tf.bfloat16.as_datatype_enum,
+    ]:
+        return False
+    shape = [d.size for d in node.attr["value"].tensor.tensor_shape.dim]
+    return int(np.prod(shape)) >= min_size
+
+
+def _quantized_nodes(node: Any, weight_dtype: str) -> List[Any]:
+    """Returns the nodes that replace the weight ``node``."""
+    import numpy as np
+    import tensorflow.compat.v1 as tf
+
+    dtype = tf.as_dtype(node.attr["dtype"].type)
+    weight = tf.make_ndarray(node.attr["value"].tensor).astype(np.float32)
+    if weight_dtype == "bfloat16":
+        if dtype == tf.bfloat16:
+            return [node]
+        stored = _const_node(node, "bfloat16", weight, tf.bfloat16)
+        return [stored, _cast_node(node.name, stored, tf.bfloat16, dtype, node.device)]
+
+    values, scale = _quantize_int8(weight)
+    stored = _const_node(node, "int8", values, tf.int8)
+    scale_node = _const_node(node, "scale", scale, tf.float32)
+    cast = _cast_node(
+        f"{node.name}/dequantize", stored, tf.int8, tf.float32, node.device
+    )
+    mul = tf.NodeDef(
+        name=node.name if dtype == tf.float32 else f"{node.name}/scaled",
+        op="Mul",
+        input=[cast.name, scale_node.name],
+        device=node.device,
+    )
+    mul.attr["T"].type = tf.float32.as_datatype_enum
+    nodes = [stored, scale_node, cast, mul]
+    if dtype != tf.float32:
+        nodes.append(_cast_node(node.name, mul, tf.float32, dtype, node.device))
+    return nodes
+
+
+def _quantize_int8(weight: Any) -> Tuple[Any, Any]:
+    """Returns symmetric int8 values with a scale per output (i.e. last) dimension.
+
+    ``values * scale`` approximates ``weight``.
+    """
+    import numpy as np
+
+    scale = np.abs(weight).max(axis=tuple(range(weight.ndim - 1))) / 127
+    scale[scale == 0] = 1.0
+    values = np.clip(np.round(weight / scale), -127, 127).astype(np.int8)
+    return values, scale.astype(np.float32)
+
+
+def _const_node(node: Any, suffix: str, value: Any, dtype: Any) -> Any:
+    import tensorflow.compat.v1 as tf
+
+    const = tf.NodeDef(name=f"{node.name}/{suffix}", op="Const", device=node.device)
+    const.attr["dtype"].type = dtype.as_datatype_enum
+    const.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(value, dtype=dtype))
+    return const
+
+
+def _cast_node(name: str, input_node: Any, src: Any, dst: Any, device: str) -> Any:
+    import tensorflow.compat.v1 as tf
+
+    cast = tf.NodeDef(name=name, op="Cast", input=[input_node.name], device=device)
+    cast.attr["SrcT"].type = src.as_datatype_enum
+    cast.attr["DstT"].type = dst.as_datatype_enum
+    cast.attr["Truncate"].b = False
+    return cast
+
+
+def _write_saved_model(path: Path, graph_def: Any, signature: Any) -> None:
+    import tensorflow.compat.v1 as tf
+
+    with tf.Graph().as_default() as graph, tf.Session(graph=graph) as session:
+        tf.import_graph_def(graph_def, name="")
+        builder = tf.saved_model.Builder(str(path))
+        builder.add_meta_graph_and_variables(
+            session,
+            [tf.saved_model.tag_constants.SERVING],
+            signature_def_map={"serving_default": signature},
+        )
+        builder.save()
+
+
+def _check(
+    export_path: Path,
+    inputs: Sequence[str],
+    num_examples: int,
+    history_kwargs: Dict[str, Any],
+) -> Dict[str, Any]:
+    """Compares the responses of the export and its checkpoint to the same inputs."""
+    from conversational_ai import t5_model
+    from conversational_ai.batch_infer import read_conversations
+
+    start = time.perf_counter()
+    exported = ExportedModel(export_path)
+    export_load_seconds = time.perf_counter() - start
+    metadata = exported.metadata
+
+    model_input = []
+    conversations = read_conversations(inputs, ("human: ", "model: "))
+    for _, convo in itertools.islice(conversations, num_examples):
+        history = TokenizedHistory(**history_kwargs)
+        for turn in convo[:-1] or convo:
+            history.append(turn)
+        model_input.append(history.model_input())
+
+    start = time.perf_counter()
+    export_outputs = exported(model_input)
+    export_seconds = time.perf_counter() - start
+    exported.close()
+
+    start = time.perf_counter()
+    predictor = t5_model.Predictor(metadata["model_dir"], step=metadata["step"])
+    try:
+        checkpoint_outputs = predictor(model_input)  # also builds and restores
+    finally:
+        predictor.close()
+    checkpoint_seconds = time.perf_counter() - start
+
+    pairs = list(zip(model_input, checkpoint_outputs, export_outputs))
+    return {
+        "inputs": len(pairs),
+        "matches": sum(a == b for _, a, b in pairs),
+        "deterministic": _is_deterministic(metadata),
+        "mismatches": [
+            {"input": inp, "checkpoint": a, "export": b}
+            for inp, a, b in pairs
+            if a != b
+        ][:5],
+        "export": {
+            "load_seconds": export_load_seconds,
+            "decode_seconds": export_seconds,
+            "size_mb": _size_mb(export_path.glob("**/*")),
+        },
+        "checkpoint": {
+            "load_and_decode_seconds": checkpoint_seconds,
+            "size_mb": _size_mb(
+                Path(metadata["model_dir"]).glob(f"model.ckpt-{metadata['step']}.*")
+            ),
+        },
+    }
+
+
+def _is_deterministic(metadata: Dict[str, Any]) -> bool:
+    """Returns whether the responses of the export should match exactly."""
+    from conversational_ai import t5_model
+
+    if metadata["model_type"] == "lm":  # decodes with `sample_autoregressive`
+        params = metadata["sample_autoregressive_parameters"]
+        return params.get("temperature", 0.0) == 0.0
+    return t5_model._is_deterministic(metadata["decode_parameters"])
+
+
+def _size_mb(paths: Any) -> float:
+    return sum(p.stat().st_size for p in paths if p.is_file()) / 2 ** 20
+
+
+if __name__ == "__main__":
+    os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # disable tf C++ logging before importing
+    from conversational_ai import t5_model
+
+    t5_model.parse_gin_defaults_and_flags()
+    export()
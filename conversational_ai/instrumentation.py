@@ -0,0 +1,139 @@
+"""Timing and memory instrumentation for chat turns."""
+import contextlib
+import json
+import resource
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+
+class TurnRecorder:
+    """Records where the time of each turn goes, as one JSON line per turn.
+
+    A turn is split into named spans (e.g. ``tokenize`` or ``decode``) that record
+    their wall time and the peak resident set size (RSS) of the process so far;
+    spans with the same name in a turn are added up. The ``tf.train.SessionRunHook``
+    returned by ``hook`` splits building the graph and restoring the checkpoint out
+    of the span they happen in (i.e. the first ``decode`` of a ``Predictor``).
+    """
+
+    def __init__(self, path: Optional[Union[str, Path]] = None) -> None:
+        """Creates a new TurnRecorder that appends each turn to ``path``."""
+        self.path = Path(path) if path is not None else None
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.turns: List[Dict[str, Any]] = []
+        self._spans: Dict[str, Dict[str, float]] = {}
+        self._fields: Dict[str, Any] = {}
+        # the name, start time and thread of the span that is being recorded
+        self._active: Optional[Tuple[str, float, int]] = None
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Records the time spent in the ``with`` block as ``name``."""
+        self._active = (name, time.perf_counter(), threading.get_ident())
+        try:
+            yield
+        finally:
+            self.split(name)
+            self._active = None
+
+    def split(self, name: str) -> None:
+        """Records the active span up to now as ``name`` and restarts it.
+
+        Does nothing outside of a span (or in another thread, e.g. when a
+        ``Predictor`` reloads a checkpoint in the background).
+        """
+        if self._active is None or self._active[2] != threading.get_ident():
+            return
+        now = time.perf_counter()
+        span = self._spans.setdefault(name, {"seconds": 0.0})
+        span["seconds"] += now - self._active[1]
+        span["peak_rss_mb"] = _peak_rss_mb()
+        self._active = (self._active[0], now, self._active[2])
+
+    def add(self, **fields: Any) -> None:
+        """Adds ``fields`` (e.g. token counts) to the current turn."""
+        self._fields.update(fields)
+
+    def end_turn(self) -> Dict[str, Any]:
+        """Writes the current turn to ``path`` (if any) and starts a new one."""
+        turn = {
+            "turn": len(self.turns),
+            "timestamp": time.time(),
+            **self._fields,
+            "spans": self._spans,
+        }
+        if self.path is not None:
+            with self.path.open("a") as f:
+                f.write(json.dumps(turn) + "\n")
+        self.turns.append(turn)
+        self._spans, self._fields = {}, {}
+        return turn
+
+    def summary(self) -> str:
+        """Returns a table of the mean and p90 wall time of each span per turn."""
+        names = sorted({name for turn in self.turns for name in turn["spans"]})
+        lines = [f"{'span':<16}{'turns':>6}{'mean (s)':>10}{'p90 (s)':>10}"]
+        for name in names:
+            seconds = sorted(
+                t["spans"][name]["seconds"] for t in self.turns if name in t["spans"]
+            )
+            lines.append(
+                f"{name:<16}{len(seconds):>6}{mean(seconds):>10.3f}"
+                f"{percentile(seconds, 90):>10.3f}"
+            )
+        peak_rss = max((_max_rss(t) for t in self.turns), default=0.0)
+        lines.append(f"peak RSS: {peak_rss:.0f} MB")
+        decoded = sum(t.get("decoded_tokens", 0) for t in self.turns)
+        decode_seconds = sum(
+            t["spans"].get("decode", {}).get("seconds", 0.0) for t in self.turns
+        )
+        if decoded and decode_seconds:
+            lines.append(f"decoded tokens/s: {decoded / decode_seconds:.1f}")
+        first_token = sorted(
+            t["time_to_first_token"] for t in self.turns if "time_to_first_token" in t
+        )
+        if first_token:
+            lines.append(
+                f"time to first token (s): mean {mean(first_token):.3f}, "
+                f"p90 {percentile(first_token, 90):.3f}"
+            )
+        return "\n".join(lines)
+
+    def hook(self) -> Any:
+        """Returns a ``tf.train.SessionRunHook`` that splits out graph and restore."""
+        import tensorflow.compat.v1 as tf
+
+        recorder = self
+
+        class _SplitHook(tf.train.SessionRunHook):
+            def begin(self) -> None:
+                recorder.split("build_graph")
+
+            def after_create_session(self, session: Any, coord: Any) -> None:
+                recorder.split("restore")
+
+        return _SplitHook()
+
+
+def _peak_rss_mb() -> float:
+    # `ru_maxrss` is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _max_rss(turn: Dict[str, Any]) -> float:
+    return max((s["peak_rss_mb"] for s in turn["spans"].values()), default=0.0)
+
+
+def mean(values: Sequence[float]) -> Optional[float]:
+    """Returns the mean of ``values`` (or ``None`` if there are none)."""
+    return sum(values) / len(values) if values else None
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Returns the ``q``th percentile of sorted ``values`` (nearest-rank)."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
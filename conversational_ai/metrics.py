@@ -0,0 +1,223 @@
+"""BLEU and ROUGE metrics that scale to large validation sets.
+
+``bleu`` and ``rouge`` compute the same metrics as ``t5.evaluation.metrics``, but
+the n-gram and longest common subsequence (LCS) statistics are computed over
+token id arrays with numpy, without recursion, in a pool of processes. They aren't
+gin configurable since T5 requires ``metric_fns`` whose positional args are
+exactly ``(targets, predictions)``.
+"""
+import collections
+import functools
+import math
+import multiprocessing
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+import sacrebleu
+
+_BLEU_ORDER = 4
+_ROUGE_KEYS = ["rouge1", "rouge2", "rougeLsum"]
+_NON_ALPHANUM_RE = re.compile(r"[^a-z0-9]+")
+# smaller inputs aren't worth starting processes for
+_MIN_CHUNK_SIZE = 1000
+
+
+def bleu(
+    targets: List[Any], predictions: List[str], num_workers: Optional[int] = None
+) -> Dict[str, float]:
+    """Returns the corpus BLEU score like ``t5.evaluation.metrics.bleu``."""
+    if targets and isinstance(targets[0], list):  # multiple references
+        from t5.evaluation import metrics
+
+        return metrics.bleu(targets, predictions)
+
+    stats = _map(_bleu_stats, targets, predictions, num_workers).sum(axis=0)
+    correct = [int(x) for x in stats[:_BLEU_ORDER]]
+    total = [int(x) for x in stats[_BLEU_ORDER : 2 * _BLEU_ORDER]]
+    sys_len, ref_len = int(stats[-2]), int(stats[-1])
+    score = sacrebleu.compute_bleu(
+        correct, total, sys_len, ref_len, smooth_method="exp", smooth_value=0.0
+    )
+    return {"bleu": score.score}
+
+
+def rouge(
+    targets: List[str],
+    predictions: List[str],
+    score_keys: Optional[Sequence[str]] = None,
+    num_workers: Optional[int] = None,
+) -> Dict[str, float]:
+    """Returns the mean ROUGE F-measures like ``t5.evaluation.metrics.rouge``.
+
+    T5 reports the median of bootstrap resampled means, which is random but very
+    close to the mean.
+    """
+    score_keys = list(score_keys or _ROUGE_KEYS)
+    fn = functools.partial(_rouge_scores, score_keys=score_keys)
+    scores = _map(fn, targets, predictions, num_workers)
+    means = scores.mean(axis=0) * 100
+    return {key: float(mean) for key, mean in zip(score_keys, means)}
+
+
+def _map(
+    fn: Callable[[Any, str], Sequence[float]],
+    targets: List[Any],
+    predictions: List[str],
+    num_workers: Optional[int],
+) -> np.ndarray:
+    """Returns ``fn(target, prediction)`` for each example as a row of an array."""
+    assert len(targets) == len(predictions) > 0
+    examples = list(zip(targets, predictions))
+    num_workers = num_workers or os.cpu_count() or 1
+    chunk_size = max(_MIN_CHUNK_SIZE, math.ceil(len(examples) / num_workers))
+    chunks = [examples[i : i + chunk_size] for i in range(0, len(examples), chunk_size)]
+    if len(chunks) == 1:
+        return _apply(fn, chunks[0])
+
+    # spawn instead of forking a process that has TensorFlow and its threads loaded
+    with multiprocessing.get_context("spawn").Pool(len(chunks)) as pool:
+        return np.concatenate(pool.map(functools.partial(_apply, fn), chunks))
+
+
+def _apply(
+    fn: Callable[[Any, str], Sequence[float]], examples: List[Tuple[Any, str]]
+) -> np.ndarray:
+    return np.array([fn(target, prediction) for target, prediction in examples])
+
+
+def _bleu_stats(target: str, prediction: str) -> List[int]:
+    """Returns the n-gram matches and totals and the lengths like ``sacrebleu``."""
+    tokenize = sacrebleu.TOKENIZERS["intl"]
+    hyp = tokenize(prediction.rstrip()).split()
+    ref = tokenize(target.rstrip()).split()
+    (hyp_ids, ref_ids), base = _to_ids(hyp, ref)
+
+    correct, total = [], []
+    for n in range(1, _BLEU_ORDER + 1):
+        hyp_ngrams = _ngrams(hyp_ids, n, base)
+        correct.append(_num_matches(hyp_ngrams, _ngrams(ref_ids, n, base)))
+        total.append(len(hyp_ngrams))
+    return correct + total + [len(hyp), len(ref)]
+
+
+def _rouge_scores(target: str, prediction: str, score_keys: List[str]) -> List[float]:
+    """Returns the ROUGE F-measures like ``rouge_score.rouge_scorer.RougeScorer``."""
+    # like `t5.evaluation.metrics.rouge`, add newlines between sentences for rougeLsum
+    ref_sents = [_rouge_tokenize(s) for s in target.replace(" . ", " .\n").split("\n")]
+    hyp_sents = [
+        _rouge_tokenize(s) for s in prediction.replace(" . ", " .\n").split("\n")
+    ]
+    sent_ids, base = _to_ids(*ref_sents, *hyp_sents)
+    ref_sent_ids, hyp_sent_ids = sent_ids[: len(ref_sents)], sent_ids[len(ref_sents) :]
+    ref_ids = np.concatenate(ref_sent_ids)
+    hyp_ids = np.concatenate(hyp_sent_ids)
+
+    scores = []
+    for key in score_keys:
+        if key == "rougeLsum":
+            scores.append(_summary_lcs_fmeasure(ref_sent_ids, hyp_sent_ids))
+        elif key == "rougeL":
+            lcs = _lcs_table(ref_ids, hyp_ids)[-1, -1] if len(hyp_ids) else 0
+            scores.append(_fmeasure(lcs, len(hyp_ids), len(ref_ids)))
+        else:
+            n = int(key[len("rouge") :])
+            ref_ngrams = _ngrams(ref_ids, n, base)
+            hyp_ngrams = _ngrams(hyp_ids, n, base)
+            matches = _num_matches(hyp_ngrams, ref_ngrams)
+            scores.append(_fmeasure(matches, len(hyp_ngrams), len(ref_ngrams)))
+    return scores
+
+
+def _rouge_tokenize(text: str) -> List[str]:
+    """Tokenizes like ``rouge_score.tokenize`` (without stemming)."""
+    return _NON_ALPHANUM_RE.sub(" ", text.lower()).split()
+
+
+def _to_ids(*token_lists: List[str]) -> Tuple[List[np.ndarray], int]:
+    """Maps tokens to ids and returns them and the number of distinct tokens."""
+    vocab: Dict[str, int] = {}
+    ids = [
+        np.array([vocab.setdefault(t, len(vocab)) for t in tokens], dtype=np.int64)
+        for tokens in token_lists
+    ]
+    return ids, max(len(vocab), 1)
+
+
+def _ngrams(ids: np.ndarray, n: int, base: int) -> np.ndarray:
+    """Returns each n-gram in ``ids`` as a single number in base ``base``."""
+    dtype = np.int64 if base ** n < 2 ** 63 else object  # object for huge n-grams
+    ngrams: np.ndarray = np.zeros(max(len(ids) - n + 1, 0), dtype=dtype)
+    for k in range(n):
+        ngrams = ngrams * base + ids[k : k + len(ngrams)].astype(dtype)
+    return ngrams
+
+
+def _num_matches(hyp_ngrams: np.ndarray, ref_ngrams: np.ndarray) -> int:
+    """Returns the number of n-grams in common, clipped by the number in each."""
+    hyp, hyp_counts = np.unique(hyp_ngrams, return_counts=True)
+    ref, ref_counts = np.unique(ref_ngrams, return_counts=True)
+    _, i, j = np.intersect1d(hyp, ref, assume_unique=True, return_indices=True)
+    return int(np.minimum(hyp_counts[i], ref_counts[j]).sum())
+
+
+def _lcs_table(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Returns the LCS dynamic programming table of ``a`` and ``b``.
+
+    Each row is computed at once: ``table[i + 1, j + 1]`` is the running maximum
+    of ``table[i, j + 1]`` and ``table[i, j] + 1`` (if ``a[i] == b[j]``).
+    """
+    table = np.zeros((len(a) + 1, len(b) + 1), dtype=np.int64)
+    for i in range(len(a)):
+        diagonal = np.where(b == a[i], table[i, :-1] + 1, 0)
+        table[i + 1, 1:] = np.maximum.accumulate(np.maximum(table[i, 1:], diagonal))
+    return table
+
+
+def _lcs_indices(a: np.ndarray, b: np.ndarray) -> List[int]:
+    """Returns the indices in ``a`` of the same LCS ``rouge_score`` finds."""
+    table = _lcs_table(a, b)
+    i, j = len(a), len(b)
+    indices = []
+    while i > 0 and j > 0:
+        if a[i - 1] == b[j - 1]:
+            indices.append(i - 1)
+            i, j = i - 1, j - 1
+        elif table[i, j - 1] > table[i - 1, j]:
+            j -= 1
+        else:
+            i -= 1
+    return indices[::-1]
+
+
+def _summary_lcs_fmeasure(
+    ref_sents: List[np.ndarray], hyp_sents: List[np.ndarray]
+) -> float:
+    """Returns the summary level (union) LCS F-measure, i.e. rougeLsum."""
+    ref_counts = collections.Counter(t for s in ref_sents for t in s.tolist())
+    hyp_counts = collections.Counter(t for s in hyp_sents for t in s.tolist())
+    num_ref, num_hyp = sum(ref_counts.values()), sum(hyp_counts.values())
+    if not num_ref or not num_hyp:
+        return 0.0
+
+    hits = 0
+    for ref in ref_sents:
+        union: Set[int] = set()
+        for hyp in hyp_sents:
+            union.update(_lcs_indices(ref, hyp))
+        for t in ref[sorted(union)].tolist():
+            # don't count a token more times than it appears (like ROUGE 1.5.5)
+            if ref_counts[t] > 0 and hyp_counts[t] > 0:
+                hits += 1
+                ref_counts[t] -= 1
+                hyp_counts[t] -= 1
+    return _fmeasure(hits, num_hyp, num_ref)
+
+
+def _fmeasure(matches: int, num_hyp: int, num_ref: int) -> float:
+    precision = matches / max(num_hyp, 1)
+    recall = matches / max(num_ref, 1)
+    if precision + recall == 0:
+        return 0.0
+    return 2 * precision * recall / (precision + recall)
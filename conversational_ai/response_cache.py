@@ -0,0 +1,118 @@
+"""Caching for model responses."""
+import collections
+import hashlib
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
+
+import gin
+
+
+@gin.configurable
+class ResponseCache:
+    """A bounded LRU cache of model responses with an optional time-to-live.
+
+    Entries are keyed by ``ResponseCache.key``, i.e. the exact model input, the
+    checkpoint, the decode parameters and the stop sequences. If ``path`` is given,
+    the cache is loaded from it when created and written back to it by ``save``.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 10_000,
+        ttl: Optional[float] = None,
+        path: Optional[Union[str, Path]] = None,
+    ) -> None:
+        """Creates a new ResponseCache, loading it from ``path`` if it exists."""
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = Path(path) if path is not None else None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "collections.OrderedDict[str, Tuple[str, float]]"
+        self._entries = collections.OrderedDict()
+
+        if self.path is not None and self.path.exists():
+            for k, (v, timestamp) in json.loads(self.path.read_text()).items():
+                self._put(k, v, timestamp)
+
+    @staticmethod
+    def key(
+        model_input: str,
+        checkpoint_path: str,
+        decode_params: Dict[str, Any],
+        stop_sequences: Sequence[Sequence[int]] = (),
+    ) -> str:
+        """Returns the cache key for a model input, checkpoint and decode params.
+
+        ``checkpoint_path`` identifies both the model and the step, so a cache that
+        is saved to ``path`` can be shared by different models.
+        """
+        key = json.dumps(
+            [
+                model_input,
+                checkpoint_path,
+                decode_params,
+                [list(s) for s in stop_sequences],
+            ],
+            sort_keys=True,
+        )
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached response for ``key`` if there is a fresh one."""
+        with self._lock:
+            value, timestamp = self._entries.get(key, (None, 0.0))
+            if value is not None and self._is_expired(timestamp):
+                del self._entries[key]
+                value = None
+
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        """Caches ``value`` for ``key``, evicting the least recently used entry."""
+        with self._lock:
+            self._put(key, value, time.time())
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the size and hit rate of the cache."""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else None,
+        }
+
+    def save(self) -> None:
+        """Writes the (unexpired) cache entries to ``path``."""
+        if self.path is None:
+            return
+        with self._lock:
+            entries = {
+                k: v for k, v in self._entries.items() if not self._is_expired(v[1])
+            }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(entries))
+        tmp.replace(self.path)  # so a crash while saving can't corrupt the cache
+
+    def _put(self, key: str, value: str, timestamp: float) -> None:
+        if self._is_expired(timestamp):
+            return
+        self._entries[key] = (value, timestamp)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _is_expired(self, timestamp: float) -> bool:
+        return self.ttl is not None and time.time() - timestamp > self.ttl
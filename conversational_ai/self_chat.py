@@ -0,0 +1,236 @@
+"""Generates conversations of a trained model with itself, many at a time.
+
+Usage: `python3 -m conversational_ai.self_chat --gin_file=self_chat.gin`
+
+Each conversation starts with the first turns of a seed conversation (read like
+the inputs of ``batch_infer``), after which the model takes every turn, i.e. both
+``turn_prefixes``. All active conversations advance one turn per step, decoded
+together in full batches, and finished conversations are replaced by new ones, so
+the turns per second depend on the batch size rather than on the number of
+conversations. Finished conversations are written as transcripts in the format of
+``chat_interactively`` (see ``TranscriptWriter``).
+"""
+import os
+import re
+import time
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import gin
+
+from conversational_ai.batch_infer import read_conversations
+from conversational_ai.chat import TokenizedHistory, postprocess_response
+from conversational_ai.transcript import TranscriptWriter
+
+
+@gin.configurable
+def self_chat(
+    seeds: Sequence[str],
+    conversation_prefix: str,
+    turn_prefixes: List[str],
+    turn_suffix: str = "",
+    context_window: int = 100,
+    model_dir: Optional[Union[str, Path]] = None,
+    step: Optional[Union[int, str]] = "latest",
+    output_dir: Union[str, Path] = "./chats/self_chat_{run}_{step}",
+    num_turns: int = 10,
+    seed_turns: int = 1,
+    max_conversations: Optional[int] = None,
+    batches_per_step: int = 4,
+    transcript_turn_prefixes: Sequence[str] = ("human: ", "model: "),
+    stop_at_turn_prefixes: bool = True,
+) -> Path:
+    """Generates ``num_turns`` long conversations and writes them to ``output_dir``.
+
+    Each conversation starts with the first ``seed_turns`` turns of a conversation
+    in ``seeds`` (see ``batch_infer`` for the formats), up to ``max_conversations``
+    of them. ``batch_size * batches_per_step`` conversations are active at a time.
+    A conversation ends early if the model's response is empty.
+
+    Conversation ``{id}`` is written to ``{output_dir}/chat_{id}.txt`` once it is
+    finished; conversations that were already written are skipped, so an
+    interrupted run can simply be restarted. See ``chat_interactively`` for the
+    other args.
+
+    Returns:
+        the path of the output directory
+    """
+    # (in)directly import tf here so we can set TF_CPP_MIN_LOG_LEVEL in __main__ first
+    import tensorflow.compat.v1 as tf
+
+    from conversational_ai import decoding, t5_model
+
+    if model_dir is None:
+        model_dir = gin.query_parameter("utils.run.model_dir")
+    model_dir = str(model_dir)
+    if step is None or step == -1 or step == "latest":
+        step = t5_model.latest_checkpoint_step(model_dir)
+    output_path = Path(str(output_dir).format(run=Path(model_dir).name, step=step))
+    output_path.mkdir(parents=True, exist_ok=True)
+    output_path.joinpath("config.gin").write_text(gin.config_str())
+
+    predictor = t5_model.Predictor(model_dir, step=step)
+    vocabulary = t5_model.utils.inputs_vocabulary(predictor.vocabulary)
+    if stop_at_turn_prefixes:  # before the graph is built by the first decode
+        decoding.use_stop_sequences(
+            decoding.encode_stop_sequences(vocabulary, turn_prefixes)
+        )
+    max_input_tokens = gin.query_parameter("utils.run.sequence_length")["inputs"]
+
+    def new_history() -> TokenizedHistory:
+        return TokenizedHistory(
+            vocabulary.encode,
+            max_input_tokens,
+            conversation_prefix,
+            turn_prefixes,
+            turn_suffix,
+            context_window,
+        )
+
+    def write(convo_id: str, turns: List[str]) -> None:
+        _write_transcript(_transcript_path(output_path, convo_id), turns, prefixes)
+
+    prefixes = list(transcript_turn_prefixes)
+    seed_convos = _seeds(seeds, seed_turns, prefixes, max_conversations)
+    try:
+        _self_chat(
+            predictor,
+            (
+                s
+                for s in seed_convos
+                if not _transcript_path(output_path, s[0]).exists()
+            ),
+            new_history,
+            turn_prefixes,
+            num_turns,
+            predictor.batch_size * batches_per_step,
+            write,
+            log=tf.logging.info,
+        )
+    finally:
+        predictor.close()
+    return output_path
+
+
+def _self_chat(
+    predict: Callable[[List[str]], List[str]],
+    seeds: Iterator[Tuple[str, List[str]]],
+    new_history: Callable[[], TokenizedHistory],
+    turn_prefixes: List[str],
+    num_turns: int,
+    num_active: int,
+    write: Callable[[str, List[str]], None],
+    log: Optional[Callable[..., None]] = None,
+) -> int:
+    """Continues the ``seeds`` with ``predict``, ``num_active`` at a time.
+
+    Returns:
+        the number of conversations that were written
+    """
+    active: List[Tuple[str, TokenizedHistory]] = []
+    num_written = 0
+    while True:
+        num_written += _start(active, num_active, seeds, new_history, num_turns, write)
+        if not active:
+            return num_written
+
+        start = time.perf_counter()
+        predictions = predict([history.model_input() for _, history in active])
+        seconds = time.perf_counter() - start
+
+        still_active = []
+        for (convo_id, history), prediction in zip(active, predictions):
+            response = _response(prediction, turn_prefixes)
+            if response:
+                history.append(response)
+            if not response or len(history.turns) >= num_turns:
+                write(convo_id, history.turns)
+                num_written += 1
+            else:
+                still_active.append((convo_id, history))
+        if log is not None:
+            log(
+                "%d turns in %.1fs (%.1f turns/s), %d conversations written",
+                len(active),
+                seconds,
+                len(active) / max(seconds, 1e-9),
+                num_written,
+            )
+        active = still_active
+
+
+def _start(
+    active: List[Tuple[str, TokenizedHistory]],
+    num_active: int,
+    seeds: Iterator[Tuple[str, List[str]]],
+    new_history: Callable[[], TokenizedHistory],
+    num_turns: int,
+    write: Callable[[str, List[str]], None],
+) -> int:
+    """Adds conversations from ``seeds`` to ``active`` until it has ``num_active``.
+
+    Returns:
+        the number of seeds that were written instead since they're long enough
+    """
+    num_written = 0
+    while len(active) < num_active:
+        convo_id, turns = next(seeds, (None, []))
+        if convo_id is None:
+            break
+        history = new_history()
+        for turn in turns[:num_turns]:
+            history.append(turn)
+        if len(history.turns) < num_turns:
+            active.append((convo_id, history))
+        else:
+            write(convo_id, history.turns)
+            num_written += 1
+    return num_written
+
+
+def _response(prediction: str, turn_prefixes: List[str]) -> str:
+    """Returns the response of either speaker that ``prediction`` starts with."""
+    # `postprocess_response` expects the second speaker to respond
+    return postprocess_response(prediction, turn_prefixes) or postprocess_response(
+        prediction, turn_prefixes[::-1]
+    )
+
+
+def _seeds(
+    seeds: Sequence[str],
+    seed_turns: int,
+    transcript_turn_prefixes: Sequence[str],
+    max_conversations: Optional[int] = None,
+) -> Iterator[Tuple[str, List[str]]]:
+    """Yields the ID and first ``seed_turns`` (non-empty) turns of each seed."""
+    num_seeds = 0
+    for convo_id, convo in read_conversations(seeds, transcript_turn_prefixes):
+        if max_conversations is not None and num_seeds >= max_conversations:
+            return
+        turns = [turn for turn in convo if turn.strip()][:seed_turns]
+        if turns:
+            yield convo_id, turns
+            num_seeds += 1
+
+
+def _transcript_path(output_dir: Path, convo_id: str) -> Path:
+    name = re.sub(r"[^\w.-]", "_", convo_id)  # e.g. "chitchat:validation:3"
+    return output_dir.joinpath(f"chat_{name}.txt")
+
+
+def _write_transcript(path: Path, turns: List[str], prefixes: List[str]) -> None:
+    # write to a temporary file first so a restarted run never skips a partial one
+    tmp = path.with_name(f".{path.name}")
+    transcript = TranscriptWriter(tmp, prefixes)
+    for turn in turns:
+        transcript.append(turn)
+    transcript.close()
+    tmp.replace(path)
+
+
+if __name__ == "__main__":
+    os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # disable tf C++ logging before importing
+    from conversational_ai import t5_model
+
+    t5_model.parse_gin_defaults_and_flags()
+    self_chat()
@@ -0,0 +1,204 @@
+"""HTTP server that batches concurrent chat requests to a trained T5 model.
+
+Usage: `python3 -m conversational_ai.serve --gin_file=serve.gin`
+"""
+import asyncio
+import collections
+import os
+import time
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Union
+
+import gin
+
+from conversational_ai.chat import build_model_input, postprocess_response
+from conversational_ai.instrumentation import mean, percentile
+
+
+class MicroBatcher:
+    """Groups concurrent predictions into a single call to ``predict``.
+
+    A batch is decoded as soon as ``max_batch_size`` requests are waiting or
+    ``max_wait`` seconds have passed since the first request in the batch arrived,
+    whichever comes first.
+    """
+
+    def __init__(
+        self,
+        predict: Callable[[List[str]], List[str]],
+        max_batch_size: int = 8,
+        max_wait: float = 0.01,
+        num_latencies: int = 1000,
+    ) -> None:
+        """Creates a new MicroBatcher; ``start`` must be called inside a loop."""
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # only created by `start`, since a queue is bound to the loop it's made in
+        self._queue: "Optional[asyncio.Queue[Tuple[str, asyncio.Future, float]]]"
+        self._queue = None
+        self._task: Optional[asyncio.Task] = None
+        self._batch_sizes: Deque[int] = collections.deque(maxlen=num_latencies)
+        self._latencies: Deque[float] = collections.deque(maxlen=num_latencies)
+        self._num_requests = 0
+
+    def start(self) -> None:
+        """Starts batching requests in the running event loop."""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        """Stops batching requests; requests that are still queued are cancelled."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        while self._queue is not None and not self._queue.empty():
+            self._queue.get_nowait()[1].cancel()
+
+    async def __call__(self, model_input: str) -> Tuple[str, float]:
+        """Returns the prediction for ``model_input`` and its latency in seconds."""
+        if self._queue is None:
+            raise RuntimeError("the MicroBatcher has not been started")
+        future = asyncio.get_event_loop().create_future()
+        start = time.perf_counter()
+        await self._queue.put((model_input, future, start))
+        prediction = await future
+        return prediction, time.perf_counter() - start
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns queue depth, batch size and latency statistics."""
+        latencies = sorted(self._latencies)
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "num_requests": self._num_requests,
+            "num_batches": len(self._batch_sizes),
+            "mean_batch_size": mean(self._batch_sizes),
+            "max_batch_size": self.max_batch_size,
+            "max_wait": self.max_wait,
+            "latency": {
+                "mean": mean(latencies),
+                **{f"p{q}": percentile(latencies, q) for q in [50, 90, 99]},
+            },
+        }
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._next_batch()
+            inputs = [model_input for model_input, _, _ in batch]
+            try:
+                # `predict` blocks, so run it in a thread to keep accepting requests
+                predictions = await loop.run_in_executor(None, self.predict, inputs)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            now = time.perf_counter()
+            self._num_requests += len(batch)
+            self._batch_sizes.append(len(batch))
+            for (_, future, start), prediction in zip(batch, predictions):
+                self._latencies.append(now - start)
+                if not future.done():
+                    future.set_result(prediction)
+
+    async def _next_batch(self) -> List[Tuple[str, asyncio.Future, float]]:
+        loop = asyncio.get_event_loop()
+        assert self._queue is not None, "the MicroBatcher has not been started"
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+
+@gin.configurable
+def serve(
+    model_dir: Optional[Union[str, Path]],
+    conversation_prefix: str,
+    turn_prefixes: List[str],
+    turn_suffix: str = "",
+    context_window: int = 100,
+    step: Optional[Union[int, str]] = "latest",
+    host: str = "0.0.0.0",
+    port: int = 8080,
+    max_batch_size: Optional[int] = None,
+    max_wait: float = 0.01,
+    stop_at_turn_prefixes: bool = False,
+) -> None:
+    """Serves the trained T5 model over HTTP.
+
+    ``POST /chat`` with ``{"history": ["Hello!", ...]}`` returns the model's next
+    turn as ``{"response": "...", "latency": 0.1}`` and ``GET /stats`` returns
+    ``MicroBatcher.stats()`` (and ``ResponseCache.stats()`` if there is a cache).
+    ``max_batch_size`` defaults to the batch size the model was compiled with,
+    since smaller batches are padded to it anyway. See ``chat_interactively`` for
+    ``stop_at_turn_prefixes``.
+    """
+    # sanic is an optional dependency so we don't add it to requirements.txt
+    from sanic import Sanic, response
+
+    # (in)directly import tf here so we can set TF_CPP_MIN_LOG_LEVEL in __main__ first
+    from conversational_ai import t5_model
+
+    if model_dir is None:
+        model_dir = gin.query_parameter("utils.run.model_dir")
+
+    predictor = t5_model.Predictor(str(model_dir), step=step)
+    if stop_at_turn_prefixes:
+        from conversational_ai import decoding
+
+        vocabulary = t5_model.utils.targets_vocabulary(predictor.vocabulary)
+        decoding.use_stop_sequences(
+            decoding.encode_stop_sequences(vocabulary, turn_prefixes)
+        )
+    batcher = MicroBatcher(predictor, max_batch_size or predictor.batch_size, max_wait)
+
+    app = Sanic("conversational_ai")
+
+    @app.listener("before_server_start")
+    async def start_batcher(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
+        batcher.start()
+
+    @app.listener("after_server_stop")
+    async def stop_batcher(app: Sanic, loop: asyncio.AbstractEventLoop) -> None:
+        await batcher.stop()
+        predictor.close()
+
+    @app.route("/chat", methods=["POST"])
+    async def chat(request: Any) -> Any:
+        history = (request.json or {}).get("history")
+        if not history or not all(isinstance(turn, str) for turn in history):
+            return response.json({"error": "`history` must be a list of str"}, 400)
+
+        model_input = build_model_input(
+            history, conversation_prefix, turn_prefixes, turn_suffix, context_window
+        )
+        prediction, latency = await batcher(model_input)
+        prediction = postprocess_response(prediction, turn_prefixes)
+        return response.json({"response": prediction, "latency": latency})
+
+    @app.route("/stats", methods=["GET"])
+    async def stats(request: Any) -> Any:
+        stats = batcher.stats()
+        if predictor.cache is not None:
+            stats["cache"] = predictor.cache.stats()
+        return response.json(stats)
+
+    app.run(host=host, port=port)
+
+
+if __name__ == "__main__":
+    os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # disable tf C++ logging before importing
+    from conversational_ai import t5_model
+
+    t5_model.parse_gin_defaults_and_flags()
+    serve()
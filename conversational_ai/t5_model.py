@@ -7,17 +7,22 @@ import ast
 import datetime
 import logging
 import platform
-import sys
+import queue
 import tempfile
+import threading
 from pathlib import Path
-from typing import Any, Callable, List, Optional, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import gin
+import numpy as np
 import pkg_resources
 import tensorflow.compat.v1 as tf
 from mesh_tensorflow.transformer import utils
 from t5.models.mtf_model import _get_latest_checkpoint_from_dir
 
+from conversational_ai import decoding, tasks
+from conversational_ai.response_cache import ResponseCache
+
 # HACK: figure out a better alternative to `RUN_TIMESTAMP` global variable?
 # hardcode the tz for now because some servers are in random timezones
 _tz = datetime.timezone(-datetime.timedelta(hours=6))
@@ -27,13 +32,6 @@ RUN_TIMESTAMP = datetime.datetime.now(tz=_tz).isoformat(timespec="milliseconds")
 def run(**kwargs) -> None:
     """Runs a T5 model for training, finetuning, evaluation etc."""
     tf.disable_v2_behavior()
-
-    if gin.query_parameter("utils.run.mode") == "eval":
-        # Increase the recursion limit, see: https://github.com/pltrdy/rouge/issues/19
-        length = gin.query_parameter("utils.run.sequence_length").get("inputs", 512)
-        batch_size = 1024  # TODO: do not hardcode batch_size for recursionlimit calc
-        sys.setrecursionlimit(batch_size * length + 10)
-
     utils.run(**kwargs)
 
 
@@ -46,7 +44,7 @@ def predict(
 ) -> List[str]:
     """Gets a prediction from the model."""
     if step == -1 or step == "latest":
-        step = _get_latest_checkpoint_from_dir(model_dir)
+        step = latest_checkpoint_step(model_dir)
 
     # HACK: use `decode` instead of `decode_from_file` (which `run` uses)
     with tempfile.TemporaryDirectory() as tmp:
@@ -71,6 +69,417 @@ def predict(
         return [ast.literal_eval(line.strip()).decode("utf-8") for line in outputs]
 
 
+_LATEST_CHECKPOINT_STEPS: Dict[str, int] = {}
+
+
+def latest_checkpoint_step(model_dir: str, refresh: bool = False) -> int:
+    """Returns the latest checkpoint step in ``model_dir``.
+
+    The result is cached per ``model_dir``, so the directory is only scanned again
+    when ``refresh`` is ``True`` (e.g. by ``Predictor`` when it watches for new
+    checkpoints).
+    """
+    if refresh or model_dir not in _LATEST_CHECKPOINT_STEPS:
+        _LATEST_CHECKPOINT_STEPS[model_dir] = _get_latest_checkpoint_from_dir(model_dir)
+    return _LATEST_CHECKPOINT_STEPS[model_dir]
+
+
+@gin.configurable
+class Predictor:
+    """A T5 model that stays loaded in memory between predictions.
+
+    ``predict`` rebuilds the graph and restores the checkpoint on every call; this
+    builds the graph, session and variables once (on the first call) and then
+    feeds every subsequent batch of inputs to the same ``estimator.predict``
+    generator.
+
+    If ``reload_interval`` is set (and ``step`` is ``"latest"``), ``model_dir`` is
+    checked for new checkpoints every ``reload_interval`` seconds in the
+    background. A new checkpoint is restored next to the current one and swapped
+    in once it is ready; requests that are already decoding finish on the old one.
+
+    If ``cache`` is given, responses are cached by model input, checkpoint path,
+    ``Bitransformer.decode`` parameters and stop sequences, but only when decoding
+    is deterministic (greedy or beam search).
+
+    ``hooks`` (``tf.train.SessionRunHook``) are passed to ``estimator.predict``,
+    e.g. to time building the graph and restoring the checkpoint.
+    """
+
+    def __init__(
+        self,
+        model_dir: str,
+        step: Optional[Union[int, str]] = None,
+        reload_interval: Optional[float] = None,
+        cache: Optional[ResponseCache] = None,
+        hooks: Optional[List[Any]] = None,
+        **kwargs,
+    ) -> None:
+        """Loads the model in ``model_dir`` at checkpoint ``step``."""
+        watch = reload_interval is not None and step in [None, -1, "latest"]
+        if step is None or step == -1 or step == "latest":
+            step = latest_checkpoint_step(model_dir)
+
+        self.model_dir = model_dir
+        self.decode_params = _decode_parameters()
+        self.cache = cache
+        if cache is not None and not _is_deterministic(self.decode_params):
+            tf.logging.warning("Not caching responses: decoding is not deterministic")
+            self.cache = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._session: Optional[_PredictorSession] = None
+        self._step = -1
+        self._num_decoded = 0
+        self._num_decoded_tokens = 0
+        self._hooks = hooks
+
+        with gin.unlock_config():
+            gin.bind_parameter("utils.run.mode", "infer")
+            gin.bind_parameter("utils.run.model_dir", model_dir)
+            gin.bind_parameter("utils.run.eval_checkpoint_step", step)
+            gin.bind_parameter("infer_model.decode_from_file_fn", self._start)
+
+        try:
+            # `utils.run` calls `self._start` with the estimator instead of decoding
+            run(**kwargs)
+        finally:
+            with gin.unlock_config():
+                gin.bind_parameter(
+                    "infer_model.decode_from_file_fn", utils.decode_from_file
+                )
+
+        if watch:
+            threading.Thread(
+                target=self._watch, args=(reload_interval,), daemon=True
+            ).start()
+
+    @property
+    def step(self) -> int:
+        """The step of the checkpoint that is (or was, if closed) used last."""
+        return self._step
+
+    @property
+    def deterministic(self) -> bool:
+        """Whether decoding is greedy or beam search (so samples are all the same)."""
+        return _is_deterministic(self.decode_params)
+
+    @property
+    def num_decoded_tokens(self) -> int:
+        """The number of tokens (including EOS) decoded so far, e.g. for throughput.
+
+        Only the outputs that are returned count, not the padding of a batch.
+        """
+        return self._num_decoded_tokens
+
+    def __call__(
+        self,
+        model_input: List[str],
+        on_tokens: Optional[Callable[[Any, Any], None]] = None,
+    ) -> List[str]:
+        """Gets a prediction from the model for each string in ``model_input``.
+
+        ``on_tokens`` is called with the ids of each decoding step of the inputs
+        that aren't cached (see ``decoding.on_tokens``).
+        """
+        if not model_input:
+            return []
+
+        with self._lock:
+            assert self._session is not None, "the predictor has been closed"
+            keys = [self._cache_key(inp, self._session) for inp in model_input]
+            outputs = [self.cache.get(k) if self.cache else None for k in keys]
+            misses = [inp for inp, out in zip(model_input, outputs) if out is None]
+            if misses:
+                input_ids = utils.encode_inputs(misses, **self._encode_kwargs)
+                with decoding.on_tokens(on_tokens):
+                    decoded = self._session.decode(input_ids)
+                self._count_tokens(decoded[: len(misses)])
+                results = iter(decoded)
+
+        for i, (inp, key) in enumerate(zip(model_input, keys)):
+            if outputs[i] is not None:
+                continue
+            outputs[i] = output = self._detokenize(next(results)["outputs"])
+            if self.cache is not None:
+                self.cache.put(key, output)
+            if self._num_decoded & (self._num_decoded - 1) == 0:
+                # log like `utils.decode` does so `tf_logging` filters still work
+                tf.logging.info("decoded {}: {}".format(self._num_decoded, inp))
+                tf.logging.info("            -> {}".format(output))
+            self._num_decoded += 1
+        return [output or "" for output in outputs]
+
+    def stream(self, model_input: str) -> Iterator[str]:
+        """Yields the prediction for ``model_input`` in pieces as it is decoded.
+
+        The pieces only come as the tokens are decoded if the graph was built after
+        ``decoding.emit_tokens``; otherwise (or if the response is cached) the
+        whole prediction comes at once. Stopping early doesn't stop the decoding,
+        which the next prediction waits for.
+        """
+        ids: "queue.Queue[Optional[int]]" = queue.Queue()
+        outputs: List[Any] = []
+
+        def decode() -> None:
+            try:
+                # the inputs are the first sequence of the (padded) batch
+                outputs.extend(self([model_input], lambda batch, _: ids.put(batch[0])))
+            except Exception as e:
+                outputs.append(e)
+            finally:
+                ids.put(None)
+
+        threading.Thread(target=decode, daemon=True).start()
+        vocab = utils.targets_vocabulary(self.vocabulary)
+        decoded: List[int] = []
+        text = ""
+        for token in iter(ids.get, None):
+            if token <= 1:  # padding or EOS
+                continue
+            decoded.append(int(token))
+            # detokenize all of it since pieces can change how their neighbors decode
+            new_text = vocab.decode(decoded)
+            if new_text.startswith(text) and len(new_text) > len(text):
+                yield new_text[len(text) :]
+                text = new_text
+        if isinstance(outputs[0], Exception):
+            raise outputs[0]
+        if outputs[0].startswith(text) and len(outputs[0]) > len(text):
+            yield outputs[0][len(text) :]
+
+    def sample(
+        self, model_input: str, num_samples: int
+    ) -> List[Tuple[str, float, int]]:
+        """Decodes ``num_samples`` predictions for ``model_input`` in one batch.
+
+        Returns:
+            each prediction, its log-likelihood under the model (summed over its
+            tokens, including EOS) and its number of tokens; the log-likelihoods
+            are only known if the graph was built after ``decoding.emit_tokens``
+            (and aren't for beam search), otherwise they are 0
+        """
+        if not 0 < num_samples <= self.batch_size:
+            raise ValueError(
+                f"num_samples must be between 1 and the batch size {self.batch_size}"
+            )
+        log_likelihoods = np.zeros(self.batch_size)
+        num_tokens = np.zeros(self.batch_size, dtype=np.int64)
+
+        def add(ids: np.ndarray, log_probs: np.ndarray) -> None:
+            if len(ids) == self.batch_size:  # else the batch is split over devices
+                log_likelihoods[:] += log_probs * (ids > 0)
+                num_tokens[:] += ids > 0
+
+        input_ids = utils.encode_inputs([model_input], **self._encode_kwargs)
+        with self._lock:
+            assert self._session is not None, "the predictor has been closed"
+            with decoding.on_tokens(add):
+                results = self._session.decode([input_ids[0]] * self.batch_size)
+            self._count_tokens(results[:num_samples])
+        return [
+            (
+                self._detokenize(r["outputs"]),
+                float(log_likelihoods[i]),
+                int(num_tokens[i]),
+            )
+            for i, r in enumerate(results[:num_samples])
+        ]
+
+    def decode_ids(self, input_ids: Any) -> List[str]:
+        """Decodes inputs that are already tokenized and padded (but not cached)."""
+        num_inputs = len(input_ids)
+        if not num_inputs:
+            return []
+        # pad to a whole number of batches like `utils.encode_inputs` does
+        padding = [input_ids[0]] * (-num_inputs % self.batch_size)
+        with self._lock:
+            assert self._session is not None, "the predictor has been closed"
+            results = self._session.decode([*input_ids, *padding])
+            self._count_tokens(results[:num_inputs])
+        return [self._detokenize(r["outputs"]) for r in results[:num_inputs]]
+
+    def reload(self, checkpoint_path: str) -> None:
+        """Swaps in the checkpoint at ``checkpoint_path`` once it is restored.
+
+        Does nothing if the predictor is closed in the meantime.
+        """
+        session = _PredictorSession(
+            self._estimator,
+            self.batch_size,
+            self.sequence_length,
+            checkpoint_path,
+            self._hooks,
+            live=False,  # keep the warm-up's ids from the `on_tokens` callbacks
+        )
+        try:
+            # decode a batch to build the graph and restore the checkpoint up front
+            session.decode(utils.encode_inputs([""], **self._encode_kwargs))
+        except Exception:
+            session.close()
+            raise
+        with self._lock:
+            if self._stopped.is_set():  # closed while restoring
+                session.close()
+                return
+            old_session, self._session = self._session, session
+            self._step = session.step
+            session.live = True
+        if old_session is not None:
+            old_session.close()
+        tf.logging.info("Reloaded predictor from {}".format(checkpoint_path))
+
+    def close(self) -> None:
+        """Stops the underlying ``estimator.predict`` generator and saves the cache."""
+        self._stopped.set()
+        if self.cache is not None:
+            self.cache.save()
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def _start(
+        self,
+        estimator: Any,
+        vocabulary: Any,
+        model_type: str,
+        batch_size: int,
+        sequence_length: Dict[str, int],
+        checkpoint_path: str,
+        **kwargs,
+    ) -> None:
+        self._estimator = estimator
+        self.vocabulary = vocabulary
+        self.model_type = model_type
+        self.batch_size = batch_size
+        self.sequence_length = sequence_length
+        self._session = _PredictorSession(
+            estimator, batch_size, sequence_length, checkpoint_path, self._hooks
+        )
+        self._step = self._session.step
+
+    @property
+    def _encode_kwargs(self) -> Dict[str, Any]:
+        return dict(
+            vocabulary=self.vocabulary,
+            model_type=self.model_type,
+            batch_size=self.batch_size,
+            sequence_length=self.sequence_length["inputs"],
+        )
+
+    def _cache_key(self, model_input: str, session: "_PredictorSession") -> str:
+        return ResponseCache.key(
+            model_input,
+            session.checkpoint_path,
+            self.decode_params,
+            decoding.stop_sequences(),
+        )
+
+    def _watch(self, interval: float) -> None:
+        for checkpoint_path in tf.train.checkpoints_iterator(
+            self.model_dir,
+            min_interval_secs=interval,
+            timeout=interval,
+            timeout_fn=self._stopped.is_set,
+        ):
+            if self._stopped.is_set():
+                break
+            try:
+                step = utils.get_step_from_checkpoint_path(checkpoint_path)
+                _LATEST_CHECKPOINT_STEPS[self.model_dir] = step
+                if step > self.step:
+                    self.reload(checkpoint_path)
+            except Exception as e:  # e.g. deleted by `keep_checkpoint_max` by now
+                tf.logging.error(
+                    "Failed to reload predictor from {}: {!r}".format(
+                        checkpoint_path, e
+                    )
+                )
+
+    def _count_tokens(self, results: List[Dict[str, Any]]) -> None:
+        for r in results:
+            if not isinstance(r["outputs"], bytes):  # else it's already detokenized
+                self._num_decoded_tokens += int(np.count_nonzero(r["outputs"]))
+
+    def _detokenize(self, value: Any) -> str:
+        if isinstance(value, bytes):
+            return value.decode("utf-8")
+        vocab = utils.targets_vocabulary(self.vocabulary)
+        return vocab.decode([int(x) for x in value])
+
+
+def _decode_parameters() -> Dict[str, Any]:
+    """Returns the ``Bitransformer.decode`` parameters that are bound in gin."""
+    params = {}
+    for name in [
+        "beam_size",
+        "alpha",
+        "temperature",
+        "decode_length_multiplier",
+        "decode_length_constant",
+        "max_decode_length",
+    ]:
+        try:
+            params[name] = gin.query_parameter(f"Bitransformer.decode.{name}")
+        except ValueError:
+            pass  # not bound so the default is used
+    return params
+
+
+def _is_deterministic(decode_params: Dict[str, Any]) -> bool:
+    """Returns whether decoding is greedy or beam search (i.e. not sampling)."""
+    beam_size = decode_params.get("beam_size", 1)
+    return beam_size > 1 or decode_params.get("temperature", 0.0) == 0.0
+
+
+class _PredictorSession:
+    """An ``estimator.predict`` generator restored from a single checkpoint."""
+
+    def __init__(
+        self,
+        estimator: Any,
+        batch_size: int,
+        sequence_length: Dict[str, int],
+        checkpoint_path: str,
+        hooks: Optional[List[Any]] = None,
+        live: bool = True,
+    ) -> None:
+        self.checkpoint_path = checkpoint_path
+        self.step = utils.get_step_from_checkpoint_path(checkpoint_path)
+        # whether decoding passes its ids to the `decoding.on_tokens` callbacks
+        self.live = live
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+
+        def input_fn(params: Dict[str, Any]) -> tf.data.Dataset:
+            del params
+            dataset = tf.data.Dataset.from_generator(
+                lambda: iter(self._queue.get, None),
+                output_types={"inputs": tf.int32},
+                output_shapes={"inputs": tf.TensorShape([sequence_length["inputs"]])},
+            )
+            return dataset.batch(batch_size, drop_remainder=True)
+
+        self._results = estimator.predict(
+            input_fn, checkpoint_path=checkpoint_path, hooks=hooks
+        )
+
+    def decode(self, input_ids: Iterable[Any]) -> List[Dict[str, Any]]:
+        """Decodes ``input_ids``, which must be padded to a whole batch."""
+        num_inputs = 0
+        for ids in input_ids:
+            self._queue.put({"inputs": ids})
+            num_inputs += 1
+        # the graph is built by the first call, so this gates its ids from then on
+        with decoding.token_gate(lambda: self.live):
+            # always read a whole batch so no results are left over for later calls
+            return [next(self._results) for _ in range(num_inputs)]
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._results.close()
+
+
 @gin.configurable
 def logging_file_handler(filename: str, **kwargs) -> logging.FileHandler:
     """Returns a ``logging.FileHandler``."""
@@ -84,6 +493,7 @@ def logging_filter_log_records_for_chat(record: Any) -> bool:
         record.msg.startswith("decoded")
         or record.msg.startswith("            ->")
         or record.msg.startswith("Restoring parameters from")
+        or record.msg.startswith("Reloaded predictor from")
     )
 
 
@@ -130,6 +540,12 @@ def parse_gin_defaults_and_flags() -> None:
     with gin.unlock_config():
         gin.bind_parameter("utils.run.model_dir", model_dir)
 
+    # only build the task or mixture that is used (e.g. by the vocabulary)
+    try:
+        tasks.register(gin.query_parameter("%MIXTURE_NAME"))
+    except ValueError:
+        pass  # no MIXTURE_NAME, e.g. a model that wasn't trained on our tasks
+
     tf_logging()
 
 
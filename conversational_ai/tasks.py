@@ -1,62 +1,134 @@
 """Tasks for training a T5 model.
 
 https://github.com/google-research/text-to-text-transfer-transformer
+
+Tasks and mixtures are only added to T5's registries by ``register`` (which
+``parse_gin_defaults_and_flags`` calls with ``MIXTURE_NAME``), so importing this
+module doesn't import TensorFlow or T5 or build tasks that aren't used.
 """
 import functools
+from typing import Any, Callable, Dict, List
+
+
+def register(mixture_or_task_name: str) -> None:
+    """Registers one of our tasks or mixtures (and its tasks) with T5.
+
+    Does nothing if it's already registered or isn't one of ours (e.g. a task
+    from ``t5.data.tasks``).
+    """
+    import t5
+
+    if mixture_or_task_name in t5.data.TaskRegistry.names():
+        return
+    if mixture_or_task_name in t5.data.MixtureRegistry.names():
+        return
+
+    if mixture_or_task_name in _MIXTURES:
+        for task_name in _MIXTURES[mixture_or_task_name]:
+            register(task_name)
+        t5.data.MixtureRegistry.add(
+            mixture_or_task_name,
+            tasks=_MIXTURES[mixture_or_task_name],
+            default_rate=t5.data.utils.rate_num_examples,  # uses `CachedTask` stats
+        )
+    elif mixture_or_task_name in _TASKS:
+        add_task = _TASKS[mixture_or_task_name]
+        add_task(mixture_or_task_name)
+
+
+def register_all() -> None:
+    """Registers all of our tasks and mixtures with T5."""
+    for name in names():
+        register(name)
+
+
+def names() -> List[str]:
+    """Returns the names of all of our tasks and mixtures."""
+    return [*_TASKS, *_MIXTURES]
+
+
+# the 256 input tokens of `finetune.gin`, less the prefix and EOS tokens, so the
+# oldest turns are dropped instead of the inputs being truncated
+_MAX_INPUT_TOKENS = 248
+
+
+def _add_task(name: str, **kwargs: Any) -> None:
+    import t5
+
+    from conversational_ai import metrics
+    from conversational_ai.dataset.cache import CachedTask
+
+    t5.data.TaskRegistry.add(
+        name,
+        CachedTask,
+        splits=["train", "validation"],
+        postprocess_fn=t5.data.postprocessors.lower_text,
+        sentencepiece_model_path=t5.data.DEFAULT_SPM_PATH,
+        **{
+            "metric_fns": [
+                t5.evaluation.metrics.accuracy,
+                metrics.bleu,
+                metrics.rouge,
+            ],
+            **kwargs,
+        },
+    )
+
+
+def _add_chitchat_v001_nsp(name: str) -> None:
+    import t5
+
+    from conversational_ai.dataset import chitchat
+
+    _add_task(
+        name,
+        source_files=[chitchat.DATA_PATH],
+        dataset_fn=functools.partial(
+            chitchat.dataset,
+            generator=functools.partial(
+                chitchat.generate_conversations_as_str, turn_suffix="\n"
+            ),
+            keys=["text"],
+        ),
+        text_preprocessor=t5.data.preprocessors.next_sentence_prediction,
+        metric_fns=[t5.evaluation.metrics.accuracy],
+    )
+
+
+def _add_chitchat_v002_compounding(name: str) -> None:
+    import t5
 
-import chitchat_dataset as ccc
-import t5
-
-from conversational_ai.dataset import chitchat, generic
-
-t5.data.TaskRegistry.add(
-    "chitchat_v001_nsp",
-    t5.data.Task,
-    dataset_fn=functools.partial(
-        chitchat.dataset,
-        generator=lambda: ({"text": "\n".join(c)} for c in ccc.ConversationDataset()),
-        keys=["text"],
-        num_train=6952,
-    ),
-    splits=["train", "validation"],
-    text_preprocessor=t5.data.preprocessors.next_sentence_prediction,
-    postprocess_fn=t5.data.postprocessors.lower_text,
-    metric_fns=[t5.evaluation.metrics.accuracy],
-    sentencepiece_model_path=t5.data.DEFAULT_SPM_PATH,
-)
-
-
-t5.data.TaskRegistry.add(
-    "chitchat_v002_compounding",
-    t5.data.Task,
-    dataset_fn=functools.partial(
-        chitchat.dataset,
-        generator=functools.partial(
-            chitchat.generate_compounding_conversations,
-            # `<` is not in the vocab...
-            first_speaker_token="speaker1> ",
-            second_speaker_token="speaker2> ",
+    from conversational_ai.dataset import chitchat, utils
+
+    _add_task(
+        name,
+        source_files=[chitchat.DATA_PATH],
+        dataset_fn=functools.partial(
+            chitchat.dataset,
+            generator=functools.partial(
+                chitchat.generate_compounding_conversations,
+                # `<` is not in the vocab...
+                first_speaker_token="speaker1> ",
+                second_speaker_token="speaker2> ",
+                prefix="converse: ",
+                max_input_length=_MAX_INPUT_TOKENS,
+                count_tokens=utils.TokenCounter(t5.data.DEFAULT_SPM_PATH),
+            ),
+            keys=["inputs", "targets"],
             end_of_utterance_token=" ",  # TODO: change `end_of_utterance_token`
-            prefix="converse: ",
         ),
-        keys=["inputs", "targets"],
-        num_train=124_990,
-    ),
-    splits=["train", "validation"],
-    text_preprocessor=None,
-    postprocess_fn=t5.data.postprocessors.lower_text,
-    metric_fns=[
-        t5.evaluation.metrics.accuracy,
-        t5.evaluation.metrics.bleu,
-        t5.evaluation.metrics.rouge,
-    ],
-    sentencepiece_model_path=t5.data.DEFAULT_SPM_PATH,
-)
+        text_preprocessor=None,
+    )
 
-for dataset_name in ["dailydialog", "convai2"]:
-    t5.data.TaskRegistry.add(
-        f"{dataset_name}_v002_compounding",
-        t5.data.Task,
+
+def _add_generic_v002_compounding(dataset_name: str, name: str) -> None:
+    import t5
+
+    from conversational_ai.dataset import generic, utils
+
+    _add_task(
+        name,
+        source_files=[f"./data/{dataset_name}"],
         dataset_fn=functools.partial(
             generic.dataset,
             generator=functools.partial(
@@ -64,53 +136,52 @@ for dataset_name in ["dailydialog", "convai2"]:
                 # `<` is not in the vocab...
                 first_speaker_token="speaker1> ",
                 second_speaker_token="speaker2> ",
-                end_of_utterance_token=" ",  # TODO: change `end_of_utterance_token`
                 prefix="converse: ",
+                max_input_length=_MAX_INPUT_TOKENS,
+                count_tokens=utils.TokenCounter(t5.data.DEFAULT_SPM_PATH),
             ),
             keys=["inputs", "targets"],
             data_dir=f"./data/{dataset_name}",
+            end_of_utterance_token=" ",  # TODO: change `end_of_utterance_token`
         ),
-        splits=["train", "validation"],
         text_preprocessor=None,
-        postprocess_fn=t5.data.postprocessors.lower_text,
-        metric_fns=[
-            t5.evaluation.metrics.accuracy,
-            t5.evaluation.metrics.bleu,
-            t5.evaluation.metrics.rouge,
-        ],
-        sentencepiece_model_path=t5.data.DEFAULT_SPM_PATH,
     )
 
-t5.data.TaskRegistry.add(
-    "chitchat_v003_prefix_lm",
-    t5.data.Task,
-    dataset_fn=functools.partial(
-        chitchat.dataset,
-        generator=functools.partial(
-            chitchat.generate_conversations_as_str,
-            prefix="",
-            suffix="",
-            turn_prefixes=["speaker1> ", "speaker2> "],  # `<` is not in the vocab...
-            turn_suffix="\t",
+
+def _add_chitchat_v003_prefix_lm(name: str) -> None:
+    import t5
+
+    from conversational_ai.dataset import chitchat
+
+    _add_task(
+        name,
+        source_files=[chitchat.DATA_PATH],
+        dataset_fn=functools.partial(
+            chitchat.dataset,
+            generator=functools.partial(
+                chitchat.generate_conversations_as_str,
+                prefix="",
+                suffix="",
+                turn_prefixes=[
+                    "speaker1> ",
+                    "speaker2> ",
+                ],  # `<` is not in the vocab...
+                turn_suffix="\t",
+            ),
+            keys=["text"],
         ),
-        keys=["text"],
-        num_train=6952,
-    ),
-    splits=["train", "validation"],
-    text_preprocessor=t5.data.preprocessors.prefix_lm,
-    postprocess_fn=t5.data.postprocessors.lower_text,
-    metric_fns=[
-        t5.evaluation.metrics.accuracy,
-        t5.evaluation.metrics.bleu,
-        t5.evaluation.metrics.rouge,
-    ],
-    sentencepiece_model_path=t5.data.DEFAULT_SPM_PATH,
-)
+        text_preprocessor=t5.data.preprocessors.prefix_lm,
+    )
 
-for dataset_name in ["dailydialog", "convai2"]:
-    t5.data.TaskRegistry.add(
-        f"{dataset_name}_v003_prefix_lm",
-        t5.data.Task,
+
+def _add_generic_v003_prefix_lm(dataset_name: str, name: str) -> None:
+    import t5
+
+    from conversational_ai.dataset import generic
+
+    _add_task(
+        name,
+        source_files=[f"./data/{dataset_name}"],
         dataset_fn=functools.partial(
             generic.dataset,
             generator=functools.partial(
@@ -126,22 +197,31 @@ for dataset_name in ["dailydialog", "convai2"]:
             keys=["text"],
             data_dir=f"./data/{dataset_name}",
         ),
-        splits=["train", "validation"],
         text_preprocessor=t5.data.preprocessors.prefix_lm,
-        postprocess_fn=t5.data.postprocessors.lower_text,
-        metric_fns=[
-            t5.evaluation.metrics.accuracy,
-            t5.evaluation.metrics.bleu,
-            t5.evaluation.metrics.rouge,
-        ],
-        sentencepiece_model_path=t5.data.DEFAULT_SPM_PATH,
     )
 
 
-t5.data.MixtureRegistry.add(
-    "chitchat_dailydialog_v003_prefix_lm",
-    tasks=["chitchat_v003_prefix_lm", "dailydialog_v003_prefix_lm"],
-    # TODO: figure out rate based on dataset length
-    # default_rate=t5.data.utils.rate_num_examples,
-    default_rate=1.0,
-)
+_TASKS: Dict[str, Callable[[str], None]] = {
+    "chitchat_v001_nsp": _add_chitchat_v001_nsp,
+    "chitchat_v002_compounding": _add_chitchat_v002_compounding,
+    **{
+        f"{dataset_name}_v002_compounding": functools.partial(
+            _add_generic_v002_compounding, dataset_name
+        )
+        for dataset_name in ["dailydialog", "convai2"]
+    },
+    "chitchat_v003_prefix_lm": _add_chitchat_v003_prefix_lm,
+    **{
+        f"{dataset_name}_v003_prefix_lm": functools.partial(
+            _add_generic_v003_prefix_lm, dataset_name
+        )
+        for dataset_name in ["dailydialog", "convai2"]
+    },
+}
+
+_MIXTURES: Dict[str, List[str]] = {
+    "chitchat_dailydialog_v003_prefix_lm": [
+        "chitchat_v003_prefix_lm",
+        "dailydialog_v003_prefix_lm",
+    ],
+}
@@ -0,0 +1,42 @@
+"""Tests for the ``conversational_ai.batch_infer`` module."""
+import json
+from pathlib import Path
+
+from conversational_ai.batch_infer import _completed_ids, _examples
+
+
+def test_examples(tmp_path: Path) -> None:
+    """Tests that ``_examples`` builds a prompt for each turn of the second speaker."""
+    tmp_path.joinpath("chat_1.txt").write_text(
+        "human: a b c\nmodel: d\nhuman: e f\nmodel: g h i j\n"
+    )
+    tmp_path.joinpath("convos.jsonl").write_text(
+        json.dumps({"id": 7, "history": ["k"]})
+    )
+    history_kwargs = dict(
+        encode=str.split,
+        max_tokens=100,
+        conversation_prefix="p:",
+        turn_prefixes=["s1> ", "s2> "],
+        turn_suffix=" ",
+    )
+    inputs = [str(tmp_path), str(tmp_path.joinpath("convos.jsonl"))]
+    examples = _examples(inputs, history_kwargs, True, ["human: ", "model: "])
+    assert [(ex["id"], ex["input"], ex["reference"]) for ex in examples] == [
+        ("7:1", "p:s1> k", None),
+        ("chat_1:1", "p:s1> a b c", "d"),
+        ("chat_1:3", "p:s1> a b c s2> d s1> e f", "g h i j"),
+    ]
+    assert [ex["num_tokens"] for ex in examples] == [3, 5, 10]
+
+    examples = _examples(inputs[:1], history_kwargs, False, ["human: ", "model: "])
+    assert [ex["id"] for ex in examples] == ["chat_1:4"]
+
+
+def test_completed_ids(tmp_path: Path) -> None:
+    """Tests that ``_completed_ids`` removes a partially written last line."""
+    path = tmp_path.joinpath("output.jsonl")
+    assert _completed_ids(path) == set()
+    path.write_text('{"id": "a:1"}\n{"id": "a:3"}\n{"id": "b')
+    assert _completed_ids(path) == {"a:1", "a:3"}
+    assert path.read_text() == '{"id": "a:1"}\n{"id": "a:3"}\n'
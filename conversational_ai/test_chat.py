@@ -1,10 +1,15 @@
 """Tests for the ``conversational_ai.chat`` module."""
 
-from conversational_ai.chat import _postprocess_response
+from conversational_ai.chat import (
+    TokenizedHistory,
+    _rerank,
+    _stream_response,
+    postprocess_response,
+)
 
 
 def test_postprocess_response() -> None:
-    """Tests ``_postprocess_response``."""
+    """Tests ``postprocess_response``."""
     for input_txt, expected_result in [
         (
             "AdLab I need to start working on a project im interested in so Im gonna "
@@ -25,5 +30,57 @@ def test_postprocess_response() -> None:
             "hahaha am I just going to take that as a no.... Hope you have a good day",
         ),
     ]:
-        actual_result = _postprocess_response(input_txt, ["speaker1>", "speaker2>"])
+        actual_result = postprocess_response(input_txt, ["speaker1>", "speaker2>"])
         assert actual_result == expected_result
+
+
+def test_tokenized_history() -> None:
+    """Tests that ``TokenizedHistory`` keeps the most recent turns that fit."""
+    encoded = []
+
+    def encode(text: str) -> list:
+        encoded.append(text)
+        return text.split()
+
+    history = TokenizedHistory(encode, 12, "prefix:", ["s1> ", "s2>  a b "], " ")
+    for turn in ["hi", "hello there", "how are you"]:
+        history.append(turn)
+    num_encoded = len(encoded)
+
+    # 2 + 3 + 6 tokens fit but adding "hi" flips the prefixes: 2 + 2 + 5 + 4 > 12
+    assert history.model_input() == "prefix:s1> hello there s2>  a b how are you"
+    assert len(encoded) == num_encoded
+    assert history.num_input_tokens == 2 + 3 + 6
+
+    history.append("a very long turn that does not fit")
+    assert history.model_input() == "prefix:s1> a very long turn that does not fit"
+    assert history.num_input_tokens == 2 + 9
+
+
+def test_stream_response() -> None:
+    """Tests that ``_stream_response`` streams the response up to a turn prefix."""
+    turn_prefixes = ["speaker1>", "speaker2>"]
+    pieces = ["spe", "aker2> Hel", "lo :) ", "how are", " you? spea", "ker1> ok"]
+    streamed = list(_stream_response(pieces, turn_prefixes))
+    assert streamed == ["Hel", "lo :)", " how are", " you?"]
+    assert "".join(streamed) == postprocess_response("".join(pieces), turn_prefixes)
+
+    # the prefix is held back until it's clear it's not one
+    streamed = list(_stream_response(["Hi speak", "ers!"], turn_prefixes))
+    assert streamed == ["Hi", " speakers!"]
+
+
+def test_rerank() -> None:
+    """Tests that ``_rerank`` prefers likely responses that weren't said before."""
+    turn_prefixes = ["speaker1>", "speaker2>"]
+    candidates = [
+        ("I'm doing great! How are you? speaker1> good", -2.0, 10),
+        ("Pretty good, I just got back from a run.", -6.0, 12),
+        ("speaker1> what?", -0.1, 3),
+    ]
+    previous = ["Hi!", "i'm doing  GREAT! how are you?"]
+    assert _rerank(candidates, turn_prefixes, []) == "I'm doing great! How are you?"
+    assert _rerank(candidates, turn_prefixes, previous) == (
+        "Pretty good, I just got back from a run."
+    )
+    assert _rerank(candidates[2:], turn_prefixes, previous) == ""
@@ -0,0 +1,52 @@
+"""Tests for the ``conversational_ai.decoding`` module."""
+import pytest
+
+
+def test_has_stopped_ignores_opening_stop_sequence() -> None:
+    """Tests that a response may start with a stop sequence (e.g. its own prefix)."""
+    mtf = pytest.importorskip("mesh_tensorflow")
+    tf = pytest.importorskip("tensorflow.compat.v1")
+    from conversational_ai import decoding
+
+    # a one token prompt (5) and then the "generated" tokens with stop sequence 7 8
+    ids = [[5, 7, 8, 9, 7, 8, 0, 0], [5, 9, 7, 8, 0, 0, 0, 0]]
+    decoding.use_stop_sequences([[7, 8]])
+    try:
+        with tf.Graph().as_default():
+            graph = mtf.Graph()
+            mesh = mtf.Mesh(graph, "mesh")
+            batch_dim = mtf.Dimension("batch", len(ids))
+            length_dim = mtf.Dimension("length", len(ids[0]))
+            mtf_ids = mtf.import_tf_tensor(
+                mesh, tf.constant(ids), shape=mtf.Shape([batch_dim, length_dim])
+            )
+            initial_position = mtf.import_tf_tensor(
+                mesh, tf.constant([1, 1]), shape=mtf.Shape([batch_dim])
+            )
+            stopped = [
+                decoding._has_stopped(
+                    mtf_ids,
+                    mtf.constant(mesh, position, dtype=tf.int32),
+                    initial_position,
+                    stop_at_token=1,
+                )
+                for position in range(1, 6)
+            ]
+            mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+                shape=[], layout={}, devices=[""]
+            )
+            lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+            outputs = [lowering.export_to_tf_tensor(s) for s in stopped]
+            with tf.Session() as sess:
+                stopped_at = sess.run(outputs)
+    finally:
+        decoding.use_stop_sequences([])
+
+    # the first sequence only stops at the second 7 8, the second at the first one
+    assert [list(s) for s in stopped_at] == [
+        [0, 0],
+        [0, 0],
+        [0, 1],
+        [0, 0],
+        [1, 0],
+    ]
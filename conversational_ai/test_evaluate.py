@@ -0,0 +1,33 @@
+"""Tests for the ``conversational_ai.evaluate`` module."""
+import json
+from pathlib import Path
+
+from conversational_ai.evaluate import _Ledger
+
+
+def test_ledger(tmp_path: Path) -> None:
+    """Tests that ``_Ledger`` persists results and drops a partial last task."""
+    ledger = _Ledger(tmp_path)
+    assert ledger.results == []
+    ledger.add(100, "a", {"bleu": 1.0, "accuracy": 50})
+    ledger.add(100, "b", {"bleu": 2.0})
+    assert ledger.is_done(100, "a") and not ledger.is_done(200, "a")
+
+    ledger = _Ledger(tmp_path)
+    assert ledger.is_done(100, "a") and ledger.is_done(100, "b")
+    assert [(r["task"], r["metric"], r["value"]) for r in ledger.results] == [
+        ("a", "accuracy", 50.0),
+        ("a", "bleu", 1.0),
+        ("b", "bleu", 2.0),
+    ]
+
+    complete = ledger.path.read_text()
+    partial = {"step": 200, "task": "a", "metric": "accuracy", "value": 60.0}
+    with ledger.path.open("a") as f:
+        f.write(json.dumps(partial) + "\n" + json.dumps(partial)[:20])
+    ledger = _Ledger(tmp_path)
+    assert not ledger.is_done(200, "a")
+    assert len(ledger.results) == 3
+    assert ledger.path.read_text() == complete
+    ledger.add(200, "a", {"accuracy": 60.0})
+    assert _Ledger(tmp_path).is_done(200, "a")
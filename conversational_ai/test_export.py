@@ -0,0 +1,14 @@
+"""Tests for the ``conversational_ai.export`` module."""
+import numpy as np
+
+from conversational_ai.export import _quantize_int8
+
+
+def test_quantize_int8() -> None:
+    """Tests that each output channel is scaled to the int8 range."""
+    weight = np.array([[0.5, -2.0, 0.0], [-1.0, 1.0, 0.0]], dtype=np.float32)
+    values, scale = _quantize_int8(weight)
+    assert values.dtype == np.int8
+    assert values.tolist() == [[64, -127, 0], [-127, 64, 0]]
+    assert scale.tolist() == [np.float32(1.0 / 127), np.float32(2.0 / 127), 1.0]
+    np.testing.assert_allclose(values * scale, weight, atol=scale.max() / 2)
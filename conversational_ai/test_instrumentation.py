@@ -0,0 +1,29 @@
+"""Tests for the ``conversational_ai.instrumentation`` module."""
+import json
+from pathlib import Path
+
+from conversational_ai.instrumentation import TurnRecorder
+
+
+def test_turn_recorder(tmp_path: Path) -> None:
+    """Tests that ``TurnRecorder`` splits and adds up spans and writes each turn."""
+    recorder = TurnRecorder(tmp_path.joinpath("metrics", "chat.jsonl"))
+    for _ in range(2):
+        with recorder.span("tokenize"):
+            pass
+        with recorder.span("decode"):
+            recorder.split("restore")  # like the hook on the first decode
+        recorder.split("outside")  # ignored outside of a span
+        with recorder.span("tokenize"):
+            pass
+        recorder.add(decoded_tokens=3)
+        recorder.end_turn()
+
+    lines = tmp_path.joinpath("metrics", "chat.jsonl").read_text().splitlines()
+    turns = [json.loads(line) for line in lines]
+    assert turns == recorder.turns
+    assert [t["turn"] for t in turns] == [0, 1]
+    assert sorted(turns[0]["spans"]) == ["decode", "restore", "tokenize"]
+    assert all(s["peak_rss_mb"] > 0 for s in turns[0]["spans"].values())
+    assert turns[1]["decoded_tokens"] == 3
+    assert "decoded tokens/s" in recorder.summary()
@@ -0,0 +1,79 @@
+"""Tests for the ``conversational_ai.metrics`` module."""
+import inspect
+import random
+
+import numpy as np
+import pytest
+import sacrebleu
+
+from conversational_ai import metrics
+
+
+def _random_texts(rng: random.Random, num_texts: int) -> list:
+    words = ["a", "b", "the", "cat", "sat", "on", "mat", ".", ",", "!", "it's", "CAT"]
+    return [
+        " ".join(rng.choice(words) for _ in range(rng.randint(0, 30)))
+        for _ in range(num_texts)
+    ]
+
+
+def test_bleu() -> None:
+    """Tests that ``bleu`` matches ``sacrebleu.corpus_bleu`` like T5 uses it."""
+    rng = random.Random(0)
+    targets, predictions = _random_texts(rng, 2500), _random_texts(rng, 2500)
+    expected = sacrebleu.corpus_bleu(
+        predictions,
+        [targets],
+        smooth_method="exp",
+        smooth_value=0.0,
+        force=False,
+        lowercase=False,
+        tokenize="intl",
+        use_effective_order=False,
+    ).score
+    actual = metrics.bleu(targets, predictions, num_workers=2)["bleu"]
+    assert actual == pytest.approx(expected)
+
+
+def test_rouge() -> None:
+    """Tests that ``rouge`` matches the mean ``rouge_score`` F-measures."""
+    rouge_scorer = pytest.importorskip("rouge_score.rouge_scorer")
+
+    rng = random.Random(0)
+    targets, predictions = _random_texts(rng, 200), _random_texts(rng, 200)
+    keys = ["rouge1", "rouge2", "rougeL", "rougeLsum"]
+    scorer = rouge_scorer.RougeScorer(keys)
+    expected = {
+        k: np.mean(
+            [
+                scorer.score(t.replace(" . ", " .\n"), p.replace(" . ", " .\n"))[
+                    k
+                ].fmeasure
+                for t, p in zip(targets, predictions)
+            ]
+        )
+        * 100
+        for k in keys
+    }
+    assert metrics.rouge(targets, predictions, keys) == pytest.approx(expected)
+
+
+def test_metric_fns_of_task() -> None:
+    """Tests that T5 accepts ``bleu`` and ``rouge`` as the metrics of a task."""
+    for fn in [metrics.bleu, metrics.rouge]:
+        # what `Task` checks, e.g. decorators can hide it
+        assert inspect.getfullargspec(fn).args[:2] == ["targets", "predictions"]
+    t5 = pytest.importorskip("t5")
+
+    def dataset_fn(split: str, shuffle_files: bool) -> None:
+        del split, shuffle_files
+
+    task = t5.data.Task(
+        "test_metric_fns_of_task",
+        dataset_fn=dataset_fn,
+        splits=["validation"],
+        text_preprocessor=None,
+        sentencepiece_model_path=t5.data.DEFAULT_SPM_PATH,
+        metric_fns=[metrics.bleu, metrics.rouge],
+    )
+    assert task.metric_fns == [metrics.bleu, metrics.rouge]
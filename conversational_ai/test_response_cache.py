@@ -0,0 +1,41 @@
+"""Tests for the ``conversational_ai.response_cache`` module."""
+from pathlib import Path
+
+from conversational_ai.response_cache import ResponseCache
+
+
+def test_response_cache(tmp_path: Path) -> None:
+    """Tests ``ResponseCache``."""
+    path = tmp_path / "cache.json"
+    cache = ResponseCache(max_size=2, path=path)
+    params = {"beam_size": 1, "temperature": 0.0}
+    hello, hi = (
+        ResponseCache.key("Hello!", "run/model.ckpt-1", params),
+        ResponseCache.key("Hi", "run/model.ckpt-1", params),
+    )
+
+    assert cache.get(hello) is None
+    cache.put(hello, "Hi!")
+    assert cache.get(hello) == "Hi!"
+    assert cache.get(ResponseCache.key("Hello!", "run/model.ckpt-2", params)) is None
+    assert cache.get(ResponseCache.key("Hello!", "other/model.ckpt-1", params)) is None
+    assert (
+        cache.get(ResponseCache.key("Hello!", "run/model.ckpt-1", params, [[3, 4]]))
+        is None
+    )
+    assert (
+        cache.get(ResponseCache.key("Hello!", "run/model.ckpt-1", {"beam_size": 4}))
+        is None
+    )
+
+    cache.put(hi, "Hello!")
+    cache.put(
+        ResponseCache.key("Hey", "run/model.ckpt-1", params), "Hey!"
+    )  # evicts `hello`
+    assert cache.get(hello) is None
+    assert cache.get(hi) == "Hello!"
+    assert cache.stats()["hit_rate"] == 2 / 8
+
+    cache.save()
+    assert ResponseCache(path=path).get(hi) == "Hello!"
+    assert ResponseCache(ttl=-1, path=path).get(hi) is None
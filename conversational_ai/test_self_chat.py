@@ -0,0 +1,52 @@
+"""Tests for the ``conversational_ai.self_chat`` module."""
+from typing import Dict, List
+
+from conversational_ai.chat import TokenizedHistory
+from conversational_ai.self_chat import _response, _self_chat
+
+
+def test_self_chat() -> None:
+    """Tests that all active conversations are advanced a turn per decode."""
+    turn_prefixes = ["s1>", "s2>"]
+    batches: List[int] = []
+
+    def predict(model_inputs: List[str]) -> List[str]:
+        batches.append(len(model_inputs))
+        # the conversation that starts with "bye" ends after its first response
+        return [
+            "" if "bye" in inp and "re" in inp else f"s2> re {len(inp)} s1> ok"
+            for inp in model_inputs
+        ]
+
+    def encode(text: str) -> list:
+        return text.split()
+
+    written: Dict[str, List[str]] = {}
+    seeds = iter(
+        [("a", ["hi"]), ("b", ["bye"]), ("c", ["hey", "ho", "x", "y"]), ("d", ["yo"])]
+    )
+    num_written = _self_chat(
+        predict,
+        seeds,
+        lambda: TokenizedHistory(encode, 100, "p:", turn_prefixes, " "),
+        turn_prefixes,
+        num_turns=3,
+        num_active=2,
+        write=written.__setitem__,
+    )
+    assert num_written == 4
+    assert written == {
+        "a": ["hi", "re 7", "re 15"],
+        "b": ["bye", "re 8"],
+        "c": ["hey", "ho", "x"],
+        "d": ["yo", "re 7", "re 15"],
+    }
+    # "c" doesn't need any turns and "d" is only started once "a" and "b" are done
+    assert batches == [2, 2, 1, 1]
+
+
+def test_response() -> None:
+    """Tests that ``_response`` handles the responses of both speakers."""
+    assert _response("s2> hi s1> hello", ["s1>", "s2>"]) == "hi"
+    assert _response("s1> hi s2> hello", ["s1>", "s2>"]) == "hi"
+    assert _response("hi s2> hello", ["s1>", "s2>"]) == "hi"
@@ -0,0 +1,27 @@
+"""Tests for the ``conversational_ai.serve`` module."""
+import asyncio
+from typing import List
+
+from conversational_ai.serve import MicroBatcher
+
+
+def test_micro_batcher() -> None:
+    """Tests that ``MicroBatcher`` groups concurrent requests into batches."""
+    batches: List[List[str]] = []
+
+    def predict(model_input: List[str]) -> List[str]:
+        batches.append(model_input)
+        return [inp.upper() for inp in model_input]
+
+    async def main() -> List[str]:
+        batcher = MicroBatcher(predict, max_batch_size=4, max_wait=0.1)
+        assert batcher.stats()["queue_depth"] == 0
+        await batcher.stop()  # before it's started
+        batcher.start()
+        results = await asyncio.gather(*(batcher(c) for c in "abcdef"))
+        assert batcher.stats()["num_requests"] == 6
+        await batcher.stop()
+        return [prediction for prediction, _ in results]
+
+    assert asyncio.run(main()) == list("ABCDEF")
+    assert [len(b) for b in batches] == [4, 2]
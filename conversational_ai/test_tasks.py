@@ -0,0 +1,27 @@
+"""Tests for the ``conversational_ai.tasks`` module."""
+import json
+import subprocess  # noqa: S404
+import sys
+from pathlib import Path
+
+
+def test_import_is_lazy() -> None:
+    """Tests that importing the tasks doesn't import TensorFlow or T5."""
+    code = (
+        "import json, sys\n"
+        "from conversational_ai import tasks\n"
+        "heavy = ['tensorflow', 't5', 'mesh_tensorflow']\n"
+        "heavy = [name for name in heavy if name in sys.modules]\n"
+        "print(json.dumps({'heavy': heavy, 'names': tasks.names()}))\n"
+    )
+    output = subprocess.run(  # noqa: S603
+        [sys.executable, "-c", code],
+        cwd=Path(__file__).parent.parent,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stdout
+    result = json.loads(output)
+    assert result["heavy"] == []
+    assert "chitchat_v003_prefix_lm" in result["names"]
+    assert "chitchat_dailydialog_v003_prefix_lm" in result["names"]
@@ -0,0 +1,41 @@
+"""Tests for the ``conversational_ai.transcript`` module."""
+from pathlib import Path
+
+from conversational_ai.transcript import ChatArchive, TranscriptWriter
+
+
+def test_transcript_writer(tmp_path: Path) -> None:
+    """Tests that ``TranscriptWriter`` only appends turns once there are enough."""
+    path = tmp_path.joinpath("chats", "chat.txt")
+    writer = TranscriptWriter(path, ["human: ", "model: "], min_turns=3)
+    writer.append("Hi!")
+    writer.append("Hello.")
+    assert not path.exists()
+    for turn in ["How are you?", "Good.", "Bye!"]:
+        writer.append(turn)
+    writer.close()
+    assert path.read_text() == (
+        "human: Hi!\nmodel: Hello.\nhuman: How are you?\nmodel: Good.\nhuman: Bye!\n"
+    )
+
+
+def test_chat_archive(tmp_path: Path) -> None:
+    """Tests that ``ChatArchive`` stores chats and configs (once) with an index."""
+    for name, turns in [("chat_1", "human: Hi!\nmodel: Hello.\n"), ("chat_2", "a\n")]:
+        tmp_path.joinpath(f"{name}.txt").write_text(turns)
+        tmp_path.joinpath(f"{name}.gin").write_text("a.b = 1\n")
+    tmp_path.joinpath("chat_2.tensorflow.log").write_text("INFO:tensorflow:...\n")
+
+    ChatArchive.create(tmp_path.joinpath("archive"), tmp_path.glob("*.txt"))
+    archive = ChatArchive(tmp_path.joinpath("archive"))
+    assert archive.names() == ["chat_1", "chat_2"]
+    assert archive.names(min_turns=2) == ["chat_1"]
+    assert len(archive.index["configs"]) == 1
+    assert list(archive.search("Hello")) == ["chat_1"]
+    assert archive.read("chat_1") == {
+        "name": "chat_1",
+        "turns": ["human: Hi!", "model: Hello."],
+        "config": "a.b = 1\n",
+        "log": None,
+    }
+    assert archive.read("chat_2")["log"] == "INFO:tensorflow:...\n"
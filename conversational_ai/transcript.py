@@ -0,0 +1,202 @@
+"""Writing chat transcripts and archiving them.
+
+Usage: `python3 -m conversational_ai.transcript --help`
+
+``TranscriptWriter`` appends each turn of a chat to its transcript as it happens.
+``ChatArchive`` consolidates many transcripts (``chat_*.txt``) and the gin configs
+and TensorFlow logs next to them into a single compressed file with an index, so
+a chat can be found and read without scanning or decompressing the others.
+"""
+import hashlib
+import json
+import os
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Union
+
+
+class TranscriptWriter:
+    """Appends the turns of a chat to a transcript, each with a speaker prefix.
+
+    Nothing is written until the chat has ``min_turns`` turns (so short chats
+    aren't saved), and then only new turns are appended. Writes are flushed at
+    most every ``flush_interval`` seconds, and synced to disk by ``close``.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        turn_prefixes: Iterable[str] = ("human: ", "model: "),
+        min_turns: int = 0,
+        flush_interval: float = 1.0,
+    ) -> None:
+        """Creates a new TranscriptWriter; the file isn't created until needed."""
+        self.path = Path(path)
+        self.turn_prefixes = list(turn_prefixes)
+        self.min_turns = min_turns
+        self.flush_interval = flush_interval
+        self.num_turns = 0
+        self._pending: List[str] = []
+        self._file: Any = None
+        self._last_flush = 0.0
+
+    def append(self, turn: str) -> None:
+        """Appends a turn, writing it (and any earlier ones) if there are enough."""
+        prefix = self.turn_prefixes[self.num_turns % len(self.turn_prefixes)]
+        self._pending.append(f"{prefix}{turn}\n")
+        self.num_turns += 1
+        if self.num_turns >= self.min_turns:
+            self._write()
+
+    def close(self) -> None:
+        """Writes the remaining turns and syncs the transcript to disk."""
+        if self._file is None:
+            return
+        self._write(flush=True)
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def _write(self, flush: bool = False) -> None:
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = self.path.open("a")
+        self._file.write("".join(self._pending))
+        self._pending.clear()
+        now = time.monotonic()
+        if flush or now - self._last_flush >= self.flush_interval:
+            self._file.flush()
+            self._last_flush = now
+
+
+class ChatArchive:
+    """A compressed archive of chats, read through an index.
+
+    ``{path}`` holds each chat (and each distinct gin config, which most chats
+    share) as a separately compressed JSON record; ``{path}.index.json`` maps the
+    names of chats and the hashes of configs to where their records are and also
+    keeps the number of turns of each chat, so chats can be listed without reading
+    ``{path}``.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        """Opens the archive at ``path``."""
+        self.path = Path(path)
+        self.index = json.loads(_index_path(self.path).read_text())
+
+    @staticmethod
+    def create(
+        path: Union[str, Path], transcripts: Iterable[Union[str, Path]]
+    ) -> "ChatArchive":
+        """Archives ``transcripts`` (and the configs and logs next to them)."""
+        path = Path(path)
+        index: Dict[str, Any] = {"chats": {}, "configs": {}}
+        with path.open("wb") as f:
+
+            def write(record: Dict[str, Any]) -> Dict[str, int]:
+                data = zlib.compress(json.dumps(record).encode("utf-8"), 9)
+                location = {"offset": f.tell(), "length": len(data)}
+                f.write(data)
+                return location
+
+            for transcript in sorted(Path(p) for p in transcripts):
+                chat = _read_chat(transcript)
+                config = chat["config"]
+                if config is not None:  # store each distinct config only once
+                    chat["config"] = hashlib.sha256(config.encode("utf-8")).hexdigest()
+                    if chat["config"] not in index["configs"]:
+                        index["configs"][chat["config"]] = write({"config": config})
+                index["chats"][chat["name"]] = {
+                    **write(chat),
+                    "num_turns": len(chat["turns"]),
+                    "config": chat["config"],
+                }
+        _index_path(path).write_text(json.dumps(index, indent=2) + "\n")
+        return ChatArchive(path)
+
+    def names(self, min_turns: int = 0) -> List[str]:
+        """Returns the names of the chats with at least ``min_turns`` turns."""
+        return [
+            name
+            for name, entry in sorted(self.index["chats"].items())
+            if entry["num_turns"] >= min_turns
+        ]
+
+    def read(self, name: str) -> Dict[str, Any]:
+        """Returns the ``turns``, gin ``config`` and TensorFlow ``log`` of a chat."""
+        chat = self._read(self.index["chats"][name])
+        if chat["config"] is not None:
+            chat["config"] = self._read(self.index["configs"][chat["config"]])["config"]
+        return chat
+
+    def search(self, text: str) -> Iterator[str]:
+        """Yields the names of the chats with a turn that contains ``text``."""
+        for name in self.names():
+            if any(
+                text in turn for turn in self._read(self.index["chats"][name])["turns"]
+            ):
+                yield name
+
+    def _read(self, location: Dict[str, int]) -> Dict[str, Any]:
+        with self.path.open("rb") as f:
+            f.seek(location["offset"])
+            data = f.read(location["length"])
+        return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+def _index_path(path: Path) -> Path:
+    return path.with_name(path.name + ".index.json")
+
+
+def _read_chat(transcript: Path) -> Dict[str, Any]:
+    """Reads a transcript and its config and log (if they exist) into a record."""
+    config_path = transcript.with_suffix(".gin")
+    log_path = transcript.with_suffix(".tensorflow.log")
+    return {
+        "name": transcript.stem,
+        "turns": transcript.read_text().splitlines(),
+        "config": config_path.read_text() if config_path.exists() else None,
+        "log": log_path.read_text() if log_path.exists() else None,
+    }
+
+
+def _parse_args() -> Any:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("archive", help="the path of the archive", metavar="PATH")
+    subparsers = parser.add_subparsers(dest="command")
+    create = subparsers.add_parser("create", help="archive transcripts")
+    create.add_argument("transcripts", nargs="+", help="the chat_*.txt files")
+    list_ = subparsers.add_parser("list", help="list the chats in the archive")
+    list_.add_argument("--min_turns", type=int, default=0)
+    list_.add_argument("--search", help="only list chats with a turn containing this")
+    show = subparsers.add_parser("show", help="print the transcript of a chat")
+    show.add_argument("name", help="the name of the chat")
+    show.add_argument("--config", action="store_true", help="print its config too")
+    return parser.parse_args()
+
+
+def _main(args: Any) -> None:
+    if args.command == "create":
+        archive = ChatArchive.create(args.archive, args.transcripts)
+        print(f"archived {len(archive.names())} chats in {archive.path}")
+    elif args.command == "list":
+        archive = ChatArchive(args.archive)
+        names = archive.search(args.search) if args.search else archive.names()
+        for name in names:
+            num_turns = archive.index["chats"][name]["num_turns"]
+            if num_turns >= args.min_turns:
+                print(f"{name}\t{num_turns}")
+    elif args.command == "show":
+        chat = ChatArchive(args.archive).read(args.name)
+        print("\n".join(chat["turns"]))
+        if args.config and chat["config"] is not None:
+            print(f"\n{chat['config']}")
+
+
+if __name__ == "__main__":
+    _main(_parse_args())